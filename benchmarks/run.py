@@ -0,0 +1,213 @@
+"""
+Throughput benchmarks for the worker, queue and rate limit machinery.
+
+Every configuration runs a stage against the simulated backend in its own
+process and reports rows/s, p50/p99 row latency, peak RSS and API calls per row.
+
+    python benchmarks/run.py                    # default sweep
+    python benchmarks/run.py --save-baseline    # store results as the baseline
+    python benchmarks/run.py --stages seed --max-threads 10 50 --batch-sizes 1 5 10
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import resource
+import itertools
+import contextlib
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [ROOT, os.path.join(ROOT, "generate")]
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+SENTENCE = "पीटीआई के मुताबिक यादव ने कहा कि अगले साल लोकसभा चुनाव से पहले तीसरे मोर्चे के गठन की कवायद से विपक्ष की एकजुटता पर असर नहीं पड़ेगा।"
+
+
+def make_rows(stage, size):
+
+    """
+    Synthetic input rows in the shape each stage reads.
+    """
+
+    for idx in range(size):
+        if stage == "seed":
+            yield f"bench:{idx}", {"text": f"{SENTENCE} {idx}"}
+        elif stage == "question":
+            yield f"bench:{idx}", {"seed": f"चुनाव {idx}"}
+        else:
+            yield f"bench:{idx}", {"question": f"लोकसभा चुनाव {idx} क्या है?"}
+
+
+class LatencyWriter:
+
+    """
+    Writer stand-in that records how long every row took from being queued to being done.
+    """
+
+    def __init__(self):
+        self.started = {}
+        self.latencies = []
+        self.rows = 0
+
+    def track(self, data_items):
+        for data_item in data_items:
+            self.started[data_item["seq"]] = time.perf_counter()
+            yield data_item
+
+    def put(self, seq, rows, row_ids, dropped=None):
+        latency = time.perf_counter() - self.started.pop(seq)
+        self.latencies.extend([latency] * len(rows or []))
+        self.rows += len(rows or [])
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_config(config, results):
+
+    """
+    Run one configuration. Meant to be the target of a fresh process so peak RSS is its own.
+    """
+
+    from seed import GeminiSeed
+    from question import GeminiQuestion
+    from answer import GeminiAnswer
+
+    stage_cls = {"seed": GeminiSeed, "question": GeminiQuestion, "answer": GeminiAnswer}[config["stage"]]
+    backend_kwargs = {"latency": config["latency"], "rate_429": config["rate_429"], "rate_500": config["rate_500"], "seed": 0}
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        generator = stage_cls(backend="simulated", backend_kwargs=backend_kwargs, cache_mode="bypass",
+                              rpm=10 ** 7, tpm=10 ** 10, max_retries=10)
+
+    # Retries back off for real; keep them short so a sweep finishes quickly
+    import models.gemini
+    models.gemini.backoff_delay = lambda attempt: 0.01 * (2 ** attempt)
+
+    writer = LatencyWriter()
+    data_items = writer.track(generator.process_input(make_rows(config["stage"], config["size"]), batch_size=config["batch_size"]))
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        generator.run(writer, data_items, mode=config["mode"], max_threads=config["workers"], max_concurrency=config["workers"])
+    elapsed = time.perf_counter() - start
+
+    calls = sum(client.backend.calls for client in generator.pool.clients)
+    results.put({
+        **config,
+        "rows": writer.rows,
+        "rows_per_s": writer.rows / elapsed,
+        "p50_latency": percentile(writer.latencies, 0.5),
+        "p99_latency": percentile(writer.latencies, 0.99),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "calls_per_row": calls / max(1, writer.rows),
+    })
+
+
+def config_key(config):
+    return f"{config['stage']}/{config['mode']}/workers={config['workers']}/batch={config['batch_size']}/size={config['size']}"
+
+
+def find_regressions(results, baseline, tolerance):
+
+    """
+    Compare results with the baseline.
+
+    Returns:
+        list: One message per metric that got worse by more than tolerance.
+    """
+
+    # Metric name mapped to whether higher is better
+    metrics = {"rows_per_s": True, "p99_latency": False, "peak_rss_mb": False, "calls_per_row": False}
+    regressions = []
+
+    for result in results:
+        base = baseline.get(config_key(result))
+        if base is None:
+            continue
+
+        for metric, higher_is_better in metrics.items():
+            old, new = base[metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f"{config_key(result)}: {metric} {old:.3f} -> {new:.3f} ({change:+.0%})")
+
+    return regressions
+
+
+def main(stages, modes, max_threads, batch_sizes, sizes, latency, rate_429, rate_500, save_baseline=False, tolerance=0.2):
+    os.environ["GENI_RATELIMIT_DB"] = os.path.join(tempfile.mkdtemp(), "ratelimit.sqlite")
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+
+    print(f"{'config':<55} {'rows/s':>9} {'p50 s':>7} {'p99 s':>7} {'rss MB':>7} {'calls/row':>9}")
+    for stage, mode, workers, batch_size, size in itertools.product(stages, modes, max_threads, batch_sizes, sizes):
+        if stage == "answer" and batch_size > 1:
+            continue
+
+        config = {"stage": stage, "mode": mode, "workers": workers, "batch_size": batch_size, "size": size,
+                  "latency": latency, "rate_429": rate_429, "rate_500": rate_500}
+
+        queue = context.Queue()
+        process = context.Process(target=run_config, args=(config, queue))
+        process.start()
+        process.join()
+
+        # Results are small, so the child has exited by the time they are readable
+        if process.exitcode != 0:
+            print(f"{config_key(config):<55} failed with exit code {process.exitcode}")
+            continue
+        result = queue.get()
+
+        results.append(result)
+        print(f"{config_key(result):<55} {result['rows_per_s']:>9.1f} {result['p50_latency']:>7.3f} {result['p99_latency']:>7.3f} "
+              f"{result['peak_rss_mb']:>7.1f} {result['calls_per_row']:>9.3f}")
+
+    if save_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump({config_key(result): result for result in results}, f, indent=2)
+        print(f"Saved baseline to {BASELINE_PATH}")
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print("No baseline found. Run with --save-baseline to store one.")
+        return 0
+
+    with open(BASELINE_PATH, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressions = find_regressions(results, baseline, tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the generation stages against a simulated backend.")
+    parser.add_argument("--stages", nargs="+", choices=["seed", "question", "answer"], default=["seed", "question", "answer"])
+    parser.add_argument("--modes", nargs="+", choices=["thread", "async"], default=["thread", "async"])
+    parser.add_argument("--max-threads", nargs="+", type=int, default=[10, 50], help="Worker counts to sweep (threads or async tasks)")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 5], help="Rows per request to sweep")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[200, 1000], help="Input row counts to sweep")
+    parser.add_argument("--latency", type=float, default=0.05, help="Median simulated request latency in seconds")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of simulated requests failing with 429")
+    parser.add_argument("--rate-500", type=float, default=0.01, help="Fraction of simulated requests failing with 500")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change that counts as a regression")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    args = parser.parse_args()
+
+    sys.exit(main(args.stages, args.modes, args.max_threads, args.batch_sizes, args.sizes, args.latency,
+                  args.rate_429, args.rate_500, save_baseline=args.save_baseline, tolerance=args.tolerance))
@@ -1,34 +1,221 @@
 import json
 import os
+import glob
+import hashlib
 import argparse
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from huggingface_hub import login
-from datasets import load_dataset
+from utils.jsonl import read_jsonl
 
 HUGGINGFACE_TOKEN = os.getenv("HUGGINGFACE_TOKEN")
-login(token=HUGGINGFACE_TOKEN)
 
-def save_samples(samples):
-    dataset = load_dataset("uonlp/CulturaX", "hi", split='train', streaming=True)
+# Unicode block of the script each language is written in, for the script filter
+SCRIPTS = {
+    "hi": ("\u0900", "\u097f"), "mr": ("\u0900", "\u097f"), "ne": ("\u0900", "\u097f"), "sa": ("\u0900", "\u097f"),
+    "bn": ("\u0980", "\u09ff"), "as": ("\u0980", "\u09ff"), "pa": ("\u0a00", "\u0a7f"), "gu": ("\u0a80", "\u0aff"),
+    "or": ("\u0b00", "\u0b7f"), "ta": ("\u0b80", "\u0bff"), "te": ("\u0c00", "\u0c7f"), "kn": ("\u0c80", "\u0cff"),
+    "ml": ("\u0d00", "\u0d7f"),
+}
 
-    subrows = [item for _, item in zip(range(samples), dataset)]
+def script_ratio(text, lang):
 
-    if not os.path.exists('data'):
-        os.mkdir('data')
+    """
+    Fraction of the letters in text that belong to the script of lang. 1.0 for languages without a known script.
+    """
 
-    # Save to jsonl file
-    with open(f'data/{str(samples)}.jsonl', 'w', encoding='utf-8') as f:
-        for entry in subrows:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    if lang not in SCRIPTS:
+        return 1.0
 
-    print(f"Saved {samples} samples to data/{str(samples)}.jsonl")
+    start, end = SCRIPTS[lang]
+    letters = [char for char in text if char.isalpha() or start <= char <= end]
+    if not letters:
+        return 0.0
+
+    return sum(1 for char in letters if start <= char <= end) / len(letters)
+
+def text_hash(text):
+    # Whitespace differences don't make a document new
+    return hashlib.blake2b(" ".join(text.split()).encode("utf-8"), digest_size=16).digest()
+
+def stream_rows(lang, offset=0, dataset_path=None):
+
+    """
+    Stream CulturaX rows of one language, starting after the first offset rows.
+
+    Args:
+        lang (str): Language config of CulturaX, e.g. "hi".
+        offset (int): Rows of the stream to skip.
+        dataset_path (str): Local copy to read instead of the Hub: a jsonl file, or a folder with
+            <lang>/*.jsonl or *.jsonl files in it.
+    """
+
+    if dataset_path is None:
+        from datasets import load_dataset
+
+        dataset = load_dataset("uonlp/CulturaX", lang, split='train', streaming=True)
+        return iter(dataset.skip(offset))
+
+    if os.path.isdir(os.path.join(dataset_path, lang)):
+        dataset_path = os.path.join(dataset_path, lang)
+
+    files = sorted(glob.glob(os.path.join(dataset_path, "*.jsonl"))) if os.path.isdir(dataset_path) else [dataset_path]
+    return islice(chain.from_iterable(read_jsonl(file) for file in files), offset, None)
+
+def shard_path(folder, shard):
+    return os.path.join(folder, f"shard_{shard:05d}.jsonl")
+
+def load_state(folder):
+    state_path = os.path.join(folder, "_state.json")
+    if not os.path.exists(state_path):
+        return {"offset": 0, "shards": 0, "kept": 0}
+
+    with open(state_path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_state(folder, state):
+    state_path = os.path.join(folder, "_state.json")
+    with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+def save_language(lang, samples, output_folder="data", shard_size=10000, min_length=0, max_length=None, min_script_ratio=0.0, dataset_path=None, resume=False):
+
+    """
+    Stream samples of one language into fixed size jsonl shards, <output_folder>/<lang>/shard_NNNNN.jsonl.
+    A shard is written to a .tmp file and renamed once full, and the stream offset is saved with
+    it, so an interrupted download resumes after the last complete shard. A last shard left short
+    because a run stopped at samples is filled up first, so only the very last shard is ever short.
+
+    Args:
+        lang (str): Language config of CulturaX.
+        samples (int): Number of rows to keep, counting rows kept by earlier runs when resuming.
+        output_folder (str): Folder holding one shard folder per language.
+        shard_size (int): Rows per shard.
+        min_length (int): Drop texts shorter than this many characters.
+        max_length (int): Drop texts longer than this many characters. None keeps all.
+        min_script_ratio (float): Drop texts where less than this fraction of the letters are in the language's script.
+        dataset_path (str): Local copy of the dataset to read instead of the Hub.
+        resume (bool): Continue from the saved state instead of starting over.
+    """
+
+    folder = os.path.join(output_folder, lang)
+    os.makedirs(folder, exist_ok=True)
+
+    if resume:
+        state = load_state(folder)
+    else:
+        for path in glob.glob(os.path.join(folder, "shard_*.jsonl*")):
+            os.remove(path)
+        state = {"offset": 0, "shards": 0, "kept": 0}
+
+    # Exact duplicates of rows in finished shards must stay out of the new ones
+    seen = set()
+    for shard in range(state["shards"]):
+        seen.update(text_hash(row["text"]) for row in read_jsonl(shard_path(folder, shard)))
+
+    skipped = {"length": 0, "script": 0, "duplicate": 0}
+    rows = stream_rows(lang, state["offset"], dataset_path)
+    offset, kept, shard = state["offset"], state["kept"], state["shards"]
+
+    # The rows of a short last shard go first into its .tmp file, which replaces it once refilled
+    refill = []
+    if shard > 0:
+        with open(shard_path(folder, shard - 1), encoding="utf-8") as f:
+            last_rows = f.readlines()
+        if len(last_rows) < shard_size and kept < samples:
+            shard -= 1
+            refill = last_rows
+
+    while kept < samples:
+        tmp_path = shard_path(folder, shard) + ".tmp"
+        in_shard = len(refill)
+
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(refill)
+            for row in rows:
+                offset += 1
+                text = row.get("text") or ""
+
+                if len(text) < min_length or (max_length is not None and len(text) > max_length):
+                    skipped["length"] += 1
+                    continue
+
+                if min_script_ratio and script_ratio(text, lang) < min_script_ratio:
+                    skipped["script"] += 1
+                    continue
+
+                digest = text_hash(text)
+                if digest in seen:
+                    skipped["duplicate"] += 1
+                    continue
+                seen.add(digest)
+
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                in_shard += 1
+                kept += 1
+                if in_shard >= shard_size or kept >= samples:
+                    break
+
+        if in_shard == len(refill):
+            # Nothing new; a shard being refilled stays as it was
+            os.remove(tmp_path)
+            if refill:
+                shard += 1
+            break
+        refill = []
+
+        os.replace(tmp_path, shard_path(folder, shard))
+        shard += 1
+        save_state(folder, {"offset": offset, "shards": shard, "kept": kept})
+
+        if in_shard < shard_size and kept < samples:
+            # Stream ran out
+            break
+
+    print(f"[{lang}] Saved {kept} samples in {shard} shards to {folder}. Skipped {skipped['length']} by length, "
+          f"{skipped['script']} by script and {skipped['duplicate']} duplicates")
+
+def save_samples(samples, languages=("hi",), output_folder="data", workers=None, dataset_path=None, **kwargs):
+
+    """
+    Download every language in parallel, one thread per language.
+
+    Args:
+        samples (int): Number of rows to keep per language.
+        languages (list): CulturaX language configs.
+        output_folder (str): Folder holding one shard folder per language.
+        workers (int): Languages downloaded at the same time. Defaults to all of them.
+        dataset_path (str): Local copy of the dataset to read instead of the Hub.
+        **kwargs: Passed on to save_language (shard_size, min_length, max_length, min_script_ratio, resume).
+    """
+
+    if dataset_path is None:
+        from huggingface_hub import login
+        login(token=HUGGINGFACE_TOKEN)
+
+    with ThreadPoolExecutor(max_workers=workers or len(languages)) as executor:
+        futures = [executor.submit(save_language, lang, samples, output_folder, dataset_path=dataset_path, **kwargs) for lang in languages]
+        for future in futures:
+            future.result()
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Save samples from uonlp/CulturaX dataset to a jsonl file.")
-    parser.add_argument("--samples", type=int, required=True, help="Number of samples to save")
+    parser = argparse.ArgumentParser(description="Save samples from uonlp/CulturaX dataset to sharded jsonl files, one folder per language.")
+    parser.add_argument("--samples", type=int, required=True, help="Number of samples to save per language")
+    parser.add_argument("--languages", nargs="+", default=["hi"], help="CulturaX language configs to download")
+    parser.add_argument("--output-folder", default="data", help="Folder holding one shard folder per language")
+    parser.add_argument("--shard-size", type=int, default=10000, help="Rows per shard")
+    parser.add_argument("--min-length", type=int, default=0, help="Drop texts shorter than this many characters")
+    parser.add_argument("--max-length", type=int, default=None, help="Drop texts longer than this many characters")
+    parser.add_argument("--min-script-ratio", type=float, default=0.0, help="Drop texts where less than this fraction of letters are in the language's script")
+    parser.add_argument("--dataset-path", default=None, help="Read a local jsonl copy of the dataset instead of streaming from the Hub")
+    parser.add_argument("--workers", type=int, default=None, help="Languages downloaded at the same time")
+    parser.add_argument("--resume", action="store_true", help="Continue after the last complete shard of an earlier run")
     args = parser.parse_args()
 
-    save_samples(args.samples)
+    save_samples(args.samples, languages=args.languages, output_folder=args.output_folder, workers=args.workers, dataset_path=args.dataset_path,
+                 shard_size=args.shard_size, min_length=args.min_length, max_length=args.max_length,
+                 min_script_ratio=args.min_script_ratio, resume=args.resume)
@@ -1,49 +1,36 @@
 import os
-from threading import Thread
-from queue import Queue
-import json
-import sys
+import argparse
 from dotenv import load_dotenv
 load_dotenv()
 
-from models.gemini import Gemini
+from models.gemini import Gemini, add_arguments, main_kwargs
 
 class GeminiAnswer(Gemini):
 
-    def __init__(self, api_key=None, model_name="gemini-pro"):
-        super().__init__(api_key, model_name)
+    def __init__(self, api_key=None, model_name="gemini-pro", **kwargs):
+        super().__init__(api_key, model_name, **kwargs)
 
         self.INPUT_PROMPT = ''''''
         self.equal_rows = False
 
-    def process_input(self, data, batch_size=1):
+    def build_prompt(self, row):
 
         """
-        Process the input data and create a queue for parallel processing.
+        Build the input prompt for one data item.
 
         Args:
-            data (list): List of data items.
-            batch_size (int): The batch size for processing.
+            row (dict): The data item.
 
         Returns:
-            Queue: A queue containing input prompts and original rows.
+            str: The input prompt.
         """
-        
-        data_queue = Queue()
 
-        for idx in range(0, len(data), batch_size):
-            batch = data[idx:idx+batch_size]
-
-            input_prompts = []
-            for row in batch:
-                text = row["question"]
-                input_prompt = self.INPUT_PROMPT + text
-                input_prompts.append(input_prompt)
-
-            data_queue.put({"input_prompt": input_prompts, "original_rows": batch})
-
-        return data_queue
+        text = row["question"]
+        return self.INPUT_PROMPT + text
     
+    def simulated_text(self, prompt):
+        return "यह एक नकली उत्तर है। " * 50
+
     def postprocess_response(self, output_rows, original_rows, response_text):
 
         """
@@ -67,50 +54,27 @@ class GeminiAnswer(Gemini):
 
         return original_rows
     
-def main(input_folder, max_threads=10):
+def main(input_folder, max_threads=10, mode="thread", max_concurrency=100, batch_size=1, resume=False, retry_dead=False, writer_kwargs=None, metrics_path=None, metrics_interval=10.0, job_db=None, job_rows=10000, lease_seconds=300, priority=None, **kwargs):
 
     """
     Main function for processing input files.
+    Run options not listed here are documented in Gemini.run_files.
 
     Args:
-        input_folder (str): Path to the input folder containing seed jsonl files.
+        input_folder (str): Path to the input folder containing question jsonl files.
+        **kwargs: Passed on to the Gemini constructor (model_name, rpm, tpm, cache_path, cache_mode, request_timeout, hedge_percentile, prefix_cache).
     """
 
     api_key = os.getenv("GEMINI_API_KEY")
-    answer_generator = GeminiAnswer(api_key=api_key)
-
-    files = os.listdir(input_folder)
-    files = [file for file in files if file.endswith(".jsonl")]
-    save_folder = input_folder + "_answers"
-
-    if not os.path.exists(save_folder):
-        os.makedirs(save_folder)
-
-    for file in files:
-
-        filepath = os.path.join(input_folder, file)
-        print(f"Processing file: {filepath}")
-        
-        output_filepath = os.path.join(save_folder, f"{file.split('.')[0]}_output.jsonl")
-
-        with open(filepath, encoding='utf-8') as f:
-            data = [json.loads(line) for line in f]
-
-        data_queue = answer_generator.process_input(data)
-
-    with open(output_filepath, "w", encoding='utf-8') as f:
-        threads = [Thread(target=answer_generator.worker, args=(f, data_queue)) for i in range(max_threads)]
-
-        for thread in threads:
-            thread.start()
-
-        for thread in threads:
-            thread.join()
+    answer_generator = GeminiAnswer(api_key=api_key, **kwargs)
+    answer_generator.run_files(input_folder, "_answers", max_threads=max_threads, mode=mode, max_concurrency=max_concurrency, batch_size=batch_size,
+                               resume=resume, retry_dead=retry_dead, writer_kwargs=writer_kwargs, metrics_path=metrics_path,
+                               metrics_interval=metrics_interval, job_db=job_db, job_rows=job_rows, lease_seconds=lease_seconds, priority=priority)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python generate/answer.py <input_folder>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Generate answers for question jsonl files.")
+    parser.add_argument("input_folder", help="Folder containing input question jsonl files")
+    add_arguments(parser, packable=GeminiAnswer.packable)
+    args = parser.parse_args()
 
-    input_folder = sys.argv[1]
-    main(input_folder)
\ No newline at end of file
+    main(args.input_folder, **main_kwargs(args))
@@ -0,0 +1,64 @@
+import os
+import argparse
+
+from utils.jsonl import read_jsonl, dumps
+from utils.minhash import LSHIndex
+
+def main(input_folder, threshold=0.8, num_perm=128, ngram=3, field="question", index_path=None):
+
+    """
+    Drop near duplicate questions before they reach the answer stage. Rows are streamed
+    through a persistent MinHash LSH index, so questions from earlier runs are matched too.
+
+    Args:
+        input_folder (str): Path to the input folder containing question jsonl files.
+        threshold (float): Estimated Jaccard similarity from which two questions are duplicates.
+        num_perm (int): MinHash signature length.
+        ngram (int): Aksharas per n-gram.
+        field (str): Row field holding the text to compare.
+        index_path (str): SQLite file of the index. Defaults to index.sqlite in the output folder.
+    """
+
+    files = os.listdir(input_folder)
+    files = [file for file in files if file.endswith(".jsonl")]
+    save_folder = input_folder + "_dedup"
+    duplicates_folder = os.path.join(save_folder, "duplicates")
+
+    if not os.path.exists(duplicates_folder):
+        os.makedirs(duplicates_folder)
+
+    kept = dropped = 0
+    with LSHIndex(index_path or os.path.join(save_folder, "index.sqlite"), threshold=threshold, num_perm=num_perm, ngram=ngram) as index:
+        for file in files:
+            filepath = os.path.join(input_folder, file)
+            print(f"Processing file: {filepath}")
+
+            with open(os.path.join(save_folder, file), "w", encoding="utf-8") as out, \
+                 open(os.path.join(duplicates_folder, file), "w", encoding="utf-8") as dup:
+
+                for line_no, row in enumerate(read_jsonl(filepath)):
+                    text = row.get(field)
+                    # Keys are stable across runs, so re-running a file keeps what it kept before
+                    match = index.check(f"{os.path.abspath(filepath)}:{line_no}", text) if text else None
+
+                    if match is None:
+                        out.write(dumps(row) + "\n")
+                        kept += 1
+                    else:
+                        row["duplicate_of"], row["similarity"] = match
+                        dup.write(dumps(row) + "\n")
+                        dropped += 1
+
+    print(f"Kept {kept} questions, dropped {dropped} near duplicates")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drop near duplicate questions with MinHash LSH before generating answers.")
+    parser.add_argument("input_folder", help="Folder containing input question jsonl files")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Estimated Jaccard similarity from which two questions are duplicates")
+    parser.add_argument("--num-perm", type=int, default=128, help="MinHash signature length")
+    parser.add_argument("--ngram", type=int, default=3, help="Aksharas per n-gram")
+    parser.add_argument("--field", default="question", help="Row field holding the text to compare")
+    parser.add_argument("--index-path", default=None, help="SQLite file of the persistent index, shared across runs")
+    args = parser.parse_args()
+
+    main(args.input_folder, threshold=args.threshold, num_perm=args.num_perm, ngram=args.ngram, field=args.field, index_path=args.index_path)
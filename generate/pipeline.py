@@ -0,0 +1,253 @@
+import os
+import asyncio
+import argparse
+from itertools import count
+from dotenv import load_dotenv
+load_dotenv()
+
+from models.gemini import add_client_arguments, client_kwargs
+from models.metrics import METRICS, Reporter
+from utils.jsonl import read_jsonl, count_lines
+from utils.minhash import LSHIndex
+from utils.prefilter import PreFilter
+from utils.checkpoint import row_id
+from utils.writer import OutputWriter
+from utils.deadletter import DeadLetters
+from seed import GeminiSeed, get_list, drop_english
+from question import GeminiQuestion
+from answer import GeminiAnswer
+
+
+async def seed_rows(seed_row, seed_row_id, seen):
+
+    """
+    Turn one seed stage output row into question stage input rows,
+    one per new Hindi name or keyword.
+
+    Args:
+        seed_row (dict): Row with model extracted Name and Keywords.
+        seed_row_id (str): Row ID of the seed row.
+        seen (set): Seeds already sent on during this run.
+
+    Yields:
+        tuple: (row_id, row) pairs for the question stage.
+    """
+
+    seeds = get_list(seed_row_id, seed_row, 'Name') + get_list(seed_row_id, seed_row, 'Keywords')
+
+    for seed in drop_english(seeds):
+        if seed in seen:
+            continue
+        seen.add(seed)
+        yield f"seed:{seed}", {"seed": seed}
+
+
+async def question_rows(question_row, row_id, dedup=None):
+
+    """
+    Pass a question on to the answer stage if the model produced one
+    and it is not a near duplicate of a question already passed on.
+    """
+
+    if not question_row.get("question"):
+        return
+
+    # Hashing and the SQLite lookup run in a thread, off the event loop the stages share
+    if dedup is not None and await asyncio.to_thread(dedup.check, row_id, question_row["question"]) is not None:
+        METRICS.inc("near_duplicates_total", stage="question")
+        return
+
+    yield row_id, dict(question_row)
+
+
+async def read_source(input_folder, out_queue, prefilter=None, stage="seed"):
+    files = sorted(file for file in os.listdir(input_folder) if file.endswith(".jsonl"))
+
+    for file in files:
+        print(f"Processing file: {os.path.join(input_folder, file)}")
+        pairs = ((row_id(file, line_no), row) for line_no, row in enumerate(read_jsonl(os.path.join(input_folder, file))))
+        if prefilter is not None:
+            pairs = prefilter.filter(pairs, on_drop=lambda row_id, reason: METRICS.inc("rows_skipped_total", stage=stage, reason="prefilter"))
+
+        for pair in pairs:
+            await out_queue.put(pair)
+
+
+async def stage_worker(generator, in_queue, writer, batch_size, seqs, forward=None, out_queue=None):
+
+    """
+    Take (row_id, row) pairs from in_queue until a None sentinel, process them in
+    batches, write them to the stage tap and forward the results to the next stage.
+
+    Args:
+        generator (Gemini): Stage generator.
+        in_queue (asyncio.Queue): Input pairs of the stage.
+        writer (OutputWriter): Tap of the stage.
+        batch_size (int): Rows per request.
+        seqs (iterator): Shared counter numbering the stage's items.
+        forward (callable): forward(row, row_id) is an async generator of (row_id, row) pairs for the next stage.
+        out_queue (asyncio.Queue): Input queue of the next stage.
+    """
+
+    stopping = False
+    while not stopping:
+        batch = []
+        pair = await in_queue.get()
+        while pair is not None:
+            batch.append(pair)
+            if len(batch) >= batch_size or in_queue.empty():
+                break
+            pair = in_queue.get_nowait()
+        stopping = pair is None
+
+        if not batch:
+            continue
+
+        METRICS.set("queue_depth", in_queue.qsize(), stage=generator.stage)
+
+        data_item = generator.make_item(batch, next(seqs))
+        processed_rows, done_ids = None, []
+        try:
+            processed_rows, done_ids = await generator.process_item_async(data_item)
+        except Exception as e:
+            print(f"Error processing item: {e}")
+            data_item["dropped"] = []
+            generator.drop(data_item, "error", str(e))
+        finally:
+            writer.put(data_item["seq"], processed_rows, done_ids, data_item.get("dropped"))
+
+        METRICS.inc("rows_done_total", len(done_ids), stage=generator.stage)
+
+        if out_queue is None:
+            continue
+
+        for done_id, row in zip(done_ids, processed_rows or []):
+            async for next_pair in forward(row, done_id):
+                await out_queue.put(next_pair)
+
+
+async def run_stage(workers, next_queue, next_workers):
+
+    """
+    Wait for every worker of a stage, then tell each worker of the next stage to stop.
+    """
+
+    await asyncio.gather(*workers)
+
+    if next_queue is not None:
+        for _ in range(next_workers):
+            await next_queue.put(None)
+
+
+async def run_pipeline(input_folder, output_folder, max_concurrency=100, seed_batch_size=1, question_batch_size=1, queue_size=1000,
+                       metrics_path=None, metrics_interval=10.0, dedup_threshold=None, prefilter_kwargs=None, **kwargs):
+
+    """
+    Run seed extraction, question generation and answer generation as concurrent
+    stages connected by bounded queues. Every stage writes its rows to a jsonl tap
+    in output_folder as soon as they are done.
+
+    Args:
+        input_folder (str): Path to the input folder containing content jsonl files.
+        output_folder (str): Folder for the seeds, questions and answers taps.
+        max_concurrency (int): Maximum number of in-flight requests per stage.
+        seed_batch_size (int): Rows packed into one seed request.
+        question_batch_size (int): Rows packed into one question request.
+        queue_size (int): Capacity of each queue between stages.
+        metrics_path (str): File to export metrics to, None to only print progress.
+        metrics_interval (float): Seconds between progress lines and metrics exports.
+        dedup_threshold (float): Drop questions at least this similar to an earlier one before answering them. None answers every question.
+        prefilter_kwargs (dict): Thresholds of the PreFilter dropping content rows not worth a seed call. None disables it.
+        **kwargs: Passed on to the Gemini constructors (model_name, rpm, tpm, cache_path, cache_mode, request_timeout, hedge_percentile, prefix_cache).
+    """
+
+    api_key = os.getenv("GEMINI_API_KEY")
+
+    # All stages use the same model, so they draw from the same shared rate limit bucket
+    seed_generator = GeminiSeed(api_key=api_key, **kwargs)
+    question_generator = GeminiQuestion(api_key=api_key, **kwargs)
+    answer_generator = GeminiAnswer(api_key=api_key, **kwargs)
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    seed_queue = asyncio.Queue(maxsize=queue_size)
+    question_queue = asyncio.Queue(maxsize=queue_size)
+    answer_queue = asyncio.Queue(maxsize=queue_size)
+    seen = set()
+
+    # Only the seed stage knows its input size up front
+    stages = [seed_generator.stage, question_generator.stage, answer_generator.stage]
+    totals = {seed_generator.stage: sum(count_lines(os.path.join(input_folder, file)) for file in os.listdir(input_folder) if file.endswith(".jsonl"))}
+
+    prefilter = PreFilter(max_chars=seed_generator.max_chars, **prefilter_kwargs) if prefilter_kwargs is not None else None
+
+    # The taps are rewritten on every run, so the index starts empty too; questions kept by an
+    # earlier run have no answers left and must not count as seen
+    dedup = LSHIndex(os.path.join(output_folder, "questions_lsh.sqlite"), threshold=dedup_threshold, resume=False) if dedup_threshold else None
+
+    seeds_path, questions_path, answers_path = (os.path.join(output_folder, name) for name in ("seeds.jsonl", "questions.jsonl", "answers.jsonl"))
+
+    # Rows a stage drops go to <tap>.dead with the reason they were dropped
+    with DeadLetters(seeds_path) as seed_dead, OutputWriter(seeds_path, dead_letters=seed_dead) as seed_writer, \
+         DeadLetters(questions_path) as question_dead, OutputWriter(questions_path, dead_letters=question_dead) as question_writer, \
+         DeadLetters(answers_path) as answer_dead, OutputWriter(answers_path, dead_letters=answer_dead) as answer_writer, \
+         Reporter(stages, totals=totals, path=metrics_path, interval=metrics_interval):
+
+        seed_seqs, question_seqs, answer_seqs = count(), count(), count()
+
+        seed_workers = [stage_worker(seed_generator, seed_queue, seed_writer, seed_batch_size, seed_seqs,
+                                     lambda row, done_id: seed_rows(row, done_id, seen), question_queue) for _ in range(max_concurrency)]
+        question_workers = [stage_worker(question_generator, question_queue, question_writer, question_batch_size, question_seqs,
+                                         lambda row, done_id: question_rows(row, done_id, dedup), answer_queue) for _ in range(max_concurrency)]
+        answer_workers = [stage_worker(answer_generator, answer_queue, answer_writer, 1, answer_seqs) for _ in range(max_concurrency)]
+
+        async def source():
+            await read_source(input_folder, seed_queue, prefilter, seed_generator.stage)
+            for _ in range(max_concurrency):
+                await seed_queue.put(None)
+
+        await asyncio.gather(
+            source(),
+            run_stage(seed_workers, question_queue, max_concurrency),
+            run_stage(question_workers, answer_queue, max_concurrency),
+            run_stage(answer_workers, None, 0),
+        )
+
+    if dedup is not None:
+        dedup.close()
+
+    if prefilter is not None:
+        prefilter.report(seed_batch_size)
+
+    print(f"Wrote {len(seen)} seeds, {question_writer.rows_written} questions and {answer_writer.rows_written} answers to {output_folder}")
+
+
+def main(input_folder, **kwargs):
+
+    """
+    Main function for running the whole pipeline.
+
+    Args:
+        input_folder (str): Path to the input folder containing content jsonl files.
+        **kwargs: Passed on to run_pipeline.
+    """
+
+    asyncio.run(run_pipeline(input_folder, input_folder + "_pipeline", **kwargs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run seed, question and answer generation as one streaming pipeline.")
+    parser.add_argument("input_folder", help="Folder containing input content jsonl files")
+    parser.add_argument("--max-concurrency", type=int, default=100, help="Maximum number of in-flight requests per stage")
+    parser.add_argument("--seed-batch-size", type=int, default=1, help="Rows packed into one seed request")
+    parser.add_argument("--question-batch-size", type=int, default=1, help="Rows packed into one question request")
+    parser.add_argument("--queue-size", type=int, default=1000, help="Capacity of each queue between stages")
+    parser.add_argument("--no-prefilter", action="store_true", help="Send every content row, without dropping short, non-Hindi, repetitive or boilerplate texts first")
+    parser.add_argument("--dedup-threshold", type=float, default=None, help="Drop questions at least this similar (MinHash Jaccard) to an earlier one before answering")
+    add_client_arguments(parser)
+    args = parser.parse_args()
+
+    main(args.input_folder, max_concurrency=args.max_concurrency, seed_batch_size=args.seed_batch_size,
+         question_batch_size=args.question_batch_size, queue_size=args.queue_size, dedup_threshold=args.dedup_threshold,
+         prefilter_kwargs=None if args.no_prefilter else {}, **client_kwargs(args))
@@ -1,49 +1,70 @@
 import os
-from threading import Thread
-from queue import Queue
-import json
-import sys
+import argparse
 from dotenv import load_dotenv
 load_dotenv()
 
-from models.gemini import Gemini
+from models.gemini import Gemini, add_arguments, main_kwargs
+from models.metrics import Reporter
+from utils.checkpoint import Checkpoint
+from utils.seed_index import SeedIndex
+from utils.writer import open_writer
+from utils.deadletter import DeadLetters
 
 class GeminiQuestion(Gemini):
 
-    def __init__(self, api_key=None, model_name="gemini-pro"):
-        super().__init__(api_key, model_name)
+    packable = True
+
+    def __init__(self, api_key=None, model_name="gemini-pro", **kwargs):
+        super().__init__(api_key, model_name, **kwargs)
 
         self.INPUT_PROMPT = ''' Generate a question using the given seed words.
 '''
+        self.PACK_FIELDS = {"question": "the question"}
 
-    def process_input(self, data, batch_size=1):
+    def build_prompt(self, row):
 
         """
-        Process the input data and create a queue for parallel processing.
+        Build the input prompt for one data item.
 
         Args:
-            data (list): List of data items.
-            batch_size (int): The batch size for processing.
+            row (dict): The data item.
 
         Returns:
-            Queue: A queue containing input prompts and original rows.
+            str: The input prompt.
         """
-        
-        data_queue = Queue()
 
-        for idx in range(0, len(data), batch_size):
-            batch = data[idx:idx+batch_size]
+        text = row["seed"]
+        return self.INPUT_PROMPT + f"\nSeeds: {text}\nQuestion:"
+
+    def pack_text(self, row):
+        text = row["seed"]
+        return f"Seeds: {text}"
+
+    def apply_packed(self, row, item, response_text):
+
+        """
+        Update a row with its object from a packed response.
 
-            input_prompts = []
-            for row in batch:
-                text = row["seed"]
-                input_prompt = self.INPUT_PROMPT + f"\nSeeds: {text}\nQuestion:"
-                input_prompts.append(input_prompt)
+        Args:
+            row (dict): The original row.
+            item (dict): Parsed object of the row.
+            response_text (str): The raw response text.
 
-            data_queue.put({"input_prompt": input_prompts, "original_rows": batch})
+        Returns:
+            dict: Updated row.
+        """
 
-        return data_queue
+        row["question"] = str(item["question"]).strip()
+        row["question_raw"] = response_text
+        return row
     
+    def simulated_fields(self, text):
+        return {"question": f"{text.replace('Seeds: ', '')} क्या है?"}
+
+    def simulated_text(self, prompt):
+        seed = prompt.rsplit("Seeds: ", 1)[-1].split("\n")[0]
+        return f"{seed} क्या है?"
+
     def postprocess_response(self, output_rows, original_rows, response_text):
 
         """
@@ -72,51 +93,81 @@ class GeminiQuestion(Gemini):
 
         return original_rows
     
-def main(input_folder, max_threads=10):
+def main(input_folder=None, max_threads=10, mode="thread", max_concurrency=100, batch_size=1, resume=False, retry_dead=False, writer_kwargs=None, metrics_path=None, metrics_interval=10.0, seed_index=None, min_count=1, job_db=None, job_rows=10000, lease_seconds=300, priority=None, **kwargs):
 
     """
     Main function for processing input files.
+    Run options not listed here are documented in Gemini.run_files.
 
     Args:
         input_folder (str): Path to the input folder containing seed jsonl files.
+        seed_index (str): SQLite seed index to read new seeds from instead of input_folder.
+        min_count (int): Only ask about seeds from the index seen at least this many times.
+        **kwargs: Passed on to the Gemini constructor (model_name, rpm, tpm, cache_path, cache_mode, request_timeout, hedge_percentile, prefix_cache).
     """
 
     api_key = os.getenv("GEMINI_API_KEY")
-    question_generator = GeminiQuestion(api_key=api_key)
+    question_generator = GeminiQuestion(api_key=api_key, **kwargs)
 
-    files = os.listdir(input_folder)
-    files = [file for file in files if file.endswith(".jsonl")]
-    save_folder = input_folder + "_questions"
+    if seed_index:
+        # The index is one growing output in one process, with nothing to shard or order
+        if job_db or priority:
+            raise ValueError("--seed-index runs in one process, without --job-db or --priority")
+        run_index(question_generator, seed_index, min_count, max_threads, mode, max_concurrency, batch_size, writer_kwargs, metrics_path, metrics_interval, retry_dead)
+        return
 
-    if not os.path.exists(save_folder):
-        os.makedirs(save_folder)
+    question_generator.run_files(input_folder, "_questions", max_threads=max_threads, mode=mode, max_concurrency=max_concurrency, batch_size=batch_size,
+                                 resume=resume, retry_dead=retry_dead, writer_kwargs=writer_kwargs, metrics_path=metrics_path,
+                                 metrics_interval=metrics_interval, job_db=job_db, job_rows=job_rows, lease_seconds=lease_seconds, priority=priority)
 
+def run_index(question_generator, seed_index, min_count, max_threads, mode, max_concurrency, batch_size, writer_kwargs, metrics_path, metrics_interval, retry_dead):
 
-    for file in files:
+    """
+    Generate questions for the seeds of a seed index that have none yet. Questions go to
+    <index>_questions/questions.jsonl, which every run appends to, so it is always resumed.
+    """
 
-        filepath = os.path.join(input_folder, file)
-        print(f"Processing file: {filepath}")
-        
-        output_filepath = os.path.join(save_folder, f"{file.split('.')[0]}_output.jsonl")
+    index = SeedIndex(seed_index)
+    save_folder = os.path.splitext(seed_index)[0] + "_questions"
 
-        with open(filepath, encoding='utf-8') as f:
-            data = [json.loads(line) for line in f]
+    if not os.path.exists(save_folder):
+        os.makedirs(save_folder)
 
-        data_queue = question_generator.process_input(data)
+    output_filepath = os.path.join(save_folder, "questions.jsonl")
+    print(f"Processing seed index: {seed_index}")
 
-        with open(output_filepath, "w", encoding='utf-8') as f:
-            threads = [Thread(target=question_generator.worker, args=(f, data_queue)) for i in range(max_threads)]
+    # Every run only sees seeds that are new since the last one, so the output is always resumed
+    checkpoint = Checkpoint(output_filepath, resume=True)
+    dead_letters = DeadLetters(output_filepath, resume=True, retry=retry_dead)
 
-            for thread in threads:
-                thread.start()
+    if retry_dead:
+        pairs = list(dead_letters.pending(checkpoint))
+        print(f"Retrying {len(pairs)} dropped rows ({dead_letters.reasons()})")
+        data_items = question_generator.process_input(pairs)
+        totals = {question_generator.stage: len(pairs)}
+    else:
+        pairs = (pair for pair in index.pending(min_count) if not checkpoint.is_done(pair[0]))
+        data_items = question_generator.process_input(pairs, batch_size=batch_size)
+        totals = {question_generator.stage: index.count_pending(min_count)}
 
-            for thread in threads:
-                thread.join()
+    with dead_letters, open_writer(output_filepath, checkpoint=checkpoint, dead_letters=dead_letters, **(writer_kwargs or {})) as writer, \
+         Reporter([question_generator.stage], totals=totals, path=metrics_path, interval=metrics_interval):
+        question_generator.run(writer, data_items, mode=mode, max_threads=max_threads, max_concurrency=max_concurrency)
+    checkpoint.close()
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python generate/question.py <input_folder>")
-        sys.exit(1)
+    index.mark_asked(checkpoint.done)
 
-    input_folder = sys.argv[1]
-    main(input_folder)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate questions from seed jsonl files.")
+    parser.add_argument("input_folder", nargs="?", help="Folder containing input seed jsonl files")
+    parser.add_argument("--seed-index", default=None, help="Read new seeds from this SQLite seed index instead of input_folder")
+    parser.add_argument("--min-count", type=int, default=1, help="Only ask about seeds from the index seen at least this many times")
+    add_arguments(parser, packable=GeminiQuestion.packable)
+    args = parser.parse_args()
+
+    if not args.input_folder and not args.seed_index:
+        parser.error("either input_folder or --seed-index is required")
+    if args.seed_index and (args.job_db or args.priority):
+        parser.error("--seed-index runs in one process, without --job-db or --priority")
+
+    main(args.input_folder, seed_index=args.seed_index, min_count=args.min_count, **main_kwargs(args))
@@ -1,19 +1,25 @@
 import os
-from threading import Thread
-from queue import Queue
-import json
-import sys
-import ast
+import argparse
+from functools import partial
+from contextlib import contextmanager
 import re
+import threading
+from collections import Counter
 from dotenv import load_dotenv
 load_dotenv()
 
-from models.gemini import Gemini
+from models.gemini import Gemini, add_arguments, main_kwargs
+from models.metrics import METRICS
+from utils.jsonl import dumps
+from utils.seed_index import SeedIndex
+from utils.prefilter import PreFilter, cut_sentences
 
 class GeminiSeed(Gemini):
 
-    def __init__(self, api_key=None, model_name="gemini-pro"):
-        super().__init__(api_key, model_name)
+    packable = True
+
+    def __init__(self, api_key=None, model_name="gemini-pro", **kwargs):
+        super().__init__(api_key, model_name, **kwargs)
 
         self.INPUT_PROMPT = '''Extract important Hindi keywords and Name from the given sentence. Remember to keep name and keywords seperate. 
 All English word and number must be ignored.
@@ -21,34 +27,62 @@ All English word and number must be ignored.
 sentence: पीटीआई के मुताबिक, यादव ने कहा कि अगले साल लोकसभा चुनाव से पहले तीसरे मोर्चे के गठन की कवायद से विपक्ष की एकजुटता पर असर नहीं पड़ेगा। टीएमसी अध्यक्ष ममता बनर्जी और टीआरएस प्रमुख चंद्रशेखर राव द्वारा तीसरा मोर्चा बनाने की कवायद से विपक्ष की एकता के प्रयासों को धक्का लगने के सवाल पर उन्होंने कहा ‘‘मुझे नहीं लगता कि तीसरा मोर्चा वजूद में आयेगा। कुछ समय इंतजार करें, तीसरा मोर्चा बनाने वाले ही साझा विपक्ष की बात करेंगे। 
 Name: ['पीटीआई', 'यादव', 'टीएमसी', 'टीआरएस' ,'ममता बनर्जी', 'चंद्रशेखर राव'], Keywords: [ 'लोकसभा', 'चुनाव', 'पहले',  'तीसरे',  'मोर्चे', 'गठन', 'विपक्ष', 'एकजुटता', 'प्रमुख', 'असर', 'अध्यक्ष', 'मोर्चा', 'एकता', 'प्रयासों', 'धक्का', 'सवाल', 'वजूद' ]
 '''
+        self.PACK_FIELDS = {"Name": "list of names", "Keywords": "list of keywords"}
+
+        # Longest text sent per row, cut at a sentence end
+        self.max_chars = 500
+
+        # Seeds of every file of the run. Files are counted on their own as their rows are
+        # flushed, so no second pass over the output is needed, and merged in once done.
+        self.seed_counts = SeedCounts()
+
+    def build_prompt(self, row):
+
+        """
+        Build the input prompt for one data item.
+
+        Args:
+            row (dict): The data item.
+
+        Returns:
+            str: The input prompt.
+        """
+
+        text = cut_sentences(row["text"], self.max_chars) # Taking only the first sentences to keep the input prompt short
+        return self.INPUT_PROMPT + f"\nsentence: {text}"
 
-    def process_input(self, data, batch_size=1):
+    def pack_text(self, row):
+        text = cut_sentences(row["text"], self.max_chars)
+        return f"sentence: {text}"
+
+    def apply_packed(self, row, item, response_text):
 
         """
-        Process the input data and create a queue for parallel processing.
+        Update a row with its object from a packed response.
+        Lists are stored in the same text form as single-row responses.
 
         Args:
-            data (list): List of data items.
-            batch_size (int): The batch size for processing.
+            row (dict): The original row.
+            item (dict): Parsed object of the row.
+            response_text (str): The raw response text.
 
         Returns:
-            Queue: A queue containing input prompts and original rows.
+            dict: Updated row.
         """
-        
-        data_queue = Queue()
 
-        for idx in range(0, len(data), batch_size):
-            batch = data[idx:idx+batch_size]
+        row["Name"] = str(item["Name"])
+        row["Keywords"] = str(item["Keywords"])
+        row["response"] = response_text
 
-            input_prompts = []
-            for row in batch:
-                text = row["text"][:500] # Taking only the first 500 characters to keep the input prompt short
-                input_prompt = self.INPUT_PROMPT + f"\nsentence: {text}"
-                input_prompts.append(input_prompt)
+        return row
 
-            data_queue.put({"input_prompt": input_prompts, "original_rows": batch})
+    def simulated_fields(self, text):
+        words = re.findall(r"[\u0900-\u097F]+", text)
+        return {"Name": words[:2], "Keywords": words[2:10]}
 
-        return data_queue
+    def simulated_text(self, prompt):
+        fields = self.simulated_fields(prompt.rsplit("sentence: ", 1)[-1])
+        return f"Name: {fields['Name']}, Keywords: {fields['Keywords']}"
 
     def postprocess_response(self, output_rows, original_rows, response_text):
 
@@ -82,109 +116,186 @@ Name: ['पीटीआई', 'यादव', 'टीएमसी', 'टीआर
 
         return original_rows
     
-def get_list(idx, row, key):
+# A quote left open at the end is a list the model was cut off in
+_QUOTED = re.compile(r"'([^'\n]*)(?:'|$)|\"([^\"\n]*)(?:\"|$)")
+_ENGLISH = re.compile(r"[a-zA-Z0-9]")
 
-    key_string = row[key]
+def parse_list(text):
 
-    key_list = []
-    try:
-        key_list = ast.literal_eval(key_string)
-    except:
-        print("Error parsing names list for idx {} row {}".format(idx, row[key]))
+    """
+    Parse a list the model wrote out as text, e.g. "['यादव', 'ममता बनर्जी']".
+    Much faster than ast.literal_eval, and tolerant of what breaks it in model
+    output: a missing closing bracket, mixed quotes, trailing commas or no quotes at all.
+
+    Args:
+        text (str): The list as text. An actual list is passed through.
+
+    Returns:
+        list: The stripped, non-empty items.
+    """
+
+    if isinstance(text, list):
+        items = [str(item) for item in text]
+    elif not text:
+        return []
+    else:
+        items = [single or double for single, double in _QUOTED.findall(text)]
+        if not items:
+            items = text.strip().strip("[]").split(",")
+
+    return [item.strip() for item in items if item.strip()]
+
+def get_list(idx, row, key):
+    return parse_list(row.get(key))
 
-    return key_list
-    
 def drop_english(data_list):
-    # Drop words with english characters or numbers
-    pattern = re.compile('[a-zA-Z0-9]')
-    data_list = [x for x in data_list if not pattern.match(x) and len(x) > 1]
-    return data_list
-
-def read_data(file_path):
-    data = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            data.append(json.loads(line))
-    return data
+    # Drop words containing any english character or number, and single characters
+    return [x for x in data_list if not _ENGLISH.search(x) and len(x) > 1]
+
+class SeedCounts:
+
+    """
+    Running frequency counts of the names and keywords seen across every input file.
+    """
+
+    def __init__(self):
+        self.names = Counter()
+        self.keywords = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, row):
+        names = drop_english(parse_list(row.get("Name")))
+        keywords = drop_english(parse_list(row.get("Keywords")))
+
+        with self._lock:
+            self.names.update(names)
+            self.keywords.update(keywords)
+
+    def add_rows(self, rows):
+
+        """
+        Count rows that are already in the output, e.g. the rows a resumed run already finished.
+        """
+
+        for row in rows:
+            self.add(row)
+
+    def merge(self, other):
+        with self._lock:
+            self.names.update(other.names)
+            self.keywords.update(other.keywords)
+
+    @staticmethod
+    def select(counts, min_count=1, top_k=None):
+
+        """
+        Returns:
+            list: (seed, count) pairs seen at least min_count times, most frequent first, at most top_k of them.
+        """
+
+        return [(seed, count) for seed, count in counts.most_common(top_k) if count >= min_count]
 
 def save_data(file_path, data):
     with open(file_path, 'w', encoding='utf-8') as f:
-        for row in data:
-            row_dict = {"seed": row}
-            f.write(json.dumps(row_dict, ensure_ascii=False) + "\n")
+        for seed, count in data:
+            row_dict = {"seed": seed, "count": count}
+            f.write(dumps(row_dict) + "\n")
 
-def main(input_folder, max_threads=10):
+def main(input_folder, max_threads=10, mode="thread", max_concurrency=100, batch_size=1, resume=False, retry_dead=False, writer_kwargs=None, metrics_path=None, metrics_interval=10.0, min_count=1, top_k=None, seed_index=None, prefilter_kwargs=None, job_db=None, job_rows=10000, lease_seconds=300, priority=None, **kwargs):
 
     """
     Main function for processing input files.
+    Run options not listed here are documented in Gemini.run_files.
 
     Args:
         input_folder (str): Path to the input folder containing content jsonl files.
+        min_count (int): Keep seeds seen at least this many times across all files.
+        top_k (int): Keep only this many of the most frequent names and keywords. None keeps all.
+        seed_index (str): SQLite seed index to add the seeds of every file to, with the file as their source.
+        prefilter_kwargs (dict): Thresholds of the PreFilter dropping rows not worth a call. None disables it.
+        job_db (str): SQLite job table to lease row range shards from, shared with other workers. None processes every file here.
+            The seeds of every shard are stored with it, and the worker finishing the last shard writes the merged seeds.
+        **kwargs: Passed on to the Gemini constructor (model_name, rpm, tpm, cache_path, cache_mode, request_timeout, hedge_percentile, prefix_cache).
     """
 
     api_key = os.getenv("GEMINI_API_KEY")
-    seed_generator = GeminiSeed(api_key=api_key)
+    seed_generator = GeminiSeed(api_key=api_key, **kwargs)
 
-    files = os.listdir(input_folder)
-    files = [file for file in files if file.endswith(".jsonl")]
-    save_folder = input_folder + "_output"
+    seed_counts = seed_generator.seed_counts
+    index = SeedIndex(seed_index) if seed_index else None
+    prefilter = PreFilter(max_chars=seed_generator.max_chars, **prefilter_kwargs) if prefilter_kwargs is not None else None
 
-    if not os.path.exists(save_folder):
-        os.makedirs(save_folder)
+    filter_pairs = None
+    if prefilter is not None:
+        filter_pairs = partial(prefilter.filter, on_drop=lambda row_id, reason: METRICS.inc("rows_skipped_total", stage=seed_generator.stage, reason="prefilter"))
 
-    for file in files:
-        filepath = os.path.join(input_folder, file)
-        print(f"Processing file: {filepath}")
-        
-        output_filepath = os.path.join(save_folder, f"{file.split('.')[0]}_output.jsonl")
+    @contextmanager
+    def count_seeds(shard):
+        file_counts = SeedCounts()
+        yield file_counts.add_rows
 
-        with open(filepath, encoding='utf-8') as f:
-            data = [json.loads(line) for line in f]
+        shard.result = {"names": file_counts.names, "keywords": file_counts.keywords}
 
-        data_queue = seed_generator.process_input(data)
+        if index is not None:
+            source = os.path.abspath(shard.filepath) + (f":{shard.start}" if job_db else "")
+            new = index.add(file_counts.names, "name", source) + index.add(file_counts.keywords, "keyword", source)
+            print(f"Added {new} new seeds to the seed index")
 
-        with open(output_filepath, "w", encoding='utf-8') as f:
-            threads = [Thread(target=seed_generator.worker, args=(f, data_queue)) for i in range(max_threads)]
+        seed_counts.merge(file_counts)
 
-            for thread in threads:
-                thread.start()
+    jobs = seed_generator.run_files(input_folder, "_output", max_threads=max_threads, mode=mode, max_concurrency=max_concurrency, batch_size=batch_size,
+                                    resume=resume, retry_dead=retry_dead, writer_kwargs=writer_kwargs, metrics_path=metrics_path,
+                                    metrics_interval=metrics_interval, job_db=job_db, job_rows=job_rows, lease_seconds=lease_seconds, priority=priority,
+                                    filter_pairs=filter_pairs, file_hook=count_seeds)
 
-            for thread in threads:
-                thread.join()
+    if prefilter is not None:
+        prefilter.report(batch_size)
 
-        # Extract out name and keywords. Then drop english words and save.
-        data = read_data(output_filepath)
-        uq_name = set()
-        uq_keywords = set()
+    if jobs is not None:
+        if not jobs.finished(seed_generator.stage):
+            print("Other workers still hold shards. The worker finishing the last one writes the merged seeds")
+            return
 
-        for idx, row in enumerate(data):
-            names_list = get_list(idx, row, 'Name')
-            for name in names_list:
-                uq_name.add(name)
-            keywords_list = get_list(idx, row, 'Keywords')
-            for keyword in keywords_list:
-                uq_keywords.add(keyword)
+        # This worker only counted its own shards, the table has the seeds of all of them
+        seed_counts = SeedCounts()
+        for result in jobs.results(seed_generator.stage):
+            seed_counts.names.update(result["names"])
+            seed_counts.keywords.update(result["keywords"])
 
-        uq_name = drop_english(uq_name)
-        uq_keywords = drop_english(uq_keywords)
+    # Seeds are merged across files, so a seed common to many files is written once
+    save_folder = input_folder + "_output"
+    keywords_folder = os.path.join(save_folder, "keywords")
+    names_folder = os.path.join(save_folder, "names")
 
-        keywords_folder = os.path.join(save_folder, "keywords")
-        names_folder = os.path.join(save_folder, "names")
+    if not os.path.exists(keywords_folder):
+        os.makedirs(keywords_folder)
 
-        if not os.path.exists(keywords_folder):
-            os.makedirs(keywords_folder)
+    if not os.path.exists(names_folder):
+        os.makedirs(names_folder)
 
-        if not os.path.exists(names_folder):
-            os.makedirs(names_folder)
+    names = seed_counts.select(seed_counts.names, min_count=min_count, top_k=top_k)
+    keywords = seed_counts.select(seed_counts.keywords, min_count=min_count, top_k=top_k)
 
-        save_data(os.path.join(names_folder, f"{file.split('.')[0]}_uq_name.jsonl"), list(uq_name))
-        save_data(os.path.join(keywords_folder, f"{file.split('.')[0]}_uq_keywords.jsonl"), list(uq_keywords))
+    save_data(os.path.join(names_folder, "uq_name.jsonl"), names)
+    save_data(os.path.join(keywords_folder, "uq_keywords.jsonl"), keywords)
+    print(f"Saved {len(names)} names and {len(keywords)} keywords")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python generate/seed.py <input_folder>")
-        sys.exit(1)
-
-    input_folder = sys.argv[1]
-    main(input_folder)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Extract seed names and keywords from content jsonl files.")
+    parser.add_argument("input_folder", help="Folder containing input content jsonl files")
+    parser.add_argument("--min-count", type=int, default=1, help="Keep seeds seen at least this many times across all files")
+    parser.add_argument("--top-k", type=int, default=None, help="Keep only this many of the most frequent names and keywords")
+    parser.add_argument("--seed-index", default=None, help="SQLite seed index to add the extracted seeds to")
+    parser.add_argument("--no-prefilter", action="store_true", help="Send every row, without dropping short, non-Hindi, repetitive or boilerplate texts first")
+    parser.add_argument("--min-length", type=int, default=50, help="Pre-filter: minimum text length in characters")
+    parser.add_argument("--min-script-ratio", type=float, default=0.5, help="Pre-filter: minimum share of letters that are Devanagari")
+    parser.add_argument("--max-repetition", type=float, default=0.5, help="Pre-filter: maximum share of repeated word trigrams")
+    parser.add_argument("--max-boilerplate", type=float, default=0.5, help="Pre-filter: maximum share of boilerplate lines")
+    add_arguments(parser, packable=GeminiSeed.packable)
+    args = parser.parse_args()
+
+    prefilter_kwargs = None if args.no_prefilter else {"min_length": args.min_length, "min_script_ratio": args.min_script_ratio,
+                                                       "max_repetition": args.max_repetition, "max_boilerplate": args.max_boilerplate}
+
+    main(args.input_folder, min_count=args.min_count, top_k=args.top_k, seed_index=args.seed_index, prefilter_kwargs=prefilter_kwargs, **main_kwargs(args))
@@ -0,0 +1,366 @@
+import json
+import time
+import datetime
+import threading
+import random
+import socket
+import asyncio
+import urllib.error
+import urllib.request
+from abc import ABC, abstractmethod
+
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+
+BACKENDS = ("gemini", "simulated", "openai")
+OPENAI_BASE_URL = "http://localhost:8000/v1"
+
+
+class BackendError(Exception):
+
+    """
+    Error raised by non Gemini backends. The message starts with the HTTP status
+    code, so the retry logic can tell 429s and 500s apart like it does for Gemini.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(f"{status} {message}")
+        self.status = status
+
+
+class RequestTimeout(BackendError):
+
+    """
+    A request that ran past its deadline. Reported as a 504, like Gemini reports its own deadline errors.
+    """
+
+    def __init__(self, timeout):
+        super().__init__(504, f"Deadline of {timeout}s exceeded")
+        self.timeout = timeout
+
+
+class Usage:
+
+    """
+    Token counts of a response, named like Gemini's usage_metadata. cached_content_token_count
+    is the part of the prompt served from a cached prefix.
+    """
+
+    def __init__(self, prompt_token_count=0, candidates_token_count=0, cached_content_token_count=0):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class BackendResponse:
+
+    """
+    Response of a non Gemini backend. Like Gemini responses, reading .text of a
+    blocked response raises ValueError.
+    """
+
+    def __init__(self, text, usage_metadata=None, blocked=False):
+        self._text = text
+        self.usage_metadata = usage_metadata
+        self.blocked = blocked
+
+    @property
+    def text(self):
+        if self.blocked:
+            raise ValueError("Response was blocked.")
+        return self._text
+
+
+def _prompt_text(prompt):
+    if isinstance(prompt, str):
+        return prompt
+    return "\n".join(prompt)
+
+
+class Backend(ABC):
+
+    """
+    Something that turns a prompt into a response with .text and .usage_metadata.
+    Both methods take a timeout in seconds, None for no deadline, and raise
+    RequestTimeout or the client's own 504 when the request runs past it.
+    A prefix is a fixed instruction sent ahead of the prompt as the system
+    instruction, which the backend caches where it can.
+    """
+
+    @abstractmethod
+    def generate(self, prompt, generation_config, safety_settings, timeout=None, prefix=None):
+        pass
+
+    @abstractmethod
+    async def generate_async(self, prompt, generation_config, safety_settings, timeout=None, prefix=None):
+        pass
+
+
+class GeminiBackend(Backend):
+
+    """
+    google.generativeai with a client per API key instead of the process wide one genai.configure sets up.
+
+    A prefix is stored once with the context caching API and referenced by every request, so its
+    tokens are billed at the cached rate. Models that don't support caching, or prefixes below the
+    minimum cache size, get it back in front of the prompt instead.
+
+    Per key clients are set on the model's _client and _async_client, which google-generativeai has
+    no public way to do; requirements.txt pins the version this was written against.
+    """
+
+    def __init__(self, api_key, model_name, cache_ttl=3600):
+
+        """
+        Args:
+            api_key (str): API key of the client.
+            model_name (str): Model name.
+            cache_ttl (float): Seconds a cached prefix lives. It is created again shortly before it expires.
+        """
+
+        self.api_key = api_key
+        self.model_name = model_name
+        self.cache_ttl = cache_ttl
+        self.model = self._client_model(genai.GenerativeModel(model_name))
+
+        # Prefix mapped to (model carrying it, time to renew it), and the event loop each model's async client is bound to
+        self._models = {None: (self.model, float("inf"))}
+        self._loops = {}
+        self._lock = threading.Lock()
+
+    def _client_model(self, model):
+        model._client = glm.GenerativeServiceClient(client_options={"api_key": self.api_key})
+        return model
+
+    def _prefixed_model(self, prefix):
+
+        """
+        Returns:
+            tuple: (model referencing the cached prefix, or None if it could not be cached, time to renew it).
+        """
+
+        model_name = self.model_name if "/" in self.model_name else f"models/{self.model_name}"
+        try:
+            cache_client = glm.CacheServiceClient(client_options={"api_key": self.api_key})
+            request = glm.CreateCachedContentRequest(cached_content=glm.CachedContent(
+                model=model_name, system_instruction=glm.Content(parts=[glm.Part(text=prefix)]), ttl=datetime.timedelta(seconds=self.cache_ttl)))
+            cached = cache_client.create_cached_content(request)
+        except Exception as e:
+            # Not as a system instruction: models without caching, like gemini-pro, mostly reject those too
+            print(f"Context caching is not available for {self.model_name} ({e}). Sending the prefix in front of the prompt")
+            # Tried again after cache_ttl, in case the failure was passing
+            return None, time.time() + self.cache_ttl
+
+        return self._client_model(genai.GenerativeModel.from_cached_content(cached)), time.time() + self.cache_ttl - 60
+
+    def _model(self, prefix, prompt):
+
+        """
+        Returns:
+            tuple: (model, prompt) to send, with the prefix put back in front of the prompt if it isn't cached.
+        """
+
+        if prefix is None:
+            return self.model, prompt
+
+        with self._lock:
+            model, renew_at = self._models.get(prefix, (None, 0))
+            if time.time() >= renew_at:
+                model, renew_at = self._models[prefix] = self._prefixed_model(prefix)
+                self._loops.pop(prefix, None)
+
+        return (model, prompt) if model is not None else (self.model, prefix + prompt)
+
+    def generate(self, prompt, generation_config, safety_settings, timeout=None, prefix=None):
+        model, prompt = self._model(prefix, prompt)
+
+        # The client cancels the call at the deadline and raises DeadlineExceeded, a 504
+        request_options = {"timeout": timeout} if timeout else None
+        return model.generate_content(prompt, generation_config=generation_config, safety_settings=safety_settings, request_options=request_options)
+
+    async def generate_async(self, prompt, generation_config, safety_settings, timeout=None, prefix=None):
+        model, prompt = await asyncio.to_thread(self._model, prefix, prompt) if prefix is not None else (self.model, prompt)
+        # An uncached prefix went into the prompt, and the plain model's async client is kept under None
+        if model is self.model:
+            prefix = None
+
+        # Async clients are bound to an event loop, and every file runs on a fresh one
+        loop = asyncio.get_running_loop()
+        if self._loops.get(prefix) is not loop:
+            model._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": self.api_key})
+            self._loops[prefix] = loop
+
+        request_options = {"timeout": timeout} if timeout else None
+        try:
+            return await asyncio.wait_for(model.generate_content_async(prompt, generation_config=generation_config, safety_settings=safety_settings,
+                                                                       request_options=request_options), timeout)
+        except asyncio.TimeoutError:
+            raise RequestTimeout(timeout)
+
+
+class SimulatedBackend(Backend):
+
+    """
+    Local stand-in for the API, for load testing without quota or network.
+    Latency follows a lognormal distribution, and 429s, 500s and safety
+    blocks are injected at configurable rates. Prefixes are cached like
+    Gemini's context caching: after the first request with a prefix, its
+    tokens are reported as cached_content_token_count.
+    """
+
+    def __init__(self, responses=None, latency=1.0, latency_sigma=0.5, rate_429=0.0, rate_500=0.0, block_rate=0.0, seed=None):
+
+        """
+        Args:
+            responses: Canned responses. A callable taking the prompt text, a list cycled through, or a single string.
+            latency (float): Median latency in seconds.
+            latency_sigma (float): Sigma of the lognormal latency distribution. 0 gives a fixed latency.
+            rate_429 (float): Fraction of requests failing with 429.
+            rate_500 (float): Fraction of requests failing with 500.
+            block_rate (float): Fraction of responses blocked as if by safety filters.
+            seed (int): Random seed for reproducible runs.
+        """
+
+        self.responses = responses if responses is not None else "simulated response"
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.block_rate = block_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.prefixes = set()
+
+    def _sample(self, prompt, prefix=None):
+
+        """
+        Returns:
+            tuple: (latency in seconds, response or exception to raise).
+        """
+
+        self.calls += 1
+        latency = self.latency * self.random.lognormvariate(0, self.latency_sigma) if self.latency_sigma else self.latency
+        draw = self.random.random()
+
+        if draw < self.rate_429:
+            return latency, BackendError(429, "Resource has been exhausted (simulated)")
+        if draw < self.rate_429 + self.rate_500:
+            return latency, BackendError(500, "Internal error (simulated)")
+
+        text = _prompt_text(prompt)
+        if callable(self.responses):
+            output = self.responses(text)
+        elif isinstance(self.responses, str):
+            output = self.responses
+        else:
+            output = self.responses[(self.calls - 1) % len(self.responses)]
+
+        prefix_tokens = len(prefix) // 3 + 1 if prefix else 0
+        cached_tokens = prefix_tokens if prefix in self.prefixes else 0
+        if prefix:
+            self.prefixes.add(prefix)
+
+        usage = Usage(prefix_tokens + len(text) // 3 + 1, len(output) // 3 + 1, cached_tokens)
+        return latency, BackendResponse(output, usage, blocked=self.random.random() < self.block_rate)
+
+    def generate(self, prompt, generation_config, safety_settings, timeout=None, prefix=None):
+        latency, result = self._sample(prompt, prefix)
+        if timeout and latency > timeout:
+            time.sleep(timeout)
+            raise RequestTimeout(timeout)
+
+        time.sleep(latency)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def generate_async(self, prompt, generation_config, safety_settings, timeout=None, prefix=None):
+        latency, result = self._sample(prompt, prefix)
+        if timeout and latency > timeout:
+            await asyncio.sleep(timeout)
+            raise RequestTimeout(timeout)
+
+        await asyncio.sleep(latency)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class OpenAIBackend(Backend):
+
+    """
+    OpenAI compatible chat completions endpoint, e.g. a local vLLM or llama.cpp server.
+    A prefix goes out as the system message, which servers with prefix caching reuse
+    across requests and report as cached prompt tokens.
+    """
+
+    def __init__(self, api_key, model_name, base_url=OPENAI_BASE_URL, timeout=600):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.timeout = timeout
+
+    def generate(self, prompt, generation_config, safety_settings, timeout=None, prefix=None):
+        messages = [{"role": "user", "content": _prompt_text(prompt)}]
+        if prefix:
+            messages.insert(0, {"role": "system", "content": prefix})
+
+        body = json.dumps({
+            "model": self.model_name,
+            "messages": messages,
+            "max_tokens": getattr(generation_config, "max_output_tokens", None),
+            "temperature": getattr(generation_config, "temperature", None),
+        }).encode("utf-8")
+
+        request = urllib.request.Request(self.url, data=body, headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}",
+        })
+
+        timeout = min(timeout, self.timeout) if timeout else self.timeout
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                result = json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise BackendError(e.code, e.read().decode("utf-8", errors="replace")) from e
+        except (TimeoutError, socket.timeout) as e:
+            raise RequestTimeout(timeout) from e
+        except urllib.error.URLError as e:
+            if isinstance(e.reason, (TimeoutError, socket.timeout)):
+                raise RequestTimeout(timeout) from e
+            raise
+
+        choice = result["choices"][0]
+        usage = result.get("usage") or {}
+
+        return BackendResponse(
+            choice["message"]["content"] or "",
+            Usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)),
+            blocked=choice.get("finish_reason") == "content_filter",
+        )
+
+    async def generate_async(self, prompt, generation_config, safety_settings, timeout=None, prefix=None):
+        return await asyncio.to_thread(self.generate, prompt, generation_config, safety_settings, timeout, prefix)
+
+
+def make_backend(backend, api_key, model_name, **kwargs):
+
+    """
+    Build a backend by name.
+
+    Args:
+        backend (str): One of BACKENDS.
+        api_key (str): API key of the backend.
+        model_name (str): Model name of the backend.
+        **kwargs: Backend specific options (base_url for openai, latency and error rates for simulated).
+    """
+
+    if backend == "gemini":
+        return GeminiBackend(api_key, model_name)
+    if backend == "simulated":
+        return SimulatedBackend(**kwargs)
+    if backend == "openai":
+        return OpenAIBackend(api_key, model_name, **kwargs)
+
+    raise ValueError(f"Unknown backend: {backend}")
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+import dataclasses
+
+DEFAULT_CACHE_PATH = os.getenv("GENI_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "geni", "responses.sqlite"))
+
+CACHE_MODES = ("readwrite", "readonly", "refresh", "bypass")
+
+
+class CachedResponse:
+
+    """
+    Stand-in for an API response served from the cache. Exposes the same
+    attributes the workers read from a real response.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+def make_key(prompt, model_name, generation_config, safety_settings, prefix=None, backend=None):
+
+    """
+    Content address of a request: everything that can change the model output.
+    A prefix sent as the system instruction is part of it, keys of requests without one are unchanged.
+    So is the backend that answered, e.g. "simulated" or "openai:<base url>", so the canned answers
+    of a load test are never served to a real run. Keys of gemini requests leave it out and are unchanged.
+
+    Returns:
+        str: Hex sha256 digest.
+    """
+
+    if dataclasses.is_dataclass(generation_config):
+        generation_config = dataclasses.asdict(generation_config)
+
+    payload = json.dumps({
+        "prompt": prompt,
+        "model_name": model_name,
+        "generation_config": generation_config,
+        "safety_settings": safety_settings,
+        **({"prefix": prefix} if prefix is not None else {}),
+        **({"backend": backend} if backend is not None else {}),
+    }, sort_keys=True, ensure_ascii=False, default=str)
+
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+
+    """
+    On-disk SQLite cache of response texts keyed by make_key.
+    Safe to share between threads and processes.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, mode="readwrite", max_bytes=2 * 1024 ** 3, max_age=None, evict_every=100):
+
+        """
+        Args:
+            path (str): SQLite file holding the cache.
+            mode (str): "readwrite", "readonly" (serve hits, never store), "refresh" (never serve hits, store the new responses)
+                or "bypass" (ignore the cache).
+            max_bytes (int): Evict least recently used entries once the stored texts exceed this size.
+            max_age (float): Entries older than this many seconds are treated as misses and evicted. None keeps them forever.
+            evict_every (int): Run eviction after this many writes.
+        """
+
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode: {mode}")
+
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self._writes = 0
+
+        if mode == "bypass":
+            return
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    @property
+    def readable(self):
+        return self.mode in ("readwrite", "readonly")
+
+    @property
+    def writable(self):
+        return self.mode in ("readwrite", "refresh")
+
+    def get(self, key):
+
+        """
+        Returns:
+            CachedResponse: The cached response, or None on a miss.
+        """
+
+        if not self.readable:
+            return None
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT text, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            text, created = row
+            if self.max_age is not None and now - created > self.max_age:
+                return None
+
+            if self.writable:
+                with conn:
+                    conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        finally:
+            conn.close()
+
+        return CachedResponse(text)
+
+    def put(self, key, text):
+        if not self.writable:
+            return
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO responses (key, text, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                             (key, text, len(text.encode("utf-8")), now, now))
+        finally:
+            conn.close()
+
+        self._writes += 1
+        if self._writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+
+        """
+        Drop entries past max_age, then least recently used entries until the cache fits in max_bytes.
+        """
+
+        if not self.writable:
+            return
+
+        conn = self._connect()
+        try:
+            with conn:
+                if self.max_age is not None:
+                    conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+
+                if self.max_bytes is not None:
+                    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                    excess = total - self.max_bytes
+                    if excess > 0:
+                        keys = []
+                        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                            keys.append((key,))
+                            excess -= size
+                            if excess <= 0:
+                                break
+                        conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        finally:
+            conn.close()
+
+
+class SingleFlight:
+
+    """
+    Merge concurrent calls for the same key into one. The first caller runs
+    the call, everyone else waiting on that key gets its result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"event": threading.Event(), "result": None}
+
+        if not leader:
+            call["event"].wait()
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["event"].set()
+
+        return call["result"]
+
+    async def do_async(self, key, fn):
+        future = self._async_calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+            future.set_result(result)
+        except BaseException:
+            future.set_result(None)
+            raise
+        finally:
+            del self._async_calls[key]
+
+        return result
@@ -1,117 +1,1146 @@
 import os
+import re
+import sys
 import json
 import time
-from ratelimit import limits, sleep_and_retry
+import asyncio
+import argparse
+from queue import Queue
+from functools import partial
+from itertools import islice, count
+from contextlib import contextmanager, nullcontext
+from threading import Thread, Lock
+from concurrent.futures import Future, wait, FIRST_COMPLETED
 import google.generativeai as genai
 
 from abc import ABC, abstractmethod
 
+from models.rate_limiter import backoff_delay
+from models.pool import ClientPool, split_list
+from models.backends import BACKENDS, OPENAI_BASE_URL
+from models.cache import ResponseCache, SingleFlight, make_key, CACHE_MODES, DEFAULT_CACHE_PATH
+from models.packing import pack_prompt, parse_packed
+from models.metrics import METRICS, LatencyWindow, Reporter
+from models.scheduler import FileTask
+from utils.checkpoint import Checkpoint
+from utils.deadletter import DeadLetters
+from utils.jobs import JobTable, work_shards
+from utils.jsonl import loads
+from utils.writer import OUTPUT_FORMATS, open_writer
+
+def _spawn(function, *args):
+
+    """
+    Run function in a new daemon thread.
+
+    Returns:
+        Future: Its result or exception.
+    """
+
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    Thread(target=run, daemon=True).start()
+    return future
+
+def add_arguments(parser, packable=False):
+
+    """
+    Add the command line options shared by every generation stage.
+
+    Args:
+        parser (argparse.ArgumentParser): Parser of the stage script.
+        packable (bool): Whether the stage can pack rows, i.e. its class's packable. Otherwise --batch-size above 1 is rejected.
+    """
+
+    def batch_size(value):
+        value = int(value)
+        if value > 1 and not packable:
+            raise argparse.ArgumentTypeError("this stage can't pack several rows into one request")
+        return value
+
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread", help="Execution engine for API calls")
+    parser.add_argument("--max-threads", type=int, default=10, help="Number of worker threads in thread mode")
+    parser.add_argument("--max-concurrency", type=int, default=100, help="Maximum number of in-flight requests in async mode")
+    add_client_arguments(parser)
+    parser.add_argument("--batch-size", type=batch_size, default=1, help="Rows packed into one request, for stages that support packing")
+    parser.add_argument("--resume", action="store_true", help="Keep existing outputs and only process rows missing from their .done index")
+    parser.add_argument("--retry-dead", action="store_true", help="Only send the rows in the outputs' .dead files again, one row per request")
+    parser.add_argument("--ordered", action="store_true", help="Write output rows in input order")
+    parser.add_argument("--atomic", action="store_true", help="Write to <output>.tmp and rename it into place when the file is done")
+    parser.add_argument("--flush-interval", type=float, default=1.0, help="Seconds between output flushes")
+    parser.add_argument("--fsync", action="store_true", help="fsync the output on every flush")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="jsonl", help="jsonl files, or folders of compressed Parquet shards with raw responses in a side table")
+    parser.add_argument("--shard-rows", type=int, default=100000, help="Rows per Parquet shard")
+    parser.add_argument("--job-db", default=None, help="SQLite job table shared by workers on several processes or hosts, which lease row range shards from it")
+    parser.add_argument("--job-rows", type=int, default=10000, help="Input rows per job table shard")
+    parser.add_argument("--lease-seconds", type=float, default=300, help="Seconds a shard lease lasts without a heartbeat before another worker can take the shard over")
+    parser.add_argument("--priority", nargs="+", default=[], metavar="FILE=N", help="Priority of input files, higher first, e.g. news.jsonl=2. Other files have 0")
+
+def add_client_arguments(parser):
+
+    """
+    Add the options of the API clients and metrics, for scripts like the pipeline that don't
+    take the file, output and worker options of add_arguments.
+
+    Args:
+        parser (argparse.ArgumentParser): Parser of the script.
+    """
+
+    parser.add_argument("--backend", choices=BACKENDS, default="gemini", help="gemini, a local simulated server for load tests, or an OpenAI compatible server")
+    parser.add_argument("--base-url", default=None, help="Base URL of the OpenAI compatible server")
+    parser.add_argument("--sim-latency", type=float, default=1.0, help="Median latency of the simulated backend in seconds")
+    parser.add_argument("--sim-429-rate", type=float, default=0.0, help="Fraction of simulated requests failing with 429")
+    parser.add_argument("--sim-500-rate", type=float, default=0.0, help="Fraction of simulated requests failing with 500")
+    parser.add_argument("--model-name", default="gemini-pro", help="Model name, or a comma separated list of models to spread requests over")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests/min quota per API key, defaults to the model's entry in MODEL_LIMITS")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens/min quota per API key, defaults to the model's entry in MODEL_LIMITS")
+    parser.add_argument("--request-timeout", type=float, default=600, help="Seconds before a request is abandoned and retried, 0 for no deadline")
+    parser.add_argument("--hedge-percentile", type=float, default=None, help="Send a duplicate of a request still running after this percentile of recent latencies, e.g. 95. Off by default")
+    parser.add_argument("--hedge-budget", type=float, default=0.05, help="Maximum duplicate requests as a fraction of all requests")
+    parser.add_argument("--prefix-cache", action="store_true", help="Send the stage's fixed instruction once as a cached system instruction instead of in every prompt")
+    parser.add_argument("--cache-mode", choices=CACHE_MODES, default="readwrite", help="Response cache mode")
+    parser.add_argument("--cache-path", default=DEFAULT_CACHE_PATH, help="SQLite file of the response cache")
+    parser.add_argument("--metrics-path", default=None, help="Export metrics to this file, a JSON snapshot if it ends with .json, a Prometheus textfile otherwise")
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="Seconds between progress lines and metrics exports")
+
+def main_kwargs(args):
+
+    """
+    Turn the options added by add_arguments into keyword arguments for a stage main().
+    """
+
+    return {
+        **client_kwargs(args),
+        "mode": args.mode,
+        "max_threads": args.max_threads,
+        "max_concurrency": args.max_concurrency,
+        # A retry would get the same cached response that was dropped; store the new one instead
+        "cache_mode": "refresh" if args.retry_dead and args.cache_mode == "readwrite" else args.cache_mode,
+        "batch_size": args.batch_size,
+        "resume": args.resume,
+        "retry_dead": args.retry_dead,
+        "writer_kwargs": {"ordered": args.ordered, "atomic": args.atomic, "flush_interval": args.flush_interval, "fsync": args.fsync,
+                          "output_format": args.output_format, "shard_rows": args.shard_rows},
+        "job_db": args.job_db,
+        "job_rows": args.job_rows,
+        "lease_seconds": args.lease_seconds,
+        "priority": {name: int(value) for name, value in (item.rsplit("=", 1) for item in args.priority)},
+    }
+
+def client_kwargs(args):
+
+    """
+    Turn the options added by add_client_arguments into keyword arguments.
+    """
+
+    backend_kwargs = {}
+    if args.backend == "openai" and args.base_url:
+        backend_kwargs = {"base_url": args.base_url}
+    elif args.backend == "simulated":
+        backend_kwargs = {"latency": args.sim_latency, "rate_429": args.sim_429_rate, "rate_500": args.sim_500_rate}
+
+    return {
+        "backend": args.backend,
+        "backend_kwargs": backend_kwargs,
+        "model_name": args.model_name,
+        "rpm": args.rpm,
+        "tpm": args.tpm,
+        "request_timeout": args.request_timeout or None,
+        "hedge_percentile": args.hedge_percentile,
+        "hedge_budget": args.hedge_budget,
+        "prefix_cache": args.prefix_cache,
+        "cache_mode": args.cache_mode,
+        "cache_path": args.cache_path,
+        "metrics_path": args.metrics_path,
+        "metrics_interval": args.metrics_interval,
+    }
+
 class Gemini(ABC):
-    RATE_LIMIT = 45
-    PERIOD = 60
 
-    def __init__(self, api_key=None, model_name="gemini-pro"):
+    # Stages that can pack several rows into one request set this, along with PACK_FIELDS, pack_text and apply_packed
+    packable = False
+
+    def __init__(self, api_key=None, model_name="gemini-pro", rpm=None, tpm=None, max_retries=5, cache_path=DEFAULT_CACHE_PATH, cache_mode="readwrite", key_weights=None, backend="gemini", backend_kwargs=None, request_timeout=600, hedge_percentile=None, hedge_budget=0.05, prefix_cache=False):
+
+        if not api_key:
+            if backend == "gemini":
+                raise Exception("No API key found. Please provide an API key or set the GEMINI_API_KEY environment variable.")
+            # Local backends don't check keys, but every pool client needs one
+            api_key = backend
 
-        if api_key is None:
-            raise Exception("No API key found. Please provide an API key or set the GEMINI_API_KEY environment variable.")
+        # Several keys and models can be given as lists or comma separated strings.
+        # Every key/model pair gets its own client and rate limiter.
+        if backend == "simulated":
+            backend_kwargs = {"responses": self.simulated_response, **(backend_kwargs or {})}
 
-        # Configure generative AI
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model_name)
+        self.pool = ClientPool(api_key, model_name, weights=key_weights, rpm=rpm, tpm=tpm, backend=backend, backend_kwargs=backend_kwargs)
+
+        # Part of the cache key, so responses of one backend are never served for another
+        self.cache_backend = None
+        if backend == "simulated":
+            self.cache_backend = backend
+        elif backend == "openai":
+            self.cache_backend = f"openai:{(backend_kwargs or {}).get('base_url', OPENAI_BASE_URL)}"
+        self.model_name = ",".join(sorted(set(split_list(model_name))))
         self.generation_config = genai.types.GenerationConfig(max_output_tokens=3000, temperature=0.0)
         self.safety_settings = {'HARASSMENT':'block_none', 'HATE_SPEECH': 'block_none', 'DANGEROUS': 'block_none', 'SEXUAL': 'block_none'}
         self.equal_rows = True
 
+        # Output fields of one row when several rows are packed into one request, None if the stage can't pack
+        self.PACK_FIELDS = None
+        self.max_retries = max_retries
+
+        # Deadline of a single request. Hedging sends a duplicate of a request slower than
+        # hedge_percentile of the recent latencies, for at most hedge_budget of the requests.
+        self.request_timeout = request_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.latencies = LatencyWindow()
+        self._requests = 0
+        self._hedges = 0
+        self._hedge_lock = Lock()
+
+        # Send INPUT_PROMPT once per client as a cached system instruction instead of ahead of every prompt
+        self.prefix_cache = prefix_cache
+
+        # Label of the stage in metrics, "seed" for GeminiSeed
+        self.stage = type(self).__name__.replace("Gemini", "").lower() or "gemini"
+
+        # Outputs are deterministic at temperature 0, so identical requests can be served from disk
+        self.cache = ResponseCache(cache_path, mode=cache_mode)
+        self._inflight = SingleFlight()
+
     @abstractmethod
-    def process_input(self):
+    def build_prompt(self, row):
         pass
 
+    def simulated_response(self, prompt):
+
+        """
+        Canned response of the simulated backend, shaped like a real answer to the prompt.
+        Packed prompts get a JSON array with every item filled from simulated_fields.
+        """
+
+        items = re.findall(r"^\[(\d+)\] (.*)$", prompt, re.M)
+        if items and self.PACK_FIELDS:
+            return json.dumps([{"id": int(item_id), **self.simulated_fields(text)} for item_id, text in items], ensure_ascii=False)
+
+        return self.simulated_text(prompt)
+
+    def simulated_text(self, prompt):
+        return "simulated response"
+
+    def simulated_fields(self, text):
+        return {field: "simulated response" for field in self.PACK_FIELDS}
+
+    @property
+    def prompt_prefix(self):
+
+        """
+        Fixed instruction the backend sends as a cached system instruction, or None when prompts are sent whole.
+        """
+
+        if self.prefix_cache and self.INPUT_PROMPT.strip():
+            return self.INPUT_PROMPT
+        return None
+
+    def make_item(self, batch, seq, packed=None):
+
+        """
+        Build the data item for a batch of (row_id, row) pairs.
+
+        Args:
+            batch (list): (row_id, row) pairs.
+            seq (int): Position of the item in the input.
+            packed (bool): Send all rows in one numbered prompt. Defaults to packing batches of more than one row.
+
+        Returns:
+            dict: Input prompts, original rows, row IDs and position of the batch.
+        """
+
+        row_ids = [row_id for row_id, _ in batch]
+        original_rows = [row for _, row in batch]
+
+        if packed is None:
+            packed = len(batch) > 1
+
+        # With a cached prefix only the payload is sent; stages build whole prompts, so their INPUT_PROMPT head is cut off here
+        prefix = self.prompt_prefix
+        if packed:
+            input_prompts = [pack_prompt("" if prefix else self.INPUT_PROMPT, [self.pack_text(row) for row in original_rows], self.PACK_FIELDS)]
+        else:
+            input_prompts = [self.build_prompt(row) for row in original_rows]
+            if prefix:
+                input_prompts = [prompt.removeprefix(prefix) for prompt in input_prompts]
+
+        return {"input_prompt": input_prompts, "original_rows": original_rows, "row_ids": row_ids, "seq": seq, "packed": packed}
+
+    def process_input(self, data, batch_size=1):
+
+        """
+        Lazily turn input rows into data items for the workers.
+        Rows are only read as the workers take items, so memory stays flat however large the input is.
+
+        Args:
+            data (iterable): (row_id, row) pairs. Row IDs are used for checkpointing.
+            batch_size (int): Rows per request. Above 1 the rows are packed into one numbered prompt.
+
+        Yields:
+            dict: Input prompts, original rows, row IDs and position of one batch.
+        """
+
+        if batch_size > 1 and not self.packable:
+            raise ValueError(f"{type(self).__name__} does not support batch_size > 1")
+
+        data = iter(data)
+
+        for seq in count():
+            batch = list(islice(data, batch_size))
+            if not batch:
+                return
+
+            yield self.make_item(batch, seq, packed=batch_size > 1)
+
     @abstractmethod
     def postprocess_response(self):
         pass
 
-    @sleep_and_retry
-    @limits(calls=RATE_LIMIT, period=PERIOD)
-    def call_api(self, data_item, retry_count=0, max_retries=3):
+    def estimate_tokens(self, data_item):
+
+        """
+        Rough input token count used to reserve tokens/min before a call.
+        Corrected from usage_metadata once the response arrives.
+        """
+
+        if isinstance(data_item, str):
+            data_item = [data_item]
+
+        return sum(len(text) for text in data_item) // 3 + 1
+
+    def _record_usage(self, client, response, reserved_tokens):
+        usage = getattr(response, "usage_metadata", None)
+        total_tokens = getattr(usage, "total_token_count", 0) if usage else 0
+        cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0 if usage else 0
+
+        if usage:
+            prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+            METRICS.inc("tokens_total", cached_tokens, stage=self.stage, kind="prefix")
+            METRICS.inc("tokens_total", prompt_tokens - cached_tokens, stage=self.stage, kind="payload")
+            METRICS.inc("tokens_total", getattr(usage, "candidates_token_count", 0) or 0, stage=self.stage, kind="candidates")
+
+        # Prefix tokens served from the provider's cache don't count against tokens/min
+        if total_tokens:
+            client.rate_limiter.adjust_tokens(total_tokens - cached_tokens - reserved_tokens)
+
+    @staticmethod
+    def _status(e):
+
+        """
+        Outcome label of a failed request: "429", "500", "timeout" or "error".
+        """
+
+        if "429" in str(e):
+            return "429"
+        if "504" in str(e) or isinstance(e, TimeoutError):
+            return "timeout"
+        if "500" in str(e):
+            return "500"
+        return "error"
+
+    def _on_api_error(self, client, e, attempt, latency):
+
+        """
+        Report a failed API call to the client pool and the metrics.
+        """
+
+        self.pool.release(client, e)
+
+        status = self._status(e)
+        METRICS.request(self.stage, status, latency)
+
+        if status == "429":
+            print(f"429 error: Rate limit exceeded on {client.name}. Attempt {attempt + 1} of {self.max_retries}")
+        elif status == "500":
+            print(f"500 error: Internal server error on {client.name}. Attempt {attempt + 1} of {self.max_retries}")
+        elif status == "timeout":
+            print(f"Request to {client.name} ran past its {self.request_timeout}s deadline. Attempt {attempt + 1} of {self.max_retries}")
+        else:
+            print(f"API call failed: {e}, retrying... Attempt {attempt + 1} of {self.max_retries}")
+
+    def _on_api_success(self, client, response, tokens, latency):
+        METRICS.request(self.stage, "ok", latency)
+        self.latencies.observe(latency)
+        self.pool.release(client)
+        self._record_usage(client, response, tokens)
+
+    def hedge_threshold(self):
+
+        """
+        Returns:
+            float: Seconds after which a request gets a duplicate, the hedge_percentile of recent latencies.
+            None if hedging is off or too few requests have finished yet.
+        """
+
+        if not self.hedge_percentile:
+            return None
+
+        threshold = self.latencies.percentile(self.hedge_percentile)
+        if threshold is not None:
+            METRICS.set("hedge_threshold_seconds", threshold, stage=self.stage)
+        return threshold
+
+    def _hedge_client(self, tokens):
+
+        """
+        Client for a duplicate request, if the hedge budget and the rate limits allow one right now.
+        A hedge never waits for quota, so hedging can't slow down requests that aren't hedged.
+
+        Returns:
+            PoolClient: The client, or None to not hedge.
+        """
+
+        with self._hedge_lock:
+            if self._hedges >= self.hedge_budget * self._requests:
+                return None
+
+        client = self.pool.try_acquire(tokens)
+        if client is None:
+            return None
+
+        with self._hedge_lock:
+            self._hedges += 1
+        return client
+
+    async def _hedge_client_async(self, tokens):
+
+        """
+        Async counterpart of _hedge_client.
+        """
+
+        with self._hedge_lock:
+            if self._hedges >= self.hedge_budget * self._requests:
+                return None
+
+        client = await self.pool.try_acquire_async(tokens)
+        if client is None:
+            return None
+
+        with self._hedge_lock:
+            self._hedges += 1
+        return client
+
+    def _hedged(self, request):
+
+        """
+        Count a hedged request by whether the duplicate answered first.
+        """
+
+        METRICS.inc("hedged_requests_total", stage=self.stage, result="won" if request == "hedge" else "lost")
+
+    def cache_key(self, data_item):
+        return make_key(data_item, self.model_name, self.generation_config, self.safety_settings, self.prompt_prefix, self.cache_backend)
+
+    def _store(self, key, response):
+        if response is None:
+            return
+
+        try:
+            self.cache.put(key, response.text)
+        except Exception:
+            # No text response given probably due to safety features. Not worth caching.
+            pass
+
+    def call_api(self, data_item):
+
+        """
+        Call the generative AI API, serving repeated requests from the cache.
+        Identical requests in flight at the same time share one API call.
+
+        Args:
+            data_item (str): The input prompt for the API.
+
+        Returns:
+            str: The API response.
+        """
+
+        if not self.cache.readable and not self.cache.writable:
+            return self._call_api(data_item)
+
+        key = self.cache_key(data_item)
+        cached = self.cache.get(key)
+        if cached is not None:
+            METRICS.inc("cache_hits_total", stage=self.stage)
+            return cached
+
+        def call():
+            response = self._call_api(data_item)
+            self._store(key, response)
+            return response
+
+        return self._inflight.do(key, call)
+
+    async def call_api_async(self, data_item):
+
+        """
+        Async counterpart of call_api.
+
+        Args:
+            data_item (str): The input prompt for the API.
+
+        Returns:
+            str: The API response.
+        """
+
+        if not self.cache.readable and not self.cache.writable:
+            return await self._call_api_async(data_item)
+
+        # SQLite calls run in worker threads, so a busy cache or rate limit database doesn't stall every request in flight
+        key = self.cache_key(data_item)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            METRICS.inc("cache_hits_total", stage=self.stage)
+            return cached
+
+        async def call():
+            response = await self._call_api_async(data_item)
+            await asyncio.to_thread(self._store, key, response)
+            return response
+
+        return await self._inflight.do_async(key, call)
+
+    def _attempt(self, client, data_item, tokens, attempt):
+
+        """
+        Send one request with a client that has been acquired for it, and hand the client back.
+
+        Returns:
+            The API response. Errors are raised once they are reported.
+        """
+
+        start = time.monotonic()
+        try:
+            response = client.backend.generate(data_item, self.generation_config, self.safety_settings, timeout=self.request_timeout,
+                                              prefix=self.prompt_prefix)
+        except Exception as e:
+            self._on_api_error(client, e, attempt, time.monotonic() - start)
+            raise
+
+        self._on_api_success(client, response, tokens, time.monotonic() - start)
+        return response
+
+    async def _attempt_async(self, client, data_item, tokens, attempt):
+
+        """
+        Async counterpart of _attempt. A request cancelled because its duplicate answered first hands its client back untouched.
+        """
+
+        start = time.monotonic()
+        try:
+            response = await client.backend.generate_async(data_item, self.generation_config, self.safety_settings, timeout=self.request_timeout,
+                                                          prefix=self.prompt_prefix)
+        except asyncio.CancelledError:
+            self.pool.cancel(client)
+            raise
+        except Exception as e:
+            await asyncio.to_thread(self._on_api_error, client, e, attempt, time.monotonic() - start)
+            raise
+
+        await asyncio.to_thread(self._on_api_success, client, response, tokens, time.monotonic() - start)
+        return response
+
+    def _send(self, data_item, tokens, attempt):
+
+        """
+        Send a request. With hedging on, a request still running after the hedge threshold
+        gets a duplicate on another client, and whichever answers first is used. The slower
+        one can't be cancelled from a thread; it runs to its deadline in the background.
+
+        Returns:
+            The API response.
+        """
+
+        client = self.pool.acquire(tokens)
+        with self._hedge_lock:
+            self._requests += 1
+
+        threshold = self.hedge_threshold()
+        if threshold is None:
+            return self._attempt(client, data_item, tokens, attempt)
+
+        primary = _spawn(self._attempt, client, data_item, tokens, attempt)
+        if wait([primary], timeout=threshold).done:
+            return primary.result()
+
+        hedge_client = self._hedge_client(tokens)
+        if hedge_client is None:
+            return primary.result()
+
+        requests = {primary: "primary", _spawn(self._attempt, hedge_client, data_item, tokens, attempt): "hedge"}
+        pending, error = set(requests), None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._hedged(requests[future])
+                    return future.result()
+                error = error or future.exception()
+
+        raise error
+
+    async def _send_async(self, data_item, tokens, attempt):
+
+        """
+        Async counterpart of _send. The slower of two hedged requests is cancelled.
+        """
+
+        client = await self.pool.acquire_async(tokens)
+        with self._hedge_lock:
+            self._requests += 1
+
+        threshold = self.hedge_threshold()
+        if threshold is None:
+            return await self._attempt_async(client, data_item, tokens, attempt)
+
+        primary = asyncio.ensure_future(self._attempt_async(client, data_item, tokens, attempt))
+        done, _ = await asyncio.wait([primary], timeout=threshold)
+        if done:
+            return primary.result()
+
+        hedge_client = await self._hedge_client_async(tokens)
+        if hedge_client is None:
+            return await primary
+
+        requests = {primary: "primary", asyncio.ensure_future(self._attempt_async(hedge_client, data_item, tokens, attempt)): "hedge"}
+        pending, error = set(requests), None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._hedged(requests[task])
+                        return task.result()
+                    error = error or task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise error
+
+    def _call_api(self, data_item):
 
         """
         Call the generative AI API with rate limiting and retry logic.
+        A request running past request_timeout is abandoned and retried.
 
         Args:
             data_item (str): The input prompt for the API.
-            retry_count (int): The current retry count.
-            max_retries (int): The maximum number of retries.
 
         Returns:
             str: The API response.
         """
 
-        if retry_count < max_retries:
+        tokens = self.estimate_tokens(data_item)
+
+        for attempt in range(self.max_retries):
             try:
-                response = self.model.generate_content(data_item, generation_config=self.generation_config, safety_settings=self.safety_settings)
-                return response
-            except Exception as e:
+                return self._send(data_item, tokens, attempt)
+            except Exception:
+                if attempt + 1 < self.max_retries:
+                    METRICS.inc("retries_total", stage=self.stage)
+                    time.sleep(backoff_delay(attempt))
 
-                retry_count += 1
+        print("Maximum retries reached. Moving on to the next item.")
+        return None
 
-                if "429" in str(e): 
-                    print("429 error: Rate limit exceeded. Sleeping for 80 seconds.")
-                    time.sleep(80)
-                    return self.call_api(data_item, retry_count, max_retries)  # Retry the same request after sleeping  
+    async def _call_api_async(self, data_item):
 
-                if "500" in str(e):
-                    print("500 error: Internal server error. Sleeping for 80 seconds.")
-                    time.sleep(80)
-                    return self.call_api(data_item, retry_count, max_retries)  # Retry the same request after sleeping
-                
-                print(f"API call failed: {e}, retrying... Attempt {retry_count} of {max_retries}")
-                return self.call_api(data_item, retry_count, max_retries)        
-        else:
-            print("Maximum retries reached. Moving on to the next item.")
+        """
+        Call the generative AI API without blocking the event loop.
+
+        Args:
+            data_item (str): The input prompt for the API.
+
+        Returns:
+            str: The API response.
+        """
+
+        tokens = self.estimate_tokens(data_item)
+
+        for attempt in range(self.max_retries):
+            try:
+                return await self._send_async(data_item, tokens, attempt)
+            except Exception:
+                if attempt + 1 < self.max_retries:
+                    METRICS.inc("retries_total", stage=self.stage)
+                    await asyncio.sleep(backoff_delay(attempt))
+
+        print("Maximum retries reached. Moving on to the next item.")
+        return None
+
+    def drop(self, data_item, reason, detail=None):
+
+        """
+        Give up on the rows of a data item. They are counted as skipped and kept on the item
+        for the writer to put in the dead-letter file, so a retry pass can send them again.
+
+        Args:
+            data_item (dict): The data item.
+            reason (str): "api_failed" (no response after every retry), "blocked" (a response without text,
+                e.g. a safety block), "row_mismatch" (wrong number of output rows) or "error" (an exception).
+            detail (str): What went wrong, for the dead-letter file.
+        """
+
+        METRICS.inc("rows_skipped_total", len(data_item["row_ids"]), stage=self.stage, reason=reason)
+        data_item.setdefault("dropped", []).extend((row_id, row, reason, detail) for row_id, row in zip(data_item["row_ids"], data_item["original_rows"]))
+
+    def handle_response(self, response, data_item):
+
+        """
+        Turn an API response into output rows.
+
+        Args:
+            response: The API response, or None if the call failed.
+            data_item (dict): The data item the response answers.
+
+        Returns:
+            list: Processed rows, or None if the item was dropped.
+        """
+
+        original_rows = data_item["original_rows"]
+
+        if response is None:
+            self.drop(data_item, "api_failed")
+            return None
+
+        try:
+            output_text = response.text
+        except Exception as e:
+            # No text response given probably due to safety features.
+            self.drop(data_item, "blocked", str(e))
+            return None
+
+        # Split the output text into individual rows
+        output_rows = output_text.split("\n")
+
+        if len(output_rows) != len(original_rows) and self.equal_rows:
+            print(f"Number of output rows ({len(output_rows)}) does not match number of input rows ({len(original_rows)}). Skipping...")
+            self.drop(data_item, "row_mismatch", f"{len(output_rows)} output rows for {len(original_rows)} input rows")
             return None
-        
-    def worker(self, file_handle, data_queue):
+
+        # Postprocess the response
+        return self.postprocess_response(output_rows, original_rows, output_text)
+
+    def handle_packed_response(self, response, data_item):
 
         """
-        Worker function for processing data items from the queue.
+        Split a packed response into finished rows and the rows that still need an answer.
 
         Args:
-            file_handle (file): File handle for writing output.
-            data_queue (Queue): Queue containing data items.
+            response: The API response, or None if the call failed.
+            data_item (dict): The packed data item.
+
+        Returns:
+            tuple: (processed rows, their row IDs, (row_id, row) pairs that were missing or malformed).
         """
 
-        while not data_queue.empty():
-            data_item = data_queue.get()
+        batch = list(zip(data_item["row_ids"], data_item["original_rows"]))
 
-            input_prompt = data_item["input_prompt"]
-            original_rows = data_item["original_rows"]
+        if response is None:
+            return [], [], batch
 
-            response = self.call_api(input_prompt)
+        try:
+            output_text = response.text
+        except:
+            # No text response given probably due to safety features.
+            return [], [], batch
 
-            if response is None:
-                data_queue.task_done()
+        items = parse_packed(output_text, len(batch), self.PACK_FIELDS)
+
+        processed_rows, done_ids, missing = [], [], []
+        for idx, (row_id, row) in enumerate(batch, start=1):
+            if idx not in items:
+                missing.append((row_id, row))
                 continue
 
             try:
-                output_text = response.text
-            except:
-                # No text response given probably due to safety features.
+                processed_rows.append(self.apply_packed(row, items[idx], output_text))
+                done_ids.append(row_id)
+            except Exception as e:
+                print(f"Error parsing packed item {idx}: {e}")
+                missing.append((row_id, row))
+
+        if missing:
+            print(f"{len(missing)} of {len(batch)} packed rows missing or malformed. Retrying them one by one...")
+
+        return processed_rows, done_ids, missing
+
+    def process_item(self, data_item):
+
+        """
+        Call the API for one data item and turn the response into output rows.
+        Rows a packed response left out are retried as single-row requests.
+
+        Returns:
+            tuple: (processed rows, their row IDs). Rows is None if the whole item has to be skipped.
+        """
+
+        response = self.call_api(data_item["input_prompt"])
+
+        if not data_item["packed"]:
+            processed_rows = self.handle_response(response, data_item)
+            return processed_rows, data_item["row_ids"] if processed_rows is not None else []
+
+        processed_rows, done_ids, missing = self.handle_packed_response(response, data_item)
+        for pair in missing:
+            retry = self.make_item([pair], data_item["seq"], packed=False)
+            rows, row_ids = self.process_item(retry)
+            processed_rows += rows or []
+            done_ids += row_ids
+            data_item.setdefault("dropped", []).extend(retry.get("dropped", []))
+
+        return self._input_order(data_item, processed_rows, done_ids)
+
+    async def process_item_async(self, data_item):
+
+        """
+        Async counterpart of process_item.
+        """
+
+        response = await self.call_api_async(data_item["input_prompt"])
+
+        if not data_item["packed"]:
+            processed_rows = self.handle_response(response, data_item)
+            return processed_rows, data_item["row_ids"] if processed_rows is not None else []
+
+        processed_rows, done_ids, missing = self.handle_packed_response(response, data_item)
+        retries = [self.make_item([pair], data_item["seq"], packed=False) for pair in missing]
+        for retry, (rows, row_ids) in zip(retries, await asyncio.gather(*map(self.process_item_async, retries))):
+            processed_rows += rows or []
+            done_ids += row_ids
+            data_item.setdefault("dropped", []).extend(retry.get("dropped", []))
+
+        return self._input_order(data_item, processed_rows, done_ids)
+
+    @staticmethod
+    def _input_order(data_item, processed_rows, done_ids):
+
+        """
+        Put rows answered by a retry back in their position within the packed item.
+        """
+
+        position = {row_id: idx for idx, row_id in enumerate(data_item["row_ids"])}
+        pairs = sorted(zip(done_ids, processed_rows), key=lambda pair: position[pair[0]])
+
+        return [row for _, row in pairs], [row_id for row_id, _ in pairs]
+
+    def worker(self, data_queue):
+
+        """
+        Worker function for processing data items from the queue until it takes a None sentinel.
+        Every item carries the task of its file, whose writer the finished item is handed to.
+
+        Args:
+            data_queue (Queue): Queue containing data items.
+        """
+
+        while True:
+            data_item = data_queue.get()
+            METRICS.set("queue_depth", data_queue.qsize(), stage=self.stage)
+            if data_item is None:
                 data_queue.task_done()
-                continue
+                break
+
+            task = data_item["task"]
+            processed_rows, done_ids = None, []
+            # Items of a shard whose lease was lost are another worker's now; they are only counted off
+            if not task.writer.cancelled:
+                try:
+                    processed_rows, done_ids = self.process_item(data_item)
+                except Exception as e:
+                    print(f"Error processing item: {e}")
+                    data_item["dropped"] = []
+                    self.drop(data_item, "error", str(e))
+
+            try:
+                task.writer.put(data_item["seq"], processed_rows, done_ids, data_item.get("dropped"))
+            except Exception:
+                # The writer failed and stopped; closing the task raises its error
+                done_ids = []
+
+            METRICS.inc("rows_done_total", len(done_ids), stage=self.stage)
 
-            # Split the output text into individual rows
-            output_rows = output_text.split("\n")
+            if task.item_done():
+                task.close()
 
-            if len(output_rows) != len(original_rows) and self.equal_rows:
-                print(f"Number of output rows ({len(output_rows)}) does not match number of input rows ({len(original_rows)}). Skipping...")
+            data_queue.task_done()
+
+    async def worker_async(self, data_queue):
+
+        """
+        Async worker function for processing data items from the queue until it takes a None sentinel.
+        Many of these run as tasks on one event loop, so an in-flight request
+        costs a coroutine instead of an OS thread.
+
+        Args:
+            data_queue (asyncio.Queue): Queue containing data items.
+        """
+
+        while True:
+            data_item = await data_queue.get()
+            METRICS.set("queue_depth", data_queue.qsize(), stage=self.stage)
+            if data_item is None:
                 data_queue.task_done()
-                continue
+                break
+
+            task = data_item["task"]
+            processed_rows, done_ids = None, []
+            # Items of a shard whose lease was lost are another worker's now; they are only counted off
+            if not task.writer.cancelled:
+                try:
+                    processed_rows, done_ids = await self.process_item_async(data_item)
+                except Exception as e:
+                    print(f"Error processing item: {e}")
+                    data_item["dropped"] = []
+                    self.drop(data_item, "error", str(e))
+
+            try:
+                task.writer.put(data_item["seq"], processed_rows, done_ids, data_item.get("dropped"))
+            except Exception:
+                # The writer failed and stopped; closing the task raises its error
+                done_ids = []
+
+            METRICS.inc("rows_done_total", len(done_ids), stage=self.stage)
+
+            # Closing flushes the writer and may touch SQLite, which must not block the event loop
+            if task.item_done():
+                await asyncio.get_running_loop().run_in_executor(None, task.close)
+
+            data_queue.task_done()
+
+    @staticmethod
+    def feed(tasks, data_queue, workers, errors):
+
+        """
+        Producer: open the tasks one after the other and put their data items on the
+        bounded queue, blocking while it is full, then one None sentinel per worker.
+        An error stops the feeding; it is added to errors for run_tasks to raise.
+        """
+
+        task = None
+        try:
+            for task in tasks:
+                for data_item in task.open():
+                    data_item["task"] = task
+                    task.add()
+                    data_queue.put(data_item)
+
+                if task.fed():
+                    task.close()
+                task = None
+        except Exception as e:
+            errors.append(e)
+            if task is not None:
+                task.fail()
+        finally:
+            for _ in range(workers):
+                data_queue.put(None)
+
+    @staticmethod
+    async def feed_async(tasks, data_queue, workers, errors):
+
+        """
+        Async counterpart of feed. Taking the next task, opening it and closing it run in a thread:
+        they lease job table shards, count lines and load checkpoints and earlier output, which
+        would stall every in-flight request. Building the items happens on the event loop.
+        """
+
+        tasks = iter(tasks)
+        task = None
+        try:
+            while True:
+                task = await asyncio.to_thread(next, tasks, None)
+                if task is None:
+                    break
+
+                data_items = await asyncio.to_thread(task.open)
+                for data_item in data_items:
+                    data_item["task"] = task
+                    task.add()
+                    await data_queue.put(data_item)
+
+                if task.fed():
+                    await asyncio.to_thread(task.close)
+                task = None
+        except Exception as e:
+            errors.append(e)
+            if task is not None:
+                await asyncio.to_thread(task.fail, sys.exc_info())
+        finally:
+            for _ in range(workers):
+                await data_queue.put(None)
+
+    async def _run_async(self, tasks, max_concurrency, queue_size, errors):
+        data_queue = asyncio.Queue(maxsize=queue_size or 2 * max_concurrency)
+
+        workers = [self.worker_async(data_queue) for _ in range(max_concurrency)]
+        await asyncio.gather(self.feed_async(tasks, data_queue, max_concurrency, errors), *workers)
+
+    def run_tasks(self, tasks, mode="thread", max_threads=10, max_concurrency=100, queue_size=None):
+
+        """
+        Process the data items of many files with one set of workers fed from one queue.
+        The next file's items are queued while the last requests of the previous one are
+        still in flight, so the quota stays used across file boundaries, and every
+        finished item goes to the writer of its own file.
+
+        Args:
+            tasks (iterable): FileTask per input file, in the order they are fed.
+            mode (str): "thread" to run a pool of worker threads, "async" to run worker tasks on an event loop.
+            max_threads (int): Number of worker threads in thread mode.
+            max_concurrency (int): Maximum number of in-flight requests in async mode.
+            queue_size (int): Maximum number of items waiting for a worker. Defaults to twice the number of workers.
+        """
+
+        errors, opened = [], []
+
+        def track(tasks):
+            for task in tasks:
+                opened.append(task)
+                yield task
+
+        tasks = track(tasks)
+
+        if mode == "async":
+            asyncio.run(self._run_async(tasks, max_concurrency, queue_size, errors))
+        elif mode == "thread":
+            data_queue = Queue(maxsize=queue_size or 2 * max_threads)
+
+            threads = [Thread(target=self.feed, args=(tasks, data_queue, max_threads, errors))]
+            threads += [Thread(target=self.worker, args=(data_queue,)) for i in range(max_threads)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+        else:
+            raise ValueError(f"Unknown mode: {mode}")
+
+        # A file that failed to close, e.g. its writer, fails the run after the other files are done
+        errors += [task.error for task in opened if task.error is not None]
+        if errors:
+            raise errors[0]
+
+    def run(self, writer, data_items, mode="thread", max_threads=10, max_concurrency=100, queue_size=None):
+
+        """
+        Process every data item of one file and write the results.
+        Items are pulled from data_items through a bounded queue, so the first
+        request goes out as soon as the first item is built.
+
+        Args:
+            writer (OutputWriter): Writer the finished items are handed to. The caller closes it.
+            data_items (iterable): Data items, as yielded by process_input.
+            mode (str): "thread" to run a pool of worker threads, "async" to run worker tasks on an event loop.
+            max_threads (int): Number of worker threads in thread mode.
+            max_concurrency (int): Maximum number of in-flight requests in async mode.
+            queue_size (int): Maximum number of items waiting for a worker. Defaults to twice the number of workers.
+        """
+
+        task = FileTask(lambda: nullcontext((data_items, writer)))
+        self.run_tasks([task], mode=mode, max_threads=max_threads, max_concurrency=max_concurrency, queue_size=queue_size)
+
+    def run_files(self, input_folder, output_suffix, max_threads=10, mode="thread", max_concurrency=100, batch_size=1, resume=False, retry_dead=False,
+                  writer_kwargs=None, metrics_path=None, metrics_interval=10.0, job_db=None, job_rows=10000, lease_seconds=300, priority=None,
+                  filter_pairs=None, file_hook=None):
+
+        """
+        Process every jsonl file of a folder, writing <name>_output.jsonl per file to the folder
+        named input_folder + output_suffix. Every output has its checkpoint and dead letters.
+
+        Args:
+            input_folder (str): Folder containing the input jsonl files.
+            output_suffix (str): Appended to input_folder to name the output folder, e.g. "_questions".
+            max_threads (int): Number of worker threads in thread mode.
+            mode (str): "thread" or "async" execution engine.
+            max_concurrency (int): Maximum number of in-flight requests in async mode.
+            batch_size (int): Rows packed into one request.
+            resume (bool): Append to existing outputs, skipping rows already recorded as done.
+            retry_dead (bool): Only send the rows in the outputs' dead-letter files again, one row per request, appending to the outputs.
+            writer_kwargs (dict): Options for the writer (ordered, atomic, flush_interval, fsync, output_format, shard_rows).
+            metrics_path (str): File to export metrics to, None to only print progress.
+            metrics_interval (float): Seconds between progress lines and metrics exports.
+            job_db (str): SQLite job table to lease row range shards from, shared with other workers. None processes every file here.
+            job_rows (int): Input rows per job table shard.
+            lease_seconds (float): Seconds a shard lease lasts without a heartbeat.
+            priority (dict): Input file name mapped to its priority. Higher priority files are processed first.
+            filter_pairs (callable): Takes the (row_id, row) pairs of a file and returns the ones worth sending.
+            file_hook (callable): Takes a Shard and returns a context manager around writing its output. It yields
+                an on_flush callback for the writer, or None, which also gets the rows a resumed output already has.
+                Its exit runs once the output is written, before the shard is handed back.
+
+        Returns:
+            JobTable: The job table shards were leased from, None without job_db.
+        """
+
+        files = [file for file in os.listdir(input_folder) if file.endswith(".jsonl")]
+        save_folder = input_folder + output_suffix
+
+        if not os.path.exists(save_folder):
+            os.makedirs(save_folder)
+
+        if retry_dead and job_db:
+            raise ValueError("--retry-dead runs in one process over the whole outputs, without --job-db")
+
+        jobs = JobTable(job_db, lease_seconds=lease_seconds) if job_db else None
+        reporter = Reporter([self.stage], path=metrics_path, interval=metrics_interval)
+
+        @contextmanager
+        def open_file(shard):
+            print(f"Processing file: {shard.filepath}" + (f" lines {shard.start}-{shard.end}" if jobs else ""))
+
+            output_filepath = os.path.join(save_folder, f"{shard.name}_output.jsonl")
+
+            # A shard taken over from a worker that died continues from that worker's output
+            checkpoint = Checkpoint(output_filepath, resume=resume or retry_dead or shard.attempts > 1)
+            dead_letters = DeadLetters(output_filepath, resume=checkpoint.resume, retry=retry_dead)
+            if checkpoint.done and not retry_dead:
+                print(f"Skipping {len(checkpoint.done)} rows already done")
+
+            if retry_dead:
+                # Single rows avoid the packing a row may have been lost in. Dropped rows passed filter_pairs already.
+                pairs = list(dead_letters.pending(checkpoint))
+                print(f"Retrying {len(pairs)} dropped rows ({dead_letters.reasons()})")
+                data_items = self.process_input(pairs)
+                reporter.add_total(self.stage, len(pairs))
+            else:
+                pairs = checkpoint.pending(shard.file, shard.rows(raw=True), shard.start, decode=loads)
+                if filter_pairs is not None:
+                    pairs = filter_pairs(pairs)
+                data_items = self.process_input(pairs, batch_size=batch_size)
+                reporter.add_total(self.stage, shard.count() - len(checkpoint.done))
+
+            hook = file_hook(shard) if file_hook is not None else nullcontext()
+            with shard, hook as on_flush, dead_letters, \
+                 open_writer(output_filepath, checkpoint=checkpoint, on_flush=on_flush, dead_letters=dead_letters, cancel=shard.lost,
+                             **(writer_kwargs or {})) as writer:
+                # Rows from the earlier run are not sent again, so the hook gets them from what the writer kept of the output
+                if on_flush is not None and checkpoint.done:
+                    on_flush(writer.existing_rows())
+                yield data_items, writer
+            checkpoint.close()
 
-            # Postprocess the response
-            processed_rows = self.postprocess_response(output_rows, original_rows, output_text)
+        # One queue for all files, so a file's last slow requests don't hold up the next one
+        shards = work_shards(self.stage, input_folder, files, jobs, job_rows, priority)
+        tasks = (FileTask(partial(open_file, shard), name=shard.filepath) for shard in shards)
 
-            # Save the response to a file
-            for row in processed_rows:
-                file_handle.write(json.dumps(row, ensure_ascii=False) + "\n")
+        with reporter:
+            self.run_tasks(tasks, mode=mode, max_threads=max_threads, max_concurrency=max_concurrency)
 
-            data_queue.task_done()
\ No newline at end of file
+        return jobs
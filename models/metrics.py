@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+HELP = {
+    "requests_total": "API requests by outcome (ok, 429, 500, timeout, error).",
+    "request_latency_seconds": "Latency of single API requests, retries included as separate requests.",
+    "retries_total": "Failed API requests that were retried.",
+    "hedged_requests_total": "Duplicate requests sent after the hedge threshold, by whether the duplicate answered first (won, lost).",
+    "hedge_threshold_seconds": "Latency after which a duplicate request is sent.",
+    "cache_hits_total": "Requests served from the response cache.",
+    "tokens_total": "Tokens reported by usage_metadata, by kind (prefix served from a prompt cache, rest of the prompt as payload, candidates).",
+    "rows_done_total": "Rows written to the output.",
+    "rows_skipped_total": "Rows dropped, by reason (api_failed, blocked, row_mismatch, error, prefilter).",
+    "near_duplicates_total": "Questions dropped as near duplicates before the answer stage.",
+    "queue_depth": "Data items waiting for a worker.",
+    "effective_rpm": "Requests sent over the last minute.",
+}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Histogram:
+
+    """
+    Cumulative bucket counts, sum and count of observed values, as Prometheus histograms have.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+
+        """
+        Upper bound of the bucket holding the q-th quantile.
+        """
+
+        target = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= target:
+                return bound
+        return self.buckets[-1]
+
+
+class LatencyWindow:
+
+    """
+    Latencies of the last size successful requests, for percentiles that follow
+    the current behaviour of the API rather than the whole run.
+    """
+
+    def __init__(self, size=1000, min_samples=50):
+
+        """
+        Args:
+            size (int): Latencies kept.
+            min_samples (int): Latencies needed before percentile() returns anything.
+        """
+
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, q):
+
+        """
+        Returns:
+            float: The q-th percentile (0-100) of the kept latencies, or None with fewer than min_samples of them.
+        """
+
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+
+        return latencies[min(len(latencies) - 1, int(q / 100 * len(latencies)))]
+
+
+class Metrics:
+
+    """
+    Counters, gauges and histograms of a generation run. Every series is labelled
+    with the stage it belongs to, so one registry serves all stages of a pipeline.
+    Updates take a lock and a dict lookup, cheap next to an API call.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def request(self, stage, status, latency):
+
+        """
+        Record one API request.
+
+        Args:
+            stage (str): Stage that sent it.
+            status (str): "ok", "429", "500" or "error".
+            latency (float): Seconds the request took.
+        """
+
+        self.inc("requests_total", stage=stage, status=status)
+        self.observe("request_latency_seconds", latency, stage=stage)
+
+        now = time.monotonic()
+        with self._lock:
+            window = self._requests.setdefault(stage, deque())
+            window.append(now)
+            while window and window[0] < now - 60:
+                window.popleft()
+
+    def effective_rpm(self, stage):
+        now = time.monotonic()
+        with self._lock:
+            window = self._requests.get(stage, ())
+            return sum(1 for sent in window if sent >= now - 60)
+
+    def total(self, name, **labels):
+
+        """
+        Sum of a counter over every series matching the given labels.
+        """
+
+        with self._lock:
+            return sum(value for (key, series), value in self.counters.items()
+                       if key == name and all(item in series for item in labels.items()))
+
+    def stages(self):
+        with self._lock:
+            return sorted({dict(labels)["stage"] for _, labels in self.counters if "stage" in dict(labels)})
+
+    def snapshot(self):
+
+        """
+        Returns:
+            dict: Every series as JSON friendly values.
+        """
+
+        for stage in self.stages():
+            self.set("effective_rpm", self.effective_rpm(stage), stage=stage)
+
+        with self._lock:
+            return {
+                "time": time.time(),
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [{"name": name, "labels": dict(labels), "buckets": dict(zip(map(str, hist.buckets), hist.counts)),
+                                "sum": hist.sum, "count": hist.count} for (name, labels), hist in sorted(self.histograms.items())],
+            }
+
+    def prometheus(self):
+
+        """
+        Returns:
+            str: Every series in the Prometheus text exposition format, names prefixed with geni_.
+        """
+
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# HELP geni_{name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE geni_{name} {kind}")
+
+        for series in snapshot["counters"]:
+            declare(series["name"], "counter")
+            lines.append(f"geni_{series['name']}{_format_labels(sorted(series['labels'].items()))} {series['value']}")
+
+        for series in snapshot["gauges"]:
+            declare(series["name"], "gauge")
+            lines.append(f"geni_{series['name']}{_format_labels(sorted(series['labels'].items()))} {series['value']}")
+
+        for series in snapshot["histograms"]:
+            declare(series["name"], "histogram")
+            labels = sorted(series["labels"].items())
+            for bound, count in series["buckets"].items():
+                bound = "+Inf" if bound == "inf" else bound
+                lines.append(f"geni_{series['name']}_bucket{_format_labels(labels + [('le', bound)])} {count}")
+            lines.append(f"geni_{series['name']}_sum{_format_labels(labels)} {series['sum']}")
+            lines.append(f"geni_{series['name']}_count{_format_labels(labels)} {series['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+
+        """
+        Write a snapshot to path, as JSON if it ends with .json and as a Prometheus
+        textfile otherwise. The file is replaced atomically so collectors never read half of it.
+        """
+
+        if path.endswith(".json"):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.prometheus()
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+
+# Process wide registry every generator records into
+METRICS = Metrics()
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class Reporter:
+
+    """
+    Background thread that prints a progress line and exports a metrics snapshot every interval.
+    """
+
+    def __init__(self, stages, totals=None, path=None, interval=10.0, metrics=METRICS):
+
+        """
+        Args:
+            stages (list): Stages shown on the progress line.
+            totals (dict): Rows expected per stage, for the ETA. Stages without a total show no ETA.
+            path (str): Metrics file, .json for a JSON snapshot, anything else for a Prometheus textfile. None to only print progress.
+            interval (float): Seconds between progress lines and exports.
+            metrics (Metrics): Registry to report.
+        """
+
+        self.stages = stages
+        self.totals = totals or {}
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+
+        # Counters are process wide; progress is measured from where they stand now
+        self.started = time.monotonic()
+        self.start_rows = {stage: self.processed(stage) for stage in stages}
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_total(self, stage, rows):
+
+        """
+        Add rows to the expected total of a stage, for work that is only known once it starts, like the files of a run.
+        """
+
+        self.totals[stage] = self.totals.get(stage, 0) + rows
+
+    def processed(self, stage):
+        return self.metrics.total("rows_done_total", stage=stage) + self.metrics.total("rows_skipped_total", stage=stage)
+
+    def progress(self):
+
+        """
+        Returns:
+            str: One line with rows done, rows/s, ETA, effective requests/min and skips per stage.
+        """
+
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        parts = []
+
+        for stage in self.stages:
+            rows = self.processed(stage) - self.start_rows[stage]
+            rate = rows / elapsed
+            total = self.totals.get(stage)
+
+            part = f"{stage}: {rows}"
+            if total:
+                part += f"/{total} rows ({100 * rows / total:.1f}%)"
+                if rate > 0:
+                    part += f", ETA {format_duration(max(0, total - rows) / rate)}"
+            else:
+                part += " rows"
+
+            part += f", {rate:.1f} rows/s, {self.metrics.effective_rpm(stage)} requests/min"
+            skipped = self.metrics.total("rows_skipped_total", stage=stage)
+            if skipped:
+                part += f", {skipped} skipped"
+            parts.append(part)
+
+        return " | ".join(parts)
+
+    def report(self):
+        print(self.progress())
+        if self.path:
+            self.metrics.write(self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.report()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,95 @@
+import re
+import json
+
+_FENCE = re.compile(r"```(?:json)?")
+
+
+def pack_prompt(instruction, texts, fields):
+
+    """
+    Build one prompt carrying several numbered items and asking for a JSON array back.
+
+    Args:
+        instruction (str): Task instruction, including any few-shot examples.
+        texts (list): Per-item payloads, in order.
+        fields (dict): Output field names mapped to a short description of their content.
+
+    Returns:
+        str: The packed prompt.
+    """
+
+    items = "\n".join(f"[{idx}] {text}" for idx, text in enumerate(texts, start=1))
+    example = ", ".join(f'"{field}": <{description}>' for field, description in fields.items())
+
+    return (
+        f"{instruction}\n"
+        f"Do this for each of the {len(texts)} numbered items below.\n\n"
+        f"{items}\n\n"
+        f"Answer with only a JSON array of {len(texts)} objects, one per item, each of the form "
+        f'{{"id": <item number>, {example}}}.'
+    )
+
+
+def _decode_objects(text):
+
+    """
+    Decode every top level JSON object in text, skipping anything that does not parse.
+    Lets a truncated or partly malformed array still yield its good items.
+    """
+
+    decoder = json.JSONDecoder()
+    objects = []
+    position = text.find("{")
+
+    while position != -1:
+        try:
+            obj, end = decoder.raw_decode(text, position)
+        except ValueError:
+            position = text.find("{", position + 1)
+            continue
+
+        if isinstance(obj, dict):
+            objects.append(obj)
+        position = text.find("{", end)
+
+    return objects
+
+
+def parse_packed(text, count, fields):
+
+    """
+    Parse the response to a packed prompt.
+
+    Args:
+        text (str): Raw response text.
+        count (int): Number of items in the prompt.
+        fields (iterable): Field names every item must have.
+
+    Returns:
+        dict: Item number (1 based) mapped to its parsed object. Missing or malformed items are left out.
+    """
+
+    text = _FENCE.sub("", text)
+
+    try:
+        start, end = text.index("["), text.rindex("]")
+        objects = json.loads(text[start:end + 1])
+        if not isinstance(objects, list):
+            raise ValueError("not a list")
+    except ValueError:
+        objects = _decode_objects(text)
+
+    items = {}
+    for obj in objects:
+        if not isinstance(obj, dict) or any(field not in obj for field in fields):
+            continue
+
+        try:
+            idx = int(obj.get("id"))
+        except (TypeError, ValueError):
+            continue
+
+        if 1 <= idx <= count and idx not in items:
+            items[idx] = obj
+
+    return items
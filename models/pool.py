@@ -0,0 +1,227 @@
+import time
+import asyncio
+import hashlib
+import threading
+
+from models.rate_limiter import RateLimiter, backoff_delay
+from models.backends import make_backend
+
+# Server errors that usually pass within seconds; a client failing with them backs off instead of leaving rotation
+TRANSIENT_ERRORS = ("500", "502", "503", "504")
+
+
+def split_list(value):
+
+    """
+    Accept a list or a comma separated string, as used for API keys and model names.
+    """
+
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(",") if item.strip()]
+
+    return list(value)
+
+
+class PoolClient:
+
+    """
+    One API key and model name with its own backend client and its own rate limiter.
+    """
+
+    def __init__(self, api_key, model_name, weight=1.0, rpm=None, tpm=None, backend="gemini", backend_kwargs=None):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.weight = weight
+
+        # Bucket names carry a hash of the key so every process using this key shares its quota
+        key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+        self.name = f"{model_name}:{key_hash}"
+        self.rate_limiter = RateLimiter.for_model(model_name, rpm=rpm, tpm=tpm, name=self.name)
+
+        self.backend = make_backend(backend, api_key, model_name, **(backend_kwargs or {}))
+
+        self.in_flight = 0
+        self.throttles = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+
+    @property
+    def load(self):
+        return self.in_flight / self.weight
+
+
+class ClientPool:
+
+    """
+    Routes requests over several API keys and models. Each request goes to the
+    least loaded client (in-flight requests over weight) that has quota left.
+    Throttled clients cool down with backoff, clients that keep failing are taken
+    out of rotation for a while. Clients that keep failing with server errors, and the
+    last client still in rotation, back off instead.
+    """
+
+    def __init__(self, api_keys, model_names, weights=None, rpm=None, tpm=None, max_failures=5, cooldown=300.0, backend="gemini", backend_kwargs=None):
+
+        """
+        Args:
+            api_keys (list): API keys, or a comma separated string of them.
+            model_names (list): Model names, or a comma separated string of them. Every key is paired with every model.
+            weights (list): Relative share of traffic per key. Defaults to equal weights.
+            rpm (int): Requests/min quota override per client.
+            tpm (int): Tokens/min quota override per client.
+            max_failures (int): Consecutive non-429 failures before a client is taken out of rotation.
+            cooldown (float): Seconds a failing client stays out of rotation.
+            backend (str): Backend every client talks to, one of models.backends.BACKENDS.
+            backend_kwargs (dict): Backend specific options.
+        """
+
+        api_keys = split_list(api_keys)
+        model_names = split_list(model_names)
+        weights = weights or [1.0] * len(api_keys)
+
+        if len(weights) != len(api_keys):
+            raise ValueError("Number of weights must match number of API keys.")
+
+        self.clients = [PoolClient(api_key, model_name, weight, rpm=rpm, tpm=tpm, backend=backend, backend_kwargs=backend_kwargs)
+                        for api_key, weight in zip(api_keys, weights)
+                        for model_name in model_names]
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, tokens):
+
+        """
+        Returns:
+            tuple: (client, 0) if a client took the request, otherwise (None, seconds to wait).
+        """
+
+        now = time.time()
+        with self._lock:
+            available = sorted((client for client in self.clients if client.cooldown_until <= now), key=lambda client: client.load)
+
+        if not available:
+            return None, min(client.cooldown_until for client in self.clients) - now
+
+        min_wait = None
+        for client in available:
+            wait = client.rate_limiter.try_acquire(tokens)
+            if wait <= 0:
+                with self._lock:
+                    client.in_flight += 1
+                return client, 0
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+
+        return None, min_wait
+
+    def try_acquire(self, tokens=0):
+
+        """
+        Take a client only if one has quota right now, without waiting.
+
+        Returns:
+            PoolClient: The client to send the request with, or None. Hand it back with release().
+        """
+
+        client, _ = self._try_acquire(tokens)
+        return client
+
+    def acquire(self, tokens=0):
+
+        """
+        Block until a client has quota for one request and the given number of tokens.
+
+        Returns:
+            PoolClient: The client to send the request with. Hand it back with release().
+        """
+
+        while True:
+            client, wait = self._try_acquire(tokens)
+            if client is not None:
+                return client
+            time.sleep(wait)
+
+    async def _try_acquire_async(self, tokens):
+
+        """
+        _try_acquire in a worker thread, so the SQLite transactions of the rate limiters don't stall the event loop.
+        A client taken after the caller was cancelled is handed back.
+        """
+
+        future = asyncio.get_running_loop().run_in_executor(None, self._try_acquire, tokens)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(self._cancel_acquired)
+            raise
+
+    def _cancel_acquired(self, future):
+        if not future.cancelled() and future.exception() is None and future.result()[0] is not None:
+            self.cancel(future.result()[0])
+
+    async def try_acquire_async(self, tokens=0):
+
+        """
+        Async counterpart of try_acquire.
+        """
+
+        client, _ = await self._try_acquire_async(tokens)
+        return client
+
+    async def acquire_async(self, tokens=0):
+
+        """
+        Async counterpart of acquire.
+        """
+
+        while True:
+            client, wait = await self._try_acquire_async(tokens)
+            if client is not None:
+                return client
+            await asyncio.sleep(wait)
+
+    def cancel(self, client):
+
+        """
+        Hand back a client whose request was cancelled before it finished, leaving its health as it was.
+        """
+
+        with self._lock:
+            client.in_flight -= 1
+
+    def release(self, client, error=None):
+
+        """
+        Hand a client back and update its health from the outcome of the request.
+
+        Args:
+            client (PoolClient): Client returned by acquire.
+            error (Exception): The exception the request raised, None on success.
+        """
+
+        if error is None:
+            client.rate_limiter.on_success()
+        elif "429" in str(error):
+            client.rate_limiter.on_throttle()
+
+        with self._lock:
+            client.in_flight -= 1
+
+            if error is None:
+                client.throttles = 0
+                client.failures = 0
+            elif "429" in str(error):
+                client.cooldown_until = time.time() + backoff_delay(client.throttles)
+                client.throttles += 1
+            else:
+                client.failures += 1
+                if client.failures >= self.max_failures:
+                    now = time.time()
+                    others = any(other is not client and other.cooldown_until <= now for other in self.clients)
+                    if others and not any(code in str(error) for code in TRANSIENT_ERRORS):
+                        print(f"Client {client.name} failed {client.failures} times in a row. Taking it out of rotation for {self.cooldown} seconds.")
+                        client.cooldown_until = now + self.cooldown
+                        client.failures = 0
+                    else:
+                        # Failures keep counting, so the backoff grows until a request succeeds
+                        client.cooldown_until = now + backoff_delay(client.failures - self.max_failures)
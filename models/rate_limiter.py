@@ -0,0 +1,217 @@
+import os
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+
+# Per-model quotas as requests/min and tokens/min. tpm of None means only requests are limited.
+MODEL_LIMITS = {
+    "gemini-pro": {"rpm": 45, "tpm": 32000},
+    "gemini-1.5-flash": {"rpm": 15, "tpm": 1000000},
+    "gemini-1.5-pro": {"rpm": 2, "tpm": 32000},
+}
+DEFAULT_LIMITS = {"rpm": 45, "tpm": None}
+
+DEFAULT_DB_PATH = os.getenv("GENI_RATELIMIT_DB", os.path.join(tempfile.gettempdir(), "geni_ratelimit.sqlite"))
+
+
+def backoff_delay(attempt, base=2.0, cap=64.0):
+
+    """
+    Exponential backoff with full jitter.
+
+    Args:
+        attempt (int): Zero based retry attempt.
+        base (float): Delay ceiling of the first attempt in seconds.
+        cap (float): Maximum delay ceiling in seconds.
+
+    Returns:
+        float: Seconds to sleep before the next attempt.
+    """
+
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class RateLimiter:
+
+    """
+    Token bucket limiter for requests/min and tokens/min with AIMD rate control.
+
+    The bucket state lives in a SQLite file, so every worker thread, async task
+    and process on the host that uses the same name draws from the same quota.
+    A 429 halves the effective rate for everyone, each success adds a little back.
+    """
+
+    def __init__(self, name, rpm, tpm=None, db_path=DEFAULT_DB_PATH, increase=0.01, decrease=0.5, min_rate=0.05, throttle_window=5.0):
+
+        """
+        Args:
+            name (str): Bucket name. Limiters with the same name share one quota.
+            rpm (float): Requests per minute.
+            tpm (float): Tokens per minute, or None to only limit requests.
+            db_path (str): SQLite file holding the shared state.
+            increase (float): Fraction of the full rate added back after each success.
+            decrease (float): Factor the rate is multiplied by on a 429.
+            min_rate (float): Lowest fraction of the full rate AIMD can go down to.
+            throttle_window (float): 429s within this many seconds count as one decrease.
+        """
+
+        self.name = name
+        self.rpm = float(rpm)
+        self.tpm = float(tpm) if tpm else None
+        self.db_path = db_path
+        self.increase = increase
+        self.decrease = decrease
+        self.min_rate = min_rate
+        self.throttle_window = throttle_window
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                requests REAL NOT NULL,
+                tokens REAL NOT NULL,
+                rate REAL NOT NULL,
+                updated REAL NOT NULL,
+                throttled REAL NOT NULL
+            )""")
+
+    @classmethod
+    def for_model(cls, model_name, rpm=None, tpm=None, name=None, **kwargs):
+
+        """
+        Build a limiter from MODEL_LIMITS, with optional overrides.
+        """
+
+        limits = MODEL_LIMITS.get(model_name, DEFAULT_LIMITS)
+        return cls(name or model_name, rpm or limits["rpm"], tpm or limits["tpm"], **kwargs)
+
+    def _connect(self):
+
+        """
+        Connection of the calling thread, opened on its first transaction. SQLite connections
+        can't move between threads, but every request takes a transaction or two.
+        """
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _transaction(self, update):
+
+        """
+        Run update(state, now) inside an exclusive transaction on the refilled bucket.
+        update mutates the state dict and returns the value to hand back to the caller.
+        """
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = conn.execute("SELECT requests, tokens, rate, updated, throttled FROM buckets WHERE name = ?", (self.name,)).fetchone()
+
+            if row is None:
+                state = {"requests": self.rpm, "tokens": self.tpm or 0.0, "rate": 1.0, "updated": now, "throttled": 0.0}
+            else:
+                state = dict(zip(("requests", "tokens", "rate", "updated", "throttled"), row))
+
+            # Refill both buckets at the current effective rate
+            elapsed = max(0.0, now - state["updated"])
+            state["requests"] = min(self.rpm * state["rate"], state["requests"] + elapsed * self.rpm * state["rate"] / 60)
+            if self.tpm:
+                state["tokens"] = min(self.tpm * state["rate"], state["tokens"] + elapsed * self.tpm * state["rate"] / 60)
+            state["updated"] = now
+
+            result = update(state, now)
+
+            conn.execute("INSERT OR REPLACE INTO buckets (name, requests, tokens, rate, updated, throttled) VALUES (?, ?, ?, ?, ?, ?)",
+                         (self.name, state["requests"], state["tokens"], state["rate"], state["updated"], state["throttled"]))
+            conn.execute("COMMIT")
+            return result
+        except:
+            # The connection is kept, so it must not be left inside a transaction
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def try_acquire(self, tokens=0):
+
+        """
+        Take one request and the given number of tokens if both are available.
+
+        Returns:
+            float: 0 if acquired, otherwise seconds to wait before trying again.
+        """
+
+        def update(state, now):
+            request_rate = self.rpm * state["rate"] / 60
+            # Never ask for more than a full bucket, or the request would wait forever
+            needed = min(tokens, self.tpm * state["rate"]) if self.tpm else 0
+
+            wait = max(0.0, (1 - state["requests"]) / request_rate)
+            if self.tpm:
+                wait = max(wait, (needed - state["tokens"]) / (self.tpm * state["rate"] / 60))
+
+            if wait <= 0:
+                state["requests"] -= 1
+                state["tokens"] -= needed
+
+            return wait
+
+        return self._transaction(update)
+
+    def adjust_tokens(self, delta):
+
+        """
+        Correct the token bucket once the real token usage of a request is known.
+
+        Args:
+            delta (int): Actual tokens used minus the tokens acquired up front.
+        """
+
+        if not self.tpm or not delta:
+            return
+
+        def update(state, now):
+            state["tokens"] -= delta
+
+        self._transaction(update)
+
+    def on_success(self):
+
+        """
+        Additive increase of the effective rate after a successful request.
+        """
+
+        def update(state, now):
+            state["rate"] = min(1.0, state["rate"] + self.increase)
+
+        self._transaction(update)
+
+    def on_throttle(self):
+
+        """
+        Multiplicative decrease of the effective rate after a 429.
+        The request bucket is emptied so every worker pauses, not just the one that got the 429.
+        """
+
+        def update(state, now):
+            if now - state["throttled"] < self.throttle_window:
+                return
+            state["rate"] = max(self.min_rate, state["rate"] * self.decrease)
+            state["requests"] = 0.0
+            state["throttled"] = now
+
+        self._transaction(update)
+
+    def effective_rpm(self):
+
+        """
+        Returns:
+            float: Requests per minute currently allowed after AIMD adjustments.
+        """
+
+        return self._transaction(lambda state, now: self.rpm * state["rate"])
@@ -0,0 +1,111 @@
+import sys
+import threading
+from contextlib import ExitStack
+
+
+class FileTask:
+
+    """
+    One input file (or shard) of a run over many files: its data items and the writer its rows go to.
+    The items of every task share one queue and one set of workers, so a run doesn't wait at file
+    boundaries for the slowest request of each file. The task is opened when the feeder reaches it
+    and closed by whichever thread finishes its last item.
+    """
+
+    def __init__(self, opener, name=None):
+
+        """
+        Args:
+            opener (callable): Returns a context manager yielding (data_items, writer). Leaving it
+                closes the writer and runs whatever has to happen once the file is done.
+            name (str): Shown in error messages.
+        """
+
+        self.opener = opener
+        self.name = name
+        self.writer = None
+        self.error = None
+        self.exc_info = (None, None, None)
+
+        self._stack = None
+        self._pending = 0
+        self._fed = False
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def open(self):
+
+        """
+        Returns:
+            iterable: The data items of the file.
+        """
+
+        self._stack = ExitStack()
+        data_items, self.writer = self._stack.enter_context(self.opener())
+        return data_items
+
+    def add(self):
+        with self._lock:
+            self._pending += 1
+
+    def _claim_close(self):
+        if self._fed and self._pending == 0 and not self._closed:
+            self._closed = True
+            return True
+        return False
+
+    def item_done(self):
+
+        """
+        Record a finished item.
+
+        Returns:
+            bool: True if it was the last one and the caller has to close the task.
+        """
+
+        with self._lock:
+            self._pending -= 1
+            return self._claim_close()
+
+    def fed(self):
+
+        """
+        Record that every item of the file has been queued.
+
+        Returns:
+            bool: True if all of them are finished already and the caller has to close the task.
+        """
+
+        with self._lock:
+            self._fed = True
+            return self._claim_close()
+
+    def close(self):
+
+        """
+        Leave the opener's context, with the exception the feeder failed on if it did. Errors
+        are kept on the task instead of raised, so a worker closing a file keeps working on the others.
+        """
+
+        if self._stack is None:
+            return
+
+        try:
+            self._stack.__exit__(*self.exc_info)
+        except Exception as e:
+            print(f"Error closing {self.name}: {e}")
+            self.error = e
+
+    def fail(self, exc_info=None):
+
+        """
+        Stop a task the feeder failed on, while handling the exception. Items already
+        queued still finish, then the task is closed with the exception.
+
+        Args:
+            exc_info (tuple): The exception as sys.exc_info() returns it, for callers outside the except block.
+        """
+
+        self.exc_info = exc_info or sys.exc_info()
+        if self.fed():
+            self.close()
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Tests import the utils and models packages from the repo root, and the stage
+# scripts by module name, the way they import each other when run from generate/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "generate")]
+
+# Rate limiter buckets are shared through this file; keep them from leaking between runs
+os.environ.setdefault("GENI_RATELIMIT_DB", os.path.join(tempfile.mkdtemp(), "ratelimit.sqlite"))
@@ -0,0 +1,34 @@
+from question import GeminiQuestion
+
+
+def make_generator(tmp_path, cache_mode="readwrite"):
+    return GeminiQuestion(api_key="key", backend="simulated", backend_kwargs={"latency": 0}, cache_path=str(tmp_path / "cache.sqlite"), cache_mode=cache_mode)
+
+
+def backend_calls(generator):
+    return sum(client.backend.calls for client in generator.pool.clients)
+
+
+def test_repeated_prompt_is_served_from_the_cache(tmp_path):
+    generator = make_generator(tmp_path)
+
+    first = generator.call_api("Seeds: भारत\nQuestion:")
+    assert backend_calls(generator) == 1
+
+    assert generator.call_api("Seeds: भारत\nQuestion:").text == first.text
+    assert backend_calls(generator) == 1
+
+    generator.call_api("Seeds: गंगा\nQuestion:")
+    assert backend_calls(generator) == 2
+
+
+def test_cache_outlives_the_process_and_bypass_skips_it(tmp_path):
+    make_generator(tmp_path).call_api("Seeds: भारत\nQuestion:")
+
+    generator = make_generator(tmp_path)
+    generator.call_api("Seeds: भारत\nQuestion:")
+    assert backend_calls(generator) == 0
+
+    generator = make_generator(tmp_path, cache_mode="bypass")
+    generator.call_api("Seeds: भारत\nQuestion:")
+    assert backend_calls(generator) == 1
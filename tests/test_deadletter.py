@@ -0,0 +1,30 @@
+import os
+
+from utils.deadletter import DeadLetters
+
+
+def test_dead_letters_are_not_stage_input(tmp_path):
+    output = str(tmp_path / "uq_name_output.jsonl")
+    open(output, "w").close()
+
+    with DeadLetters(output) as dead_letters:
+        dead_letters.add([(0, {"name": "x"}, "blocked", None)])
+
+    # The listing every stage and dedup use to pick up input files
+    files = [file for file in os.listdir(tmp_path) if file.endswith(".jsonl")]
+    assert files == ["uq_name_output.jsonl"]
+    assert os.path.exists(dead_letters.path)
+
+
+def test_retry_takes_dead_rows_once(tmp_path):
+    output = str(tmp_path / "out.jsonl")
+
+    with DeadLetters(output) as dead_letters:
+        dead_letters.add([(0, {"a": 1}, "api_failed", None), (1, {"a": 2}, "error", "boom")])
+        dead_letters.add([(0, {"a": 1}, "api_failed", None)])
+
+    with DeadLetters(output, retry=True) as dead_letters:
+        assert list(dead_letters.pending()) == [(0, {"a": 1}), (1, {"a": 2})]
+        assert dead_letters.reasons() == {"api_failed": 2, "error": 1}
+
+    assert not os.path.exists(dead_letters.retry_path)
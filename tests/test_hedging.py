@@ -0,0 +1,48 @@
+import time
+import asyncio
+
+import pytest
+
+from question import GeminiQuestion
+
+
+@pytest.fixture
+def generator():
+    generator = GeminiQuestion(api_key="key-a,key-b", backend="simulated", backend_kwargs={"latency": 0}, cache_mode="bypass",
+                               hedge_percentile=95, hedge_budget=1.0)
+
+    # The first client stalls; recent requests all took 10ms
+    slow = generator.pool.clients[0].backend
+    slow.latency, slow.latency_sigma = 1.0, 0
+    for _ in range(50):
+        generator.latencies.observe(0.01)
+
+    return generator
+
+
+def test_slow_request_is_hedged(generator):
+    start = time.monotonic()
+    assert generator.call_api("Seeds: भारत\nQuestion:") is not None
+
+    assert time.monotonic() - start < 0.5
+    assert generator._hedges == 1
+
+
+def test_slow_request_is_hedged_async(generator):
+    start = time.monotonic()
+    assert asyncio.run(generator.call_api_async("Seeds: भारत\nQuestion:")) is not None
+
+    assert time.monotonic() - start < 0.5
+    assert generator._hedges == 1
+    # The slower request was cancelled and handed its client back
+    assert all(client.in_flight == 0 for client in generator.pool.clients)
+
+
+def test_hedges_stay_within_budget(generator):
+    generator.hedge_budget = 0.0
+
+    start = time.monotonic()
+    generator.call_api("Seeds: भारत\nQuestion:")
+
+    assert time.monotonic() - start >= 1.0
+    assert generator._hedges == 0
@@ -0,0 +1,80 @@
+import time
+import threading
+
+from utils.jobs import JobTable
+from utils.jsonl import read_jsonl
+from utils.writer import OutputWriter
+
+
+def write_input(path, rows):
+    with open(path, "w") as f:
+        f.writelines(f'{{"i": {i}}}\n' for i in range(rows))
+
+
+def test_expired_lease_goes_to_the_next_worker(tmp_path, monkeypatch):
+    write_input(tmp_path / "in.jsonl", 25)
+    path = str(tmp_path / "jobs.sqlite")
+    first = JobTable(path, lease_seconds=60, worker_id="first")
+    second = JobTable(path, lease_seconds=60, worker_id="second")
+
+    assert first.add_files("seed", [str(tmp_path / "in.jsonl")], shard_rows=10) == 3
+    assert first.add_files("seed", [str(tmp_path / "in.jsonl")], shard_rows=10) == 0
+
+    shard = first.lease("seed")
+    assert (shard.start, shard.end, shard.attempts) == (0, 10, 1)
+    assert second.lease("seed").start == 10
+
+    # The first worker stops heartbeating; once its lease ran out the shard is leased again
+    now = time.time()
+    monkeypatch.setattr("utils.jobs.time.time", lambda: now + 120)
+    taken = second.lease("seed")
+    assert (taken.start, taken.attempts) == (0, 2)
+
+    assert not first.heartbeat(shard)
+    assert not first.complete(shard)
+    assert second.complete(taken)
+
+
+def test_failing_heartbeat_loses_the_lease(tmp_path):
+    write_input(tmp_path / "in.jsonl", 5)
+    table = JobTable(str(tmp_path / "jobs.sqlite"), lease_seconds=0.3)
+    table.add_files("seed", [str(tmp_path / "in.jsonl")])
+
+    def heartbeat(shard):
+        raise RuntimeError("database is locked")
+
+    table.heartbeat = heartbeat
+    shard = table.lease("seed")
+    with shard:
+        assert shard.lost.wait(2)
+    assert table.progress("seed") == {"pending": 1}
+
+
+def test_lost_lease_writes_nothing_more(tmp_path):
+    output = str(tmp_path / "out.jsonl")
+    lost = threading.Event()
+
+    writer = OutputWriter(output, atomic=True, cancel=lost, flush_interval=60)
+    writer.put(0, [{"a": 1}], [])
+    lost.set()
+    writer.put(1, [{"a": 2}], [])
+    writer.close()
+
+    assert writer.cancelled
+    assert list(read_jsonl(output + ".tmp")) == []
+
+
+def test_readding_a_grown_file_adds_the_new_lines(tmp_path):
+    write_input(tmp_path / "in.jsonl", 7)
+    table = JobTable(str(tmp_path / "jobs.sqlite"))
+    table.add_files("seed", [str(tmp_path / "in.jsonl")], shard_rows=5)
+
+    # A short last download shard refilled with --resume
+    write_input(tmp_path / "in.jsonl", 12)
+    assert table.add_files("seed", [str(tmp_path / "in.jsonl")], shard_rows=5) == 1
+
+    ranges = []
+    for shard in table.leases("seed"):
+        ranges.append((shard.start, shard.end))
+        table.complete(shard)
+    assert ranges == [(0, 5), (5, 7), (7, 12)]
@@ -0,0 +1,83 @@
+import os
+import json
+import mmap
+
+import utils.jsonl
+from utils.jsonl import LineIndex, read_jsonl, count_lines, dumps
+
+
+def write_rows(path, count, trailing_newline=True):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(f'{{"n": {n}, "text": "{"क" * (n % 7)}"}}' for n in range(count)))
+        if trailing_newline:
+            f.write("\n")
+
+
+def test_seek_across_blocks(tmp_path):
+    path = str(tmp_path / "rows.jsonl")
+    write_rows(path, 23)
+
+    # Every 4th offset is stored, so most lines are reached from a stored offset several blocks in
+    index = LineIndex(path, every=4)
+    assert len(index) == 23 and len(index.offsets) == 6
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        lines = mm[:].split(b"\n")
+        for line_no in range(23):
+            position = index.seek(mm, line_no)
+            assert mm[position:mm.find(b"\n", position)] == lines[line_no]
+        assert index.seek(mm, 23) == len(mm)
+
+    # A sidecar built with another stride is rebuilt, not misread
+    assert len(LineIndex(path).offsets) == 1
+    assert len(LineIndex(path, every=4).offsets) == 6
+
+
+def test_read_from_every_start(tmp_path):
+    path = str(tmp_path / "rows.jsonl")
+    write_rows(path, 23)
+
+    for start in range(25):
+        assert [row["n"] for row in read_jsonl(path, start)] == list(range(start, 23))
+
+    assert [row["n"] for row in read_jsonl(path, 5, 9)] == [5, 6, 7, 8]
+    assert list(read_jsonl(path, 9, 5)) == []
+    assert list(read_jsonl(path, 2, 3, raw=True)) == [b'{"n": 2, "text": "\xe0\xa4\x95\xe0\xa4\x95"}']
+
+
+def test_no_trailing_newline(tmp_path):
+    path = str(tmp_path / "rows.jsonl")
+    write_rows(path, 10, trailing_newline=False)
+
+    assert count_lines(path) == 10
+    assert [row["n"] for row in read_jsonl(path, 8)] == [8, 9]
+
+
+def test_index_rebuilt_after_append(tmp_path):
+    path = str(tmp_path / "rows.jsonl")
+    write_rows(path, 5)
+    assert count_lines(path) == 5
+    assert os.path.exists(path + ".idx")
+
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"n": 5}\n')
+
+    assert count_lines(path) == 6
+    assert [row["n"] for row in read_jsonl(path, 5)] == [5]
+
+
+def test_empty_file(tmp_path):
+    path = str(tmp_path / "rows.jsonl")
+    open(path, "w").close()
+
+    assert count_lines(path) == 0
+    assert list(read_jsonl(path, 3)) == []
+
+
+def test_dumps_format_without_orjson(monkeypatch):
+    row = {"text": "भारत", "n": [1, 2.5], "ok": True, "none": None}
+    with_orjson = dumps(row)
+
+    monkeypatch.setattr(utils.jsonl, "orjson", None)
+    assert dumps(row) == with_orjson == '{"text":"भारत","n":[1,2.5],"ok":true,"none":null}'
+    assert json.loads(dumps({1: "x"})) == {"1": "x"}
@@ -0,0 +1,28 @@
+from utils.minhash import LSHIndex, MinHasher, similarity
+
+QUESTION = "भारत की राजधानी क्या है और वह किस राज्य में है?"
+OTHER = "गंगा नदी कितनी लंबी है और कहाँ से निकलती है?"
+
+
+def test_signature_similarity():
+    hasher = MinHasher()
+
+    assert similarity(hasher.signature(QUESTION), hasher.signature(QUESTION)) == 1.0
+    assert similarity(hasher.signature(QUESTION), hasher.signature(OTHER)) < 0.5
+
+
+def test_index_drops_near_duplicates(tmp_path):
+    path = str(tmp_path / "index.sqlite")
+
+    with LSHIndex(path, threshold=0.8) as index:
+        assert index.check("q:0", QUESTION) is None
+        assert index.check("q:1", OTHER) is None
+        assert index.check("q:2", QUESTION + " ")[0] == "q:0"
+        # A text checked again under its own key is not its own duplicate
+        assert index.check("q:0", QUESTION) is None
+
+    with LSHIndex(path, threshold=0.8) as index:
+        assert index.check("q:3", QUESTION)[0] == "q:0"
+
+    with LSHIndex(path, threshold=0.8, resume=False) as index:
+        assert index.check("q:3", QUESTION) is None
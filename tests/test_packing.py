@@ -0,0 +1,51 @@
+import argparse
+
+import pytest
+
+from models.gemini import add_arguments
+from models.packing import parse_packed
+
+FIELDS = ["question"]
+
+
+def test_parse_packed_plain_and_fenced():
+    text = '[{"id": 1, "question": "a"}, {"id": 2, "question": "b"}]'
+    expected = {1: {"id": 1, "question": "a"}, 2: {"id": 2, "question": "b"}}
+
+    assert parse_packed(text, 2, FIELDS) == expected
+    assert parse_packed("```json\n" + text + "\n```", 2, FIELDS) == expected
+
+
+def test_parse_packed_truncated_keeps_complete_items():
+    text = '[{"id": 1, "question": "a"}, {"id": 2, "question": "b'
+    assert parse_packed(text, 2, FIELDS) == {1: {"id": 1, "question": "a"}}
+
+
+def test_parse_packed_objects_without_array():
+    text = 'Here you go: {"id": 1, "question": "a"} and {"id": 2, "question": "b"}'
+    assert parse_packed(text, 2, FIELDS) == {1: {"id": 1, "question": "a"}, 2: {"id": 2, "question": "b"}}
+
+
+def test_parse_packed_duplicate_and_out_of_range_ids():
+    text = ('[{"id": 1, "question": "a"}, {"id": 1, "question": "again"}, '
+            '{"id": 0, "question": "low"}, {"id": 3, "question": "high"}, {"id": "2", "question": "b"}]')
+    assert parse_packed(text, 2, FIELDS) == {1: {"id": 1, "question": "a"}, 2: {"id": "2", "question": "b"}}
+
+
+def test_parse_packed_drops_malformed_items():
+    assert parse_packed('[{"id": 1}, {"id": "x", "question": "q"}, 5, null]', 2, FIELDS) == {}
+    assert parse_packed("no json here", 2, FIELDS) == {}
+    assert parse_packed("", 2, FIELDS) == {}
+
+
+@pytest.mark.parametrize("packable", [True, False])
+def test_batch_size_needs_a_packable_stage(packable):
+    parser = argparse.ArgumentParser()
+    add_arguments(parser, packable=packable)
+
+    assert parser.parse_args(["--batch-size", "1"]).batch_size == 1
+    if packable:
+        assert parser.parse_args(["--batch-size", "8"]).batch_size == 8
+    else:
+        with pytest.raises(SystemExit):
+            parser.parse_args(["--batch-size", "8"])
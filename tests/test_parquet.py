@@ -0,0 +1,30 @@
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from utils.parquet import ParquetWriter, read_table, shard_files
+
+
+def test_new_columns_start_a_new_shard(tmp_path):
+    output = str(tmp_path / "out.jsonl")
+
+    with ParquetWriter(output, batch_rows=1) as writer:
+        writer.put(0, [{"a": 1, "b": None}], [])
+        writer.put(1, [{"a": 2, "b": "x", "c": 1.5}], [])
+        writer.put(2, [{"a": 3}], [])
+
+    assert len(shard_files(str(tmp_path / "out"))) == 2
+    assert read_table(str(tmp_path / "out")).to_pylist() == [
+        {"a": 1, "b": None, "c": None},
+        {"a": 2, "b": "x", "c": 1.5},
+        {"a": 3, "b": None, "c": None},
+    ]
+
+
+def test_type_change_reaches_the_caller(tmp_path):
+    writer = ParquetWriter(str(tmp_path / "out.jsonl"), batch_rows=1)
+    writer.put(0, [{"a": 1}], [])
+    writer.put(1, [{"a": "x"}], [])
+
+    with pytest.raises(ValueError):
+        writer.close()
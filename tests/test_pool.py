@@ -0,0 +1,40 @@
+import time
+
+from models.pool import ClientPool
+
+
+def fail(pool, client, error, times):
+    for _ in range(times):
+        client.in_flight += 1
+        pool.release(client, Exception(error))
+
+
+def test_failing_client_leaves_rotation_while_others_remain():
+    pool = ClientPool("key-a,key-b", "sim-model", backend="simulated")
+    client = pool.clients[0]
+
+    fail(pool, client, "400 Bad Request", 5)
+    assert client.cooldown_until > time.time() + pool.cooldown - 5
+
+
+def test_last_client_backs_off_instead():
+    pool = ClientPool("key-a", "sim-model", backend="simulated")
+    client = pool.clients[0]
+
+    fail(pool, client, "400 Bad Request", 5)
+    assert client.cooldown_until <= time.time() + 2
+
+
+def test_server_errors_back_off():
+    pool = ClientPool("key-a,key-b", "sim-model", backend="simulated")
+    client = pool.clients[0]
+
+    fail(pool, client, "503 Service Unavailable", 5)
+    assert client.cooldown_until <= time.time() + 2
+
+    # The backoff grows with every further failure until a request succeeds
+    fail(pool, client, "503 Service Unavailable", 1)
+    assert client.failures == 6
+    client.in_flight += 1
+    pool.release(client)
+    assert client.failures == 0
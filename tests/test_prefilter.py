@@ -0,0 +1,33 @@
+from utils.prefilter import PreFilter, cut_sentences
+
+HINDI = "भारत सरकार ने आज नई शिक्षा नीति की घोषणा की जिससे देश के लाखों छात्रों को फायदा होगा।"
+
+
+def test_cut_sentences_at_sentence_end():
+    assert cut_sentences("पहला वाक्य। दूसरा वाक्य। तीसरा", 14) == "पहला वाक्य।"
+    assert cut_sentences("One. Two? Three!", 9) == "One. Two?"
+    assert cut_sentences("short", 10) == "short"
+
+
+def test_cut_sentences_long_first_sentence():
+    # No sentence end in reach: cut at the last word boundary, or hard at max_chars without one
+    assert cut_sentences("एक बहुत लंबा वाक्य बिना विराम", 10) == "एक बहुत"
+    assert cut_sentences("abcdefghij", 5) == "abcde"
+
+
+def test_prefilter_reasons():
+    prefilter = PreFilter(min_length=20)
+    rows = {
+        "ok": {"text": HINDI},
+        "short": {"text": "छोटा"},
+        "english": {"text": "The government announced a new education policy today for students."},
+        "repeated": {"text": " ".join(["यह एक बात है"] * 20)},
+        "furniture": {"text": "सभी अधिकार सुरक्षित हैं इस वेबसाइट पर\nयह भी पढ़ें: आज की सबसे बड़ी खबरें यहां"},
+    }
+    dropped = {}
+
+    kept = list(prefilter.filter(rows.items(), on_drop=lambda row_id, reason: dropped.update({row_id: reason})))
+
+    assert [row_id for row_id, _ in kept] == ["ok"]
+    assert dropped == {"short": "length", "english": "script", "repeated": "repetition", "furniture": "boilerplate"}
+    assert prefilter.kept == 1
@@ -0,0 +1,38 @@
+import pytest
+
+from models.rate_limiter import RateLimiter
+
+
+@pytest.fixture
+def limiter(tmp_path):
+    return RateLimiter("test", rpm=60, db_path=str(tmp_path / "ratelimit.sqlite"), increase=0.1, throttle_window=60)
+
+
+def test_throttle_halves_the_rate_once_per_window(limiter):
+    limiter.on_throttle()
+    assert limiter.effective_rpm() == pytest.approx(30)
+
+    # More 429s from the same burst don't halve it again
+    limiter.on_throttle()
+    assert limiter.effective_rpm() == pytest.approx(30)
+
+    # The bucket was emptied, so every worker waits
+    assert limiter.try_acquire() > 0
+
+
+def test_successes_add_the_rate_back(limiter):
+    limiter.on_throttle()
+    for _ in range(3):
+        limiter.on_success()
+    assert limiter.effective_rpm() == pytest.approx(48)
+
+    for _ in range(10):
+        limiter.on_success()
+    assert limiter.effective_rpm() == pytest.approx(60)
+
+
+def test_limiters_with_one_name_share_the_quota(limiter):
+    other = RateLimiter("test", rpm=60, db_path=limiter.db_path)
+
+    limiter.on_throttle()
+    assert other.effective_rpm() == pytest.approx(30)
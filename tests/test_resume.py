@@ -0,0 +1,38 @@
+import os
+import json
+
+from question import GeminiQuestion
+from utils.checkpoint import Checkpoint
+from utils.jsonl import read_jsonl
+
+
+def write_seeds(path, start, stop):
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(json.dumps({"seed": f"seed {i}"}) + "\n" for i in range(start, stop))
+
+
+def run(input_folder, resume):
+    generator = GeminiQuestion(api_key="key", backend="simulated", backend_kwargs={"latency": 0}, cache_mode="bypass")
+    generator.run_files(input_folder, "_questions", max_threads=2, resume=resume, writer_kwargs={"ordered": True})
+    return sum(client.backend.calls for client in generator.pool.clients)
+
+
+def test_resume_only_sends_rows_missing_from_the_index(tmp_path):
+    input_folder = str(tmp_path / "seeds")
+    os.makedirs(input_folder)
+    write_seeds(os.path.join(input_folder, "a.jsonl"), 0, 5)
+
+    assert run(input_folder, resume=False) == 5
+
+    write_seeds(os.path.join(input_folder, "a.jsonl"), 5, 8)
+    assert run(input_folder, resume=True) == 3
+
+    output = os.path.join(input_folder + "_questions", "a_output.jsonl")
+    assert [row["seed"] for row in read_jsonl(output)] == [f"seed {i}" for i in range(8)]
+    checkpoint = Checkpoint(output, resume=True)
+    checkpoint.close()
+    assert checkpoint.done == {f"a.jsonl:{i}" for i in range(8)}
+
+    # Without --resume the output starts over
+    assert run(input_folder, resume=False) == 8
+    assert len(list(read_jsonl(output))) == 8
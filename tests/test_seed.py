@@ -0,0 +1,21 @@
+from seed import parse_list, drop_english, SeedCounts
+
+
+def test_parse_list():
+    assert parse_list("['यादव', 'ममता बनर्जी']") == ["यादव", "ममता बनर्जी"]
+    assert parse_list("['यादव', \"ममता\", ") == ["यादव", "ममता"]
+    assert parse_list("[यादव, ममता बनर्जी,]") == ["यादव", "ममता बनर्जी"]
+    assert parse_list("['', ' भारत ']") == ["भारत"]
+    assert parse_list(["a", " b ", ""]) == ["a", "b"]
+    assert parse_list("") == []
+    assert parse_list(None) == []
+
+
+def test_seed_counts_across_rows():
+    counts = SeedCounts()
+    counts.add_rows([{"Name": "['यादव', 'PTI']", "Keywords": "['चुनाव', 'मोर्चा']"},
+                     {"Name": "['यादव']", "Keywords": "['चुनाव', 'क', '2024']"}])
+
+    assert counts.select(counts.names) == [("यादव", 2)]
+    assert counts.select(counts.keywords, min_count=2) == [("चुनाव", 2)]
+    assert drop_english(["PTI", "क", "भारत", "G20"]) == ["भारत"]
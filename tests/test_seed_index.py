@@ -0,0 +1,28 @@
+from utils.seed_index import SeedIndex, normalize_seed
+
+
+def test_normalize_seed():
+    # ज़िंदगी with the precomposed letter and with ज + nukta
+    precomposed, decomposed = "\u095b\u093f\u0902\u0926\u0917\u0940", "\u091c\u093c\u093f\u0902\u0926\u0917\u0940"
+
+    assert normalize_seed(precomposed) == normalize_seed(decomposed) == "जिंदगी"
+    assert normalize_seed(decomposed, fold_nukta=False) == normalize_seed(precomposed, fold_nukta=False)
+    assert normalize_seed("\u0915\u094d\u200d\u0937") == "क्ष"  # with a ZWJ
+    assert normalize_seed("  भारत   सरकार ") == "भारत सरकार"
+
+
+def test_index_merges_variants_and_tracks_asked(tmp_path):
+    index = SeedIndex(str(tmp_path / "seeds.sqlite"))
+
+    assert index.add({"ज़िंदगी": 2, "भारत": 1}, "keyword", "a.jsonl") == 2
+    assert index.add({"ज़िंदगी": 1}, "keyword", "b.jsonl") == 0
+    # Adding a source again replaces its counts
+    assert index.add({"भारत": 1}, "keyword", "a.jsonl") == 0
+
+    pending = dict(index.pending())
+    assert pending == {"seed:जिंदगी": {"seed": "ज़िंदगी", "count": 3}, "seed:भारत": {"seed": "भारत", "count": 1}}
+    assert index.count_pending(min_count=2) == 1
+
+    index.mark_asked(["seed:जिंदगी"])
+    assert [row_id for row_id, _ in index.pending()] == ["seed:भारत"]
+    assert index.known(["जिंदगी", "नया"]) == {"जिंदगी"}
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from utils.checkpoint import Checkpoint
+from utils.jsonl import read_jsonl
+from utils.writer import OutputWriter
+
+
+def test_ordered_writes_in_input_order(tmp_path):
+    output = str(tmp_path / "out.jsonl")
+
+    with OutputWriter(output, ordered=True, flush_interval=60) as writer:
+        for seq in (2, 0, 3, 1):
+            writer.put(seq, [{"seq": seq}], [])
+
+    assert [row["seq"] for row in read_jsonl(output)] == [0, 1, 2, 3]
+
+
+def test_atomic_renames_only_on_success(tmp_path):
+    output = str(tmp_path / "out.jsonl")
+
+    writer = OutputWriter(output, atomic=True)
+    writer.put(0, [{"a": 1}], [])
+    writer.close(success=False)
+    assert not os.path.exists(output)
+    assert os.path.exists(output + ".tmp")
+
+    with OutputWriter(output, atomic=True) as writer:
+        writer.put(0, [{"a": 1}], [])
+    assert list(read_jsonl(output)) == [{"a": 1}]
+    assert not os.path.exists(output + ".tmp")
+
+
+def test_write_error_reaches_the_caller(tmp_path):
+    output = str(tmp_path / "out.jsonl")
+
+    def fail(rows):
+        raise OSError("disk full")
+
+    checkpoint = Checkpoint(output)
+    writer = OutputWriter(output, checkpoint=checkpoint, atomic=True, batch_rows=1, on_flush=fail)
+    writer.put(0, [{"a": 1}], ["in.jsonl:0"])
+    writer._thread.join()
+
+    with pytest.raises(OSError):
+        writer.put(1, [{"a": 2}], ["in.jsonl:1"])
+    with pytest.raises(OSError):
+        writer.close()
+
+    assert not os.path.exists(output)
+    assert not checkpoint.done
+
+
+def test_resume_drops_rows_written_without_their_ids(tmp_path):
+    output = str(tmp_path / "out.jsonl")
+
+    checkpoint = Checkpoint(output)
+    with OutputWriter(output, checkpoint=checkpoint) as writer:
+        writer.put(0, [{"a": 1}], ["in.jsonl:0"])
+    checkpoint.close()
+
+    # A crash between writing a batch and marking it done, with half an ID in the index
+    with open(output, "a") as f:
+        f.write('{"a":2}\n')
+    with open(output + ".done", "a") as f:
+        f.write("in.jsonl:1\nin.jsonl:")
+
+    checkpoint = Checkpoint(output, resume=True)
+    assert checkpoint.done == {"in.jsonl:0"}
+
+    with OutputWriter(output, checkpoint=checkpoint) as writer:
+        writer.put(0, [{"a": 2}], ["in.jsonl:1"])
+    checkpoint.close()
+
+    assert list(read_jsonl(output)) == [{"a": 1}, {"a": 2}]
+    checkpoint = Checkpoint(output, resume=True)
+    checkpoint.close()
+    assert checkpoint.done == {"in.jsonl:0", "in.jsonl:1"}
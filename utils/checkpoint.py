@@ -0,0 +1,123 @@
+import os
+import threading
+
+
+def row_id(file_name, line_no):
+
+    """
+    Stable ID of an input row: its file name and line offset.
+    """
+
+    return f"{os.path.basename(file_name)}:{line_no}"
+
+
+class Checkpoint:
+
+    """
+    Completion index kept next to an output file as <output>.done, one row ID per line.
+    A row ID is only appended once the row's output has been flushed, so on resume
+    every ID in the index has its output on disk.
+
+    After the IDs of a flush the writer records how far the output got, as a line
+    holding a tab and the position (the jsonl file size, or the number of Parquet shards).
+    IDs are only trusted up to the last position, and on resume the writer cuts the
+    output back to it, so rows written without their IDs are not written twice.
+    """
+
+    def __init__(self, output_filepath, resume=False):
+
+        """
+        Args:
+            output_filepath (str): Output jsonl file the index belongs to.
+            resume (bool): Skip rows already in the index. Otherwise the index starts from scratch.
+        """
+
+        self.output_filepath = output_filepath
+        self.index_path = output_filepath + ".done"
+        self.resume = resume
+        self.done = set()
+        self.position = None
+        self._lock = threading.Lock()
+
+        if resume and os.path.exists(self.index_path):
+            self._load()
+            self._index = open(self.index_path, "a", encoding='utf-8')
+        else:
+            # A new output is empty, so a crash before the first flush leaves nothing to keep
+            self._index = open(self.index_path, "w", encoding='utf-8')
+            self._index.write("\t0\n")
+            self._index.flush()
+            self.position = 0
+
+    def _load(self):
+        done, unconfirmed = set(), []
+        confirmed_size = 0
+
+        with open(self.index_path, "rb+") as f:
+            size = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                size += len(line)
+                line = line[:-1].decode("utf-8")
+
+                if line.startswith("\t"):
+                    done.update(unconfirmed)
+                    unconfirmed = []
+                    self.position = int(line[1:])
+                    confirmed_size = size
+                else:
+                    unconfirmed.append(line)
+
+            if self.position is None:
+                # Written without positions: every complete line counts
+                done.update(unconfirmed)
+                confirmed_size = size
+
+            # IDs past the last position have no output left once the writer cuts it back
+            f.truncate(confirmed_size)
+
+        self.done = done
+
+    def is_done(self, row_id):
+        return row_id in self.done
+
+    def pending(self, file_name, rows, start=0, decode=None):
+
+        """
+        Pair rows with their row IDs, skipping rows already done.
+
+        Args:
+            file_name (str): Input file the rows come from.
+            rows (iterable): Rows in file order.
+            start (int): Line of the first row, for rows that don't start at the top of the file.
+            decode (callable): Parses a row. Given raw lines, only the rows still to process are parsed.
+
+        Yields:
+            tuple: (row_id, row) for every row still to process.
+        """
+
+        for line_no, row in enumerate(rows, start):
+            current_id = row_id(file_name, line_no)
+            if current_id not in self.done:
+                yield current_id, row if decode is None else decode(row)
+
+    def mark_done(self, row_ids, position=None):
+
+        """
+        Args:
+            row_ids (list): Row IDs whose output was flushed.
+            position (int): How far the output got with them, see the class docstring.
+        """
+
+        with self._lock:
+            for row_id in row_ids:
+                self._index.write(row_id + "\n")
+                self.done.add(row_id)
+            if position is not None:
+                self._index.write(f"\t{position}\n")
+                self.position = position
+            self._index.flush()
+
+    def close(self):
+        self._index.close()
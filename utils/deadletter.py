@@ -0,0 +1,132 @@
+import os
+
+from utils.jsonl import read_jsonl, dumps
+from utils.writer import drop_partial_line
+
+
+class DeadLetters:
+
+    """
+    Rows the workers gave up on, kept next to an output file as <output>.dead with
+    one {"row_id", "reason", "detail", "row"} object per row. A retry pass reads them back
+    and sends only those rows again, instead of rerunning the whole file.
+
+    A retry moves the file to <output>.dead.prev first, so rows that fail again go to a
+    fresh file. The .prev file is removed once the retry finishes; if the retry dies, the next
+    one picks up both files. The name doesn't end in .jsonl, so the stages reading a folder
+    of outputs don't take the dead letters for input.
+    """
+
+    def __init__(self, output_filepath, resume=False, retry=False):
+
+        """
+        Args:
+            output_filepath (str): Output file the dead letters belong to.
+            resume (bool): Append to the dead letters of the run being resumed. Otherwise they start from scratch.
+            retry (bool): Take the existing dead letters for a retry pass.
+        """
+
+        self.path = output_filepath + ".dead"
+        self.retry_path = self.path + ".prev"
+        self.retry = retry
+        self.count = 0
+        self._file = None
+
+        if retry:
+            self._take_for_retry()
+        elif resume:
+            drop_partial_line(self.path)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _take_for_retry(self):
+        if not os.path.exists(self.path):
+            return
+
+        drop_partial_line(self.path)
+        if not os.path.exists(self.retry_path):
+            os.replace(self.path, self.retry_path)
+            return
+
+        # A retry that died left both files; everything still dead is in one of them
+        with open(self.retry_path, "a", encoding='utf-8') as f, open(self.path, encoding='utf-8') as dead:
+            f.writelines(dead)
+        os.remove(self.path)
+
+    def pending(self, checkpoint=None):
+
+        """
+        Dead rows to retry, each once and in the order they were dropped.
+
+        Args:
+            checkpoint (Checkpoint): Completion index. Rows done since they were dropped are skipped.
+
+        Yields:
+            tuple: (row_id, row) for every row to retry.
+        """
+
+        if not os.path.exists(self.retry_path):
+            return
+
+        seen = set()
+        for entry in read_jsonl(self.retry_path):
+            if entry["row_id"] in seen or (checkpoint is not None and checkpoint.is_done(entry["row_id"])):
+                continue
+            seen.add(entry["row_id"])
+            yield entry["row_id"], entry["row"]
+
+    def reasons(self):
+
+        """
+        Returns:
+            dict: Number of dead rows per reason in the file taken for the retry.
+        """
+
+        counts = {}
+        if os.path.exists(self.retry_path):
+            for entry in read_jsonl(self.retry_path):
+                counts[entry["reason"]] = counts.get(entry["reason"], 0) + 1
+        return counts
+
+    def add(self, entries):
+
+        """
+        Append dropped rows. Called from the writer thread only.
+
+        Args:
+            entries (list): (row_id, row, reason, detail) tuples.
+        """
+
+        if not entries:
+            return
+
+        if self._file is None:
+            self._file = open(self.path, "a", encoding='utf-8')
+
+        self._file.write("".join(dumps({"row_id": row_id, "reason": reason, "detail": detail, "row": row}) + "\n"
+                                 for row_id, row, reason, detail in entries))
+        self._file.flush()
+        self.count += len(entries)
+
+    def close(self, success=True):
+
+        """
+        Args:
+            success (bool): The run finished, so the dead letters taken for a retry are no longer needed.
+        """
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        if self.count:
+            print(f"{self.count} dropped rows written to {self.path}")
+
+        if self.retry and success and os.path.exists(self.retry_path):
+            os.remove(self.retry_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(success=exc_type is None)
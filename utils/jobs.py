@@ -0,0 +1,372 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+
+from utils.jsonl import read_jsonl, count_lines
+
+
+class Shard:
+
+    """
+    A row range of one input file that a worker processes as a unit. Used as a context
+    manager, a leased shard keeps its lease alive while the body runs and is completed
+    when the body finishes without error, or handed back to the table when it raises.
+    """
+
+    def __init__(self, filepath, start=0, end=None, table=None, shard_id=None, attempts=1):
+
+        """
+        Args:
+            filepath (str): Input jsonl file.
+            start (int): First line of the range.
+            end (int): Line after the last one of the range. None for the rest of the file.
+            table (JobTable): Job table the shard is leased from. None for a whole file processed without one.
+            shard_id (int): ID of the shard in the table.
+            attempts (int): How many times the shard has been leased, this time included.
+        """
+
+        self.filepath = filepath
+        self.file = os.path.basename(filepath)
+        self.start = start
+        self.end = end
+        self.table = table
+        self.shard_id = shard_id
+        self.attempts = attempts
+
+        # Whatever the stage wants stored with the shard once it is done, e.g. counts to merge later
+        self.result = None
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    @property
+    def name(self):
+
+        """
+        Output name of the shard: the input file name without extension, with the start line for leased shards.
+        """
+
+        stem = self.file.split('.')[0]
+        return stem if self.table is None else f"{stem}_{self.start:09d}"
+
+    def rows(self, raw=False):
+
+        """
+        Rows of the range in file order. Stops early if the lease was lost to another worker.
+
+        Args:
+            raw (bool): Yield the undecoded lines, see read_jsonl.
+        """
+
+        for row in read_jsonl(self.filepath, start=self.start, stop=self.end, raw=raw):
+            if self.lost.is_set():
+                return
+            yield row
+
+    def count(self):
+        end = self.end if self.end is not None else count_lines(self.filepath)
+        return end - self.start
+
+    def _beat(self):
+        renewed = time.monotonic()
+        while not self._stop.wait(self.table.lease_seconds / 3):
+            try:
+                if self.table.heartbeat(self):
+                    renewed = time.monotonic()
+                    continue
+                print(f"Lost the lease on {self.file} lines {self.start}-{self.end} to another worker. Stopping it...")
+            except Exception as e:
+                # E.g. a locked database; the lease still holds until it runs out without a heartbeat
+                if time.monotonic() - renewed < self.table.lease_seconds * 2 / 3:
+                    print(f"Heartbeat on {self.file} lines {self.start}-{self.end} failed ({e}). Trying again...")
+                    continue
+                print(f"Heartbeat on {self.file} lines {self.start}-{self.end} failed until the lease ran out ({e}). Stopping it...")
+
+            self.lost.set()
+            return
+
+    def __enter__(self):
+        if self.table is not None:
+            self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+            self._heartbeat.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.table is None:
+            return
+
+        self._stop.set()
+        self._heartbeat.join()
+
+        if exc_type is None and not self.lost.is_set():
+            self.table.complete(self)
+        else:
+            self.table.release(self)
+
+
+class JobTable:
+
+    """
+    Job table in SQLite holding the row range shards of the input files. Worker processes
+    on any number of hosts lease shards from it, heartbeat while they work on them and
+    complete them when their output is flushed. A lease that isn't renewed within
+    lease_seconds expires, and the shard goes to the next worker asking for one.
+
+    The table uses SQLite's rollback journal rather than WAL, which needs shared memory
+    and doesn't work across hosts, so it can live on a shared filesystem with working locks.
+    """
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3, worker_id=None):
+
+        """
+        Args:
+            path (str): SQLite file of the table, on a filesystem every worker can reach.
+            lease_seconds (float): Seconds a lease lasts without a heartbeat. Heartbeats are sent every third of it.
+            max_attempts (int): Leases a shard gets before it is marked failed instead of retried again.
+            worker_id (str): Name of this worker in the table. Defaults to host:pid.
+        """
+
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        conn = self._connect()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS shards (
+                id INTEGER PRIMARY KEY,
+                stage TEXT NOT NULL,
+                file TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                owner TEXT,
+                lease_until REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                priority INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                UNIQUE (stage, file, start)
+            )""")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def _transaction(self, update):
+
+        """
+        Run update(conn, now) inside an exclusive transaction and return its result.
+        """
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            result = update(conn, time.time())
+            conn.execute("COMMIT")
+            return result
+        except:
+            # A failed BEGIN, e.g. on a locked database, leaves no transaction to roll back
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def add_files(self, stage, filepaths, shard_rows=10000, priority=None):
+
+        """
+        Split input files into shards of shard_rows lines. Adding a file again only adds the
+        lines appended to it since, e.g. to a short last download shard that was refilled,
+        so every worker can call this on start-up.
+
+        Args:
+            stage (str): Stage the shards belong to.
+            filepaths (list): Input jsonl files.
+            shard_rows (int): Lines per shard.
+            priority (dict): File name mapped to its priority. Shards of higher priority files are leased first, others have 0.
+
+        Returns:
+            int: Number of shards that were not in the table before.
+        """
+
+        priority = priority or {}
+
+        lines = {os.path.abspath(filepath): count_lines(filepath) for filepath in filepaths}
+
+        def update(conn, now):
+            added = 0
+            for filepath, file_lines in lines.items():
+                # Shards already in the table keep their ranges; new ones start where they end
+                known = conn.execute("SELECT MAX(end) FROM shards WHERE stage = ? AND file = ?", (stage, filepath)).fetchone()[0] or 0
+                file_priority = priority.get(os.path.basename(filepath), 0)
+                added += sum(conn.execute("INSERT OR IGNORE INTO shards (stage, file, start, end, priority) VALUES (?, ?, ?, ?, ?)",
+                                          (stage, filepath, start, min(start + shard_rows, file_lines), file_priority)).rowcount
+                             for start in range(known, file_lines, shard_rows))
+            return added
+
+        return self._transaction(update)
+
+    def lease(self, stage):
+
+        """
+        Lease the next pending shard of a stage, or one whose lease expired, highest priority first.
+        Shards that used up max_attempts are marked failed on the way.
+
+        Returns:
+            Shard: The leased shard, or None if no shard is left to lease.
+        """
+
+        def update(conn, now):
+            conn.execute("UPDATE shards SET status = 'failed', owner = NULL WHERE stage = ? AND status = 'leased' AND lease_until < ? AND attempts >= ?",
+                         (stage, now, self.max_attempts))
+
+            row = conn.execute("SELECT id, file, start, end, attempts FROM shards WHERE stage = ? AND "
+                               "(status = 'pending' OR (status = 'leased' AND lease_until < ?)) ORDER BY priority DESC, id LIMIT 1", (stage, now)).fetchone()
+            if row is None:
+                return None
+
+            shard_id, filepath, start, end, attempts = row
+            conn.execute("UPDATE shards SET status = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                         (self.worker_id, now + self.lease_seconds, shard_id))
+            return Shard(filepath, start, end, table=self, shard_id=shard_id, attempts=attempts + 1)
+
+        return self._transaction(update)
+
+    def leases(self, stage):
+
+        """
+        Lease shards of a stage one after the other until none is left.
+
+        Yields:
+            Shard: The leased shards.
+        """
+
+        while True:
+            shard = self.lease(stage)
+            if shard is None:
+                return
+            yield shard
+
+    def heartbeat(self, shard):
+
+        """
+        Extend the lease on a shard.
+
+        Returns:
+            bool: False if the lease expired and another worker took the shard over.
+        """
+
+        def update(conn, now):
+            return conn.execute("UPDATE shards SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'leased'",
+                                (now + self.lease_seconds, shard.shard_id, self.worker_id)).rowcount == 1
+
+        return self._transaction(update)
+
+    def complete(self, shard):
+
+        """
+        Mark a shard done and store its result. A worker that lost the lease can't complete it.
+
+        Returns:
+            bool: True if the shard was completed.
+        """
+
+        result = json.dumps(shard.result, ensure_ascii=False) if shard.result is not None else None
+
+        def update(conn, now):
+            return conn.execute("UPDATE shards SET status = 'done', result = ?, lease_until = 0 WHERE id = ? AND owner = ? AND status = 'leased'",
+                                (result, shard.shard_id, self.worker_id)).rowcount == 1
+
+        return self._transaction(update)
+
+    def release(self, shard):
+
+        """
+        Hand a shard back without completing it, so the next worker can lease it right away.
+        """
+
+        def update(conn, now):
+            status = "pending" if shard.attempts < self.max_attempts else "failed"
+            conn.execute("UPDATE shards SET status = ?, owner = NULL, lease_until = 0 WHERE id = ? AND owner = ? AND status = 'leased'",
+                         (status, shard.shard_id, self.worker_id))
+
+        self._transaction(update)
+
+    def progress(self, stage):
+
+        """
+        Returns:
+            dict: Number of shards per status (pending, leased, done, failed).
+        """
+
+        conn = self._connect()
+        try:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM shards WHERE stage = ? GROUP BY status", (stage,)).fetchall())
+        finally:
+            conn.close()
+
+    def finished(self, stage):
+
+        """
+        True once no shard of the stage is pending or leased any more.
+        """
+
+        progress = self.progress(stage)
+        return not progress.get("pending") and not progress.get("leased")
+
+    def results(self, stage):
+
+        """
+        Yields:
+            The stored results of the done shards of a stage, in shard order.
+        """
+
+        conn = self._connect()
+        try:
+            for (result,) in conn.execute("SELECT result FROM shards WHERE stage = ? AND status = 'done' AND result IS NOT NULL ORDER BY id", (stage,)):
+                yield json.loads(result)
+        finally:
+            conn.close()
+
+
+def work_shards(stage, input_folder, files, table=None, shard_rows=10000, priority=None):
+
+    """
+    The units of work of a stage run: every input file as a whole, or with a job table,
+    the shards this worker manages to lease from it.
+
+    Args:
+        stage (str): Stage the shards belong to in the table.
+        input_folder (str): Folder holding the input files.
+        files (list): Input file names.
+        table (JobTable): Job table shared with the other workers. None processes every file in this process.
+        shard_rows (int): Input rows per shard when the files are added to the table.
+        priority (dict): File name mapped to its priority. Higher priority files come first, others have 0.
+
+    Yields:
+        Shard: The shards to process, each to be used as a context manager.
+    """
+
+    priority = priority or {}
+    files = sorted(files, key=lambda file: -priority.get(file, 0))
+    filepaths = [os.path.join(input_folder, file) for file in files]
+
+    if table is None:
+        for filepath in filepaths:
+            yield Shard(filepath)
+        return
+
+    new = table.add_files(stage, filepaths, shard_rows=shard_rows, priority=priority)
+    if new:
+        print(f"Added {new} shards to the job table")
+
+    yield from table.leases(stage)
+
+    print(f"No {stage} shards left to lease")
@@ -0,0 +1,190 @@
+import os
+import json
+import mmap
+import struct
+from array import array
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Offsets of every INDEX_EVERY-th line are kept; reaching a line in between skips at most that many lines
+INDEX_EVERY = 1024
+_HEADER = struct.Struct("<4sIQQQ")
+_MAGIC = b"GJLX"
+
+
+def loads(line):
+
+    """
+    Parse one JSON value from str or bytes, with orjson when it is installed.
+    """
+
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def dumps(row):
+
+    """
+    Serialize a row to one line of compact JSON without the newline, keeping non-ASCII text as is.
+    Uses orjson when it is installed, and json for values orjson doesn't take (e.g. non-string keys).
+    Both write the same compact format, so outputs don't depend on whether orjson is installed.
+    """
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(row).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(row, ensure_ascii=False, separators=(",", ":"))
+
+
+def _map(f):
+
+    """
+    Returns:
+        mmap.mmap: Read-only map of the file, or None if it is empty.
+    """
+
+    if os.fstat(f.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class LineIndex:
+
+    """
+    Byte offsets of the lines of a jsonl file, kept next to it as <file>.idx so a shard can
+    seek straight to its first row and counting rows costs nothing after the first time.
+    Only every INDEX_EVERY-th offset is stored, which keeps the sidecar at 8 bytes per 1024 lines.
+
+    The sidecar records the size and modification time of the file it was built from, and is
+    rebuilt when they don't match. If it can't be written, e.g. in a read-only input folder,
+    the index is kept in memory only.
+    """
+
+    def __init__(self, filepath, every=INDEX_EVERY):
+
+        """
+        Args:
+            filepath (str): jsonl file to index.
+            every (int): Keep the offset of every this many lines.
+        """
+
+        self.filepath = filepath
+        self.path = filepath + ".idx"
+        self.every = every
+
+        stat = os.stat(filepath)
+        if not self._load(stat):
+            self._build(stat)
+
+    def _load(self, stat):
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, "rb") as f:
+            header = f.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                return False
+
+            magic, every, size, mtime_ns, lines = _HEADER.unpack(header)
+            if magic != _MAGIC or every != self.every or size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+                return False
+
+            self.offsets = array("Q")
+            self.offsets.frombytes(f.read())
+
+        self.lines = lines
+        return True
+
+    def _build(self, stat):
+        self.offsets = array("Q")
+        self.lines = 0
+
+        with open(self.filepath, "rb") as f:
+            mm = _map(f)
+            if mm is not None:
+                with mm:
+                    position = 0
+                    while position < len(mm):
+                        if self.lines % self.every == 0:
+                            self.offsets.append(position)
+                        newline = mm.find(b"\n", position)
+                        position = len(mm) if newline == -1 else newline + 1
+                        self.lines += 1
+
+        try:
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(_HEADER.pack(_MAGIC, self.every, stat.st_size, stat.st_mtime_ns, self.lines))
+                self.offsets.tofile(f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save the line index of {self.filepath}, keeping it in memory: {e}")
+
+    def __len__(self):
+        return self.lines
+
+    def seek(self, mm, line_no):
+
+        """
+        Returns:
+            int: Byte offset of a line in the mapped file, or its size if line_no is past the end.
+        """
+
+        if line_no >= self.lines:
+            return len(mm)
+
+        position = self.offsets[line_no // self.every]
+        for _ in range(line_no % self.every):
+            position = mm.find(b"\n", position) + 1
+
+        return position
+
+
+def read_jsonl(filepath, start=0, stop=None, raw=False):
+
+    """
+    Stream rows from a memory-mapped jsonl file.
+
+    Args:
+        filepath (str): Path to the jsonl file.
+        start (int): First line to read. Reading from a later line seeks to it through the file's LineIndex.
+        stop (int): Line to stop before. None reads to the end.
+        raw (bool): Yield the undecoded lines as bytes, for callers that only parse some of them.
+
+    Yields:
+        dict: One parsed row per line.
+    """
+
+    if stop is not None and stop <= start:
+        return
+
+    with open(filepath, "rb") as f:
+        mm = _map(f)
+        if mm is None:
+            return
+
+        with mm:
+            position = LineIndex(filepath).seek(mm, start) if start else 0
+            line_no = start
+            while position < len(mm) and (stop is None or line_no < stop):
+                newline = mm.find(b"\n", position)
+                end = len(mm) if newline == -1 else newline
+                line = mm[position:end]
+                yield line if raw else loads(line)
+                position = end + 1
+                line_no += 1
+
+
+def count_lines(filepath):
+
+    """
+    Count the rows of a jsonl file without parsing them, from its LineIndex.
+    """
+
+    return len(LineIndex(filepath))
@@ -0,0 +1,242 @@
+import os
+import random
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from array import array
+
+from utils.seed_index import normalize_seed
+
+VIRAMA = "\u094d"
+
+_MERSENNE = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+
+def clusters(text):
+
+    """
+    Split text into aksharas: a base character with its vowel signs, nukta and
+    virama attached, and a virama followed by a consonant forming a conjunct.
+    Counting n-grams in aksharas instead of code points keeps a matra change
+    from touching more n-grams than a consonant change.
+
+    Returns:
+        list: The clusters of text.
+    """
+
+    result = []
+    for char in text:
+        if result and (unicodedata.category(char).startswith("M") or (result[-1].endswith(VIRAMA) and not char.isspace())):
+            result[-1] += char
+        else:
+            result.append(char)
+
+    return result
+
+
+def shingles(text, ngram=3):
+
+    """
+    Character n-grams of a normalized text, over aksharas.
+
+    Returns:
+        set: The n-grams as strings.
+    """
+
+    # Punctuation and symbols, the danda included, carry no meaning for similarity.
+    # \W can't be used for this, Python counts vowel signs as non word characters.
+    text = "".join(" " if unicodedata.category(char)[0] in "PS" else char for char in text.lower())
+    text = normalize_seed(text)
+    units = clusters(text)
+
+    if len(units) <= ngram:
+        return {"".join(units)} if units else set()
+
+    return {"".join(units[idx:idx + ngram]) for idx in range(len(units) - ngram + 1)}
+
+
+def lsh_params(threshold, num_perm):
+
+    """
+    Bands and rows per band whose S-curve crosses over closest to the threshold.
+
+    Returns:
+        tuple: (bands, rows) with bands * rows <= num_perm.
+    """
+
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        crossover = (1 / bands) ** (1 / rows)
+        if best is None or abs(crossover - threshold) < abs(best[2] - threshold):
+            best = (bands, rows, crossover)
+
+    return best[0], best[1]
+
+
+class MinHasher:
+
+    """
+    MinHash signatures with num_perm universal hash permutations of a 32 bit base hash.
+    """
+
+    def __init__(self, num_perm=128, ngram=3, seed=1):
+        self.num_perm = num_perm
+        self.ngram = ngram
+
+        generator = random.Random(seed)
+        self.permutations = [(generator.randrange(1, _MERSENNE), generator.randrange(0, _MERSENNE)) for _ in range(num_perm)]
+
+    def signature(self, text):
+
+        """
+        Returns:
+            list: num_perm minimum hash values of the text's n-grams.
+        """
+
+        hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+                  for shingle in shingles(text, self.ngram)]
+
+        if not hashes:
+            return [_MAX_HASH] * self.num_perm
+
+        return [min(((a * value + b) % _MERSENNE) & _MAX_HASH for value in hashes) for a, b in self.permutations]
+
+
+def similarity(signature, other):
+
+    """
+    Estimated Jaccard similarity of two signatures: the fraction of positions they agree on.
+    """
+
+    return sum(1 for left, right in zip(signature, other) if left == right) / len(signature)
+
+
+class LSHIndex:
+
+    """
+    Persistent MinHash LSH index in SQLite. Signatures are split into bands, and
+    texts sharing a band bucket are candidates, confirmed by their estimated similarity.
+    check() may be called from several threads, one at a time; writes are committed
+    every commit_every inserts and on close.
+    """
+
+    def __init__(self, path, threshold=0.8, num_perm=128, ngram=3, commit_every=1000, resume=True):
+
+        """
+        Args:
+            path (str): SQLite file holding the index.
+            threshold (float): Estimated Jaccard similarity from which texts count as near duplicates.
+            num_perm (int): Signature length. Longer is more accurate and slower.
+            ngram (int): Aksharas per n-gram.
+            commit_every (int): Inserts between commits.
+            resume (bool): Keep the texts indexed by earlier runs. Otherwise the index starts empty.
+        """
+
+        self.path = path
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm=num_perm, ngram=ngram)
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self.commit_every = commit_every
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS signatures (key TEXT PRIMARY KEY, signature BLOB NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets (band INTEGER NOT NULL, bucket INTEGER NOT NULL, key TEXT NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS buckets_lookup ON buckets (band, bucket)")
+
+        if not resume:
+            for table in ("meta", "signatures", "buckets"):
+                self.conn.execute(f"DELETE FROM {table}")
+            self.conn.commit()
+
+        # Signatures made with other parameters can't be compared, so an index is tied to its parameters
+        params = f"num_perm={num_perm},ngram={ngram},bands={self.bands},rows={self.rows}"
+        stored = self.conn.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        if stored is None:
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('params', ?)", (params,))
+            self.conn.commit()
+        elif stored[0] != params:
+            raise ValueError(f"Index {path} was built with {stored[0]}, not {params}")
+
+    def _buckets(self, signature):
+        for band in range(self.bands):
+            values = array("Q", signature[band * self.rows:(band + 1) * self.rows]).tobytes()
+            yield band, int.from_bytes(hashlib.blake2b(values, digest_size=8).digest(), "little", signed=True)
+
+    def query(self, signature):
+
+        """
+        Returns:
+            tuple: (key, similarity) of the most similar indexed text at or above the threshold, or None.
+        """
+
+        candidates = set()
+        for band, bucket in self._buckets(signature):
+            candidates.update(key for (key,) in self.conn.execute("SELECT key FROM buckets WHERE band = ? AND bucket = ?", (band, bucket)))
+
+        best = None
+        for key in candidates:
+            stored = array("Q")
+            stored.frombytes(self.conn.execute("SELECT signature FROM signatures WHERE key = ?", (key,)).fetchone()[0])
+            score = similarity(signature, stored)
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (key, score)
+
+        return best
+
+    def insert(self, key, signature):
+        self.conn.execute("INSERT OR REPLACE INTO signatures (key, signature) VALUES (?, ?)", (key, array("Q", signature).tobytes()))
+        self.conn.executemany("INSERT INTO buckets (band, bucket, key) VALUES (?, ?, ?)",
+                              [(band, bucket, key) for band, bucket in self._buckets(signature)])
+
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.conn.commit()
+            self._pending = 0
+
+    def check(self, key, text):
+
+        """
+        Look a text up and index it if it is new.
+
+        Args:
+            key (str): Stable ID of the text. A text already indexed under the same key is not its own duplicate.
+            text (str): The text.
+
+        Returns:
+            tuple: (key, similarity) of the text it duplicates, or None if it was kept.
+        """
+
+        signature = self.hasher.signature(text)
+
+        # Lookup and insert in one step, so two near duplicates checked at once can't both be kept
+        with self._lock:
+            if self.conn.execute("SELECT 1 FROM signatures WHERE key = ?", (key,)).fetchone():
+                return None
+
+            match = self.query(signature)
+            if match is None:
+                self.insert(key, signature)
+
+        return match
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
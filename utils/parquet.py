@@ -0,0 +1,244 @@
+import os
+import glob
+import hashlib
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from utils.writer import OutputWriter
+
+# Row fields holding the raw model response, the same for every row of a batch
+RAW_FIELDS = ("response", "question_raw")
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet output needs pyarrow. Install it with `pip install pyarrow`.")
+
+
+def shard_files(folder, prefix="part"):
+
+    """
+    Finished shards of a Parquet output folder, in order. Shards still being written end in .tmp and are left out.
+    """
+
+    return sorted(glob.glob(os.path.join(folder, f"{prefix}-*.parquet")))
+
+
+def raw_id(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+class ParquetWriter(OutputWriter):
+
+    """
+    Writer thread for sharded, compressed Parquet output. Rows go to part-NNNNN.parquet
+    files in a folder named after the output file. Raw response fields are moved to a
+    raw-NNNNN.parquet side table with one row per distinct response, and the rows keep
+    <field>_id instead, so a packed batch's response is stored once rather than on every row.
+
+    A shard is written to .tmp and renamed once it holds shard_rows rows or the writer
+    closes. Row IDs are only marked done at that point, because a Parquet file without
+    its footer can't be read back. The number of finished shards is recorded with them,
+    and on resume shards past it are removed, as their rows are sent again.
+    """
+
+    def __init__(self, filepath, checkpoint=None, shard_rows=100000, compression="zstd", raw_fields=RAW_FIELDS, batch_rows=10000, **kwargs):
+
+        """
+        Args:
+            filepath (str): Output file the shard folder is named after, e.g. out.jsonl writes to out/.
+            checkpoint (Checkpoint): Completion index. Resuming starts a new shard after the existing ones.
+            shard_rows (int): Rows per shard.
+            compression (str): Parquet compression codec.
+            raw_fields (tuple): Row fields moved to the raw side table.
+            batch_rows (int): Rows per write, which become one row group.
+            **kwargs: Passed on to OutputWriter (flush_interval, ordered, on_flush). atomic and fsync don't apply, shards are always renamed into place.
+        """
+
+        _require_pyarrow()
+
+        self.shard_rows = shard_rows
+        self.compression = compression
+        self.raw_fields = raw_fields
+
+        kwargs.pop("atomic", None)
+        kwargs.pop("fsync", None)
+        super().__init__(filepath, checkpoint=checkpoint, batch_rows=batch_rows, **kwargs)
+
+    def _open(self, resume):
+        self.path = os.path.splitext(self.filepath)[0]
+        os.makedirs(self.path, exist_ok=True)
+
+        for path in glob.glob(os.path.join(self.path, "*.parquet.tmp")) + ([] if resume else glob.glob(os.path.join(self.path, "*.parquet"))):
+            os.remove(path)
+
+        if resume and self.checkpoint.position is not None:
+            for path in shard_files(self.path, "part") + shard_files(self.path, "raw"):
+                if int(os.path.basename(path).split("-")[1].split(".")[0]) >= self.checkpoint.position:
+                    os.remove(path)
+
+        existing = shard_files(self.path)
+        self._schema = pa.unify_schemas([pq.read_schema(path) for path in existing]) if existing else None
+        self._shard = len(existing)
+        self._part_writer = None
+        self._raw_writer = None
+        self._shard_count = 0
+        self._shard_ids = []
+        self._raw_seen = set()
+
+    def existing_rows(self):
+        for path in shard_files(self.path):
+            yield from pq.read_table(path).to_pylist()
+
+    def _shard_path(self, prefix):
+        return os.path.join(self.path, f"{prefix}-{self._shard:05d}.parquet")
+
+    def _split_raw(self, rows):
+
+        """
+        Returns:
+            tuple: (rows with raw fields replaced by their IDs, raw side table rows not stored yet).
+        """
+
+        slim_rows, raw_rows = [], []
+        for row in rows:
+            row = dict(row)
+            for field in self.raw_fields:
+                if field not in row:
+                    continue
+
+                text = row.pop(field)
+                text = text if isinstance(text, str) else str(text)
+                row[f"{field}_id"] = text_id = raw_id(text)
+
+                if text_id not in self._raw_seen:
+                    self._raw_seen.add(text_id)
+                    raw_rows.append({"raw_id": text_id, "field": field, "text": text})
+            slim_rows.append(row)
+
+        return slim_rows, raw_rows
+
+    def _write(self, rows):
+
+        # Split at shard boundaries; a flush can be larger than what is left of the shard
+        while rows:
+            take = self.shard_rows - self._shard_count
+            self._write_shard(rows[:take])
+            rows = rows[take:]
+
+    def _unify(self, schema):
+
+        """
+        Returns:
+            pyarrow.Schema: The schema so far, with the new columns of schema and the types of columns that were only null so far.
+        """
+
+        if self._schema is None:
+            return schema
+
+        try:
+            return pa.unify_schemas([self._schema, schema])
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f"Rows written to {self.path} changed the type of a column: {e}") from e
+
+    def _write_shard(self, rows):
+        rows, raw_rows = self._split_raw(rows)
+
+        # Columns empty so far stay typed null until a batch has values for them
+        schema = self._unify(pa.Table.from_pylist(rows).schema)
+        if self._schema is None or not schema.equals(self._schema):
+            # A Parquet file has one schema, so rows with new columns or types start the next shard
+            if self._part_writer is not None:
+                self._finish_shard()
+            self._schema = schema
+
+        if self._part_writer is None:
+            self._part_writer = pq.ParquetWriter(self._shard_path("part") + ".tmp", self._schema, compression=self.compression)
+        self._part_writer.write_table(pa.Table.from_pylist(rows, schema=self._schema))
+
+        if raw_rows:
+            if self._raw_writer is None:
+                raw_schema = pa.schema([("raw_id", pa.string()), ("field", pa.string()), ("text", pa.string())])
+                self._raw_writer = pq.ParquetWriter(self._shard_path("raw") + ".tmp", raw_schema, compression=self.compression)
+            self._raw_writer.write_table(pa.Table.from_pylist(raw_rows, schema=self._raw_writer.schema))
+
+        self._shard_count += len(rows)
+        if self._shard_count >= self.shard_rows:
+            self._finish_shard()
+
+    def _mark_done(self, done_ids):
+        self._shard_ids.extend(done_ids)
+        if self._part_writer is None:
+            self._finish_shard()
+
+    def _finish_shard(self):
+        for prefix, writer in (("part", self._part_writer), ("raw", self._raw_writer)):
+            if writer is not None:
+                writer.close()
+                os.replace(self._shard_path(prefix) + ".tmp", self._shard_path(prefix))
+
+        if self._part_writer is not None:
+            self._shard += 1
+
+        if self._shard_ids and self.checkpoint is not None:
+            self.checkpoint.mark_done(self._shard_ids, self._shard)
+
+        self._part_writer = None
+        self._raw_writer = None
+        self._shard_count = 0
+        self._shard_ids = []
+
+    def _close(self):
+        if self.error is None and not self.cancelled:
+            self._finish_shard()
+            return
+
+        # A failed or cancelled shard is left as .tmp, which the next run removes
+        for writer in (self._part_writer, self._raw_writer):
+            if writer is not None:
+                writer.close()
+
+
+def read_table(folder, columns=None, prefix="part"):
+
+    """
+    Read the shards of a Parquet output folder as one Arrow table.
+
+    Args:
+        folder (str): Shard folder written by ParquetWriter.
+        columns (list): Columns to read. None reads all of them.
+        prefix (str): "part" for the rows, "raw" for the raw response side table.
+
+    Returns:
+        pyarrow.Table: The rows.
+    """
+
+    _require_pyarrow()
+
+    # Shards differ in schema where later rows brought new columns
+    paths = shard_files(folder, prefix)
+    schema = pa.unify_schemas([pq.read_schema(path) for path in paths]) if paths else None
+    return pq.ParquetDataset(paths, schema=schema).read(columns=columns)
+
+
+def to_dataset(folder, columns=None, prefix="part"):
+
+    """
+    Load a Parquet output folder as a datasets.Dataset, e.g. to push_to_hub it.
+
+    Args:
+        folder (str): Shard folder written by ParquetWriter.
+        columns (list): Columns to load. None loads all of them.
+        prefix (str): "part" for the rows, "raw" for the raw response side table.
+
+    Returns:
+        datasets.Dataset: The rows.
+    """
+
+    from datasets import Dataset
+
+    return Dataset.from_parquet(shard_files(folder, prefix), columns=columns)
@@ -0,0 +1,150 @@
+import re
+
+_DEVANAGARI = re.compile("[\u0900-\u097f]")
+# Letters of any other script. \w leaves out vowel signs, which are all Devanagari here anyway.
+_OTHER_LETTERS = re.compile("[^\\W\\d_\u0900-\u097f]")
+_SENTENCE_END = re.compile(r"(?<=[।॥?!.])\s+")
+
+# Lines that are site furniture rather than content, in English and Hindi
+_BOILERPLATE = re.compile(
+    r"cookie|copyright|©|all rights reserved|privacy policy|terms of (use|service)|click here|subscribe|sign up|log ?in|https?://|www\.|"
+    r"सभी अधिकार सुरक्षित|यह भी पढ़ें|ये भी पढ़ें|और पढ़ें|सब्सक्राइब|फॉलो करें|लाइक करें|डाउनलोड करें",
+    re.IGNORECASE,
+)
+
+
+def cut_sentences(text, max_chars=500):
+
+    """
+    Cut text to at most max_chars at a sentence end (danda, double danda, ?, ! or .)
+    instead of mid-sentence. A first sentence longer than max_chars is cut at a word boundary.
+
+    Returns:
+        str: The cut text.
+    """
+
+    if len(text) <= max_chars:
+        return text
+
+    cut = 0
+    for match in _SENTENCE_END.finditer(text):
+        if match.start() > max_chars:
+            break
+        cut = match.start()
+
+    if cut:
+        return text[:cut]
+
+    space = text.rfind(" ", 0, max_chars + 1)
+    return text[:space if space > 0 else max_chars]
+
+
+def text_stats(text):
+
+    """
+    Cheap per-row statistics deciding whether a text is worth an API call.
+
+    Returns:
+        dict: length (characters), script_ratio (share of letters that are Devanagari),
+        repetition (share of repeated word trigrams) and boilerplate (share of lines that look like site furniture).
+    """
+
+    devanagari = len(_DEVANAGARI.findall(text))
+    other = len(_OTHER_LETTERS.findall(text))
+
+    words = text.split()
+    trigrams = list(zip(words, words[1:], words[2:]))
+    repetition = 1 - len(set(trigrams)) / len(trigrams) if trigrams else 0.0
+
+    lines = [line for line in text.splitlines() if line.strip()]
+    boilerplate = sum(1 for line in lines if _BOILERPLATE.search(line)) / len(lines) if lines else 0.0
+
+    return {
+        "length": len(text.strip()),
+        "script_ratio": devanagari / (devanagari + other) if devanagari + other else 0.0,
+        "repetition": repetition,
+        "boilerplate": boilerplate,
+    }
+
+
+class PreFilter:
+
+    """
+    Drops rows that can't yield Hindi seeds before a prompt is built for them:
+    too short, mostly another script, repetitive or boilerplate.
+    """
+
+    def __init__(self, min_length=50, min_script_ratio=0.5, max_repetition=0.5, max_boilerplate=0.5, field="text", max_chars=None):
+
+        """
+        Args:
+            min_length (int): Minimum length of the text in characters.
+            min_script_ratio (float): Minimum share of letters that are Devanagari.
+            max_repetition (float): Maximum share of repeated word trigrams.
+            max_boilerplate (float): Maximum share of boilerplate lines.
+            field (str): Row field holding the text.
+            max_chars (int): Judge only the part of the text cut_sentences keeps for the prompt. None judges all of it.
+        """
+
+        self.min_length = min_length
+        self.min_script_ratio = min_script_ratio
+        self.max_repetition = max_repetition
+        self.max_boilerplate = max_boilerplate
+        self.field = field
+        self.max_chars = max_chars
+        self.kept = 0
+        self.dropped = {"length": 0, "script": 0, "repetition": 0, "boilerplate": 0}
+
+    def reason(self, row):
+
+        """
+        Returns:
+            str: Why the row is dropped, or None to keep it.
+        """
+
+        text = row.get(self.field) or ""
+        if self.max_chars is not None:
+            text = cut_sentences(text, self.max_chars)
+
+        stats = text_stats(text)
+
+        if stats["length"] < self.min_length:
+            return "length"
+        if stats["script_ratio"] < self.min_script_ratio:
+            return "script"
+        if stats["repetition"] > self.max_repetition:
+            return "repetition"
+        if stats["boilerplate"] > self.max_boilerplate:
+            return "boilerplate"
+
+        return None
+
+    def filter(self, pairs, on_drop=None):
+
+        """
+        Pass on the (row_id, row) pairs worth sending.
+
+        Args:
+            pairs (iterable): (row_id, row) pairs.
+            on_drop (callable): Called with the row_id and reason of every dropped row.
+
+        Yields:
+            tuple: The kept (row_id, row) pairs.
+        """
+
+        for row_id, row in pairs:
+            reason = self.reason(row)
+            if reason is None:
+                self.kept += 1
+                yield row_id, row
+                continue
+
+            self.dropped[reason] += 1
+            if on_drop is not None:
+                on_drop(row_id, reason)
+
+    def report(self, batch_size=1):
+        dropped = sum(self.dropped.values())
+        details = ", ".join(f"{count} by {reason}" for reason, count in self.dropped.items() if count)
+        print(f"Pre-filter kept {self.kept} rows and dropped {dropped}{f' ({details})' if details else ''}, "
+              f"saving about {-(-dropped // batch_size)} API calls")
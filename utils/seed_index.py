@@ -0,0 +1,207 @@
+import os
+import re
+import time
+import sqlite3
+import unicodedata
+
+NUKTA = "\u093c"
+
+# Zero width space, ZWNJ, ZWJ, word joiner and BOM change how a word renders at most, not what it is
+_INVISIBLE = re.compile("[\u200b\u200c\u200d\u2060\ufeff]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_seed(seed, fold_nukta=True):
+
+    """
+    Canonical form of a seed, so spelling variants of one Devanagari word share an index entry.
+
+    Args:
+        seed (str): Seed as the model wrote it.
+        fold_nukta (bool): Drop the nukta, so ज़िंदगी and जिंदगी are the same seed.
+
+    Returns:
+        str: NFC normalized seed without zero width characters and with single spaces.
+    """
+
+    # NFD first: precomposed letters like ऩ only split off their nukta when decomposed
+    seed = unicodedata.normalize("NFD", seed)
+    seed = _INVISIBLE.sub("", seed)
+    if fold_nukta:
+        seed = seed.replace(NUKTA, "")
+
+    return _SPACES.sub(" ", unicodedata.normalize("NFC", seed)).strip()
+
+
+class SeedIndex:
+
+    """
+    Persistent SQLite index of every seed extracted so far, keyed by its normalized form.
+    Keeps a count and the files each seed came from, and whether questions were
+    already generated for it, so later runs only pay for seeds that are new.
+    """
+
+    def __init__(self, path, fold_nukta=True):
+
+        """
+        Args:
+            path (str): SQLite file holding the index.
+            fold_nukta (bool): Treat seeds that only differ by nukta as the same seed.
+        """
+
+        self.path = path
+        self.fold_nukta = fold_nukta
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS seeds (
+                norm TEXT PRIMARY KEY,
+                seed TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                added REAL NOT NULL,
+                asked INTEGER NOT NULL DEFAULT 0
+            )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS sources (
+                norm TEXT NOT NULL,
+                source TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (norm, source, kind)
+            )""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def normalize(self, seed):
+        return normalize_seed(seed, fold_nukta=self.fold_nukta)
+
+    def add(self, counts, kind, source):
+
+        """
+        Record the seeds one source produced. Adding the same source again replaces its
+        counts instead of adding to them, so re-running a file does not inflate them.
+
+        Args:
+            counts (dict): Seed mapped to how often the source produced it.
+            kind (str): "name" or "keyword".
+            source (str): Where the seeds came from, e.g. the input file.
+
+        Returns:
+            int: Number of seeds that were not in the index before.
+        """
+
+        # Merge variants first, they may be written differently within one source too
+        merged = {}
+        for seed, count in counts.items():
+            norm = self.normalize(seed)
+            if norm:
+                first_seed, total = merged.get(norm, (seed, 0))
+                merged[norm] = (first_seed, total + count)
+
+        new = 0
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                for norm, (seed, count) in merged.items():
+                    cursor = conn.execute("INSERT OR IGNORE INTO seeds (norm, seed, kind, count, added) VALUES (?, ?, ?, 0, ?)",
+                                          (norm, seed, kind, now))
+                    new += cursor.rowcount
+
+                    row = conn.execute("SELECT count FROM sources WHERE norm = ? AND source = ? AND kind = ?", (norm, source, kind)).fetchone()
+                    previous = row[0] if row else 0
+
+                    conn.execute("INSERT OR REPLACE INTO sources (norm, source, kind, count) VALUES (?, ?, ?, ?)", (norm, source, kind, count))
+                    conn.execute("UPDATE seeds SET count = count + ? WHERE norm = ?", (count - previous, norm))
+        finally:
+            conn.close()
+
+        return new
+
+    def __contains__(self, seed):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT 1 FROM seeds WHERE norm = ?", (self.normalize(seed),)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def known(self, seeds):
+
+        """
+        Returns:
+            set: The given seeds that are already in the index.
+        """
+
+        norms = {}
+        for seed in seeds:
+            norms.setdefault(self.normalize(seed), []).append(seed)
+
+        found = set()
+        conn = self._connect()
+        try:
+            keys = list(norms)
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for (norm,) in conn.execute(f"SELECT norm FROM seeds WHERE norm IN ({placeholders})", chunk):
+                    found.update(norms[norm])
+        finally:
+            conn.close()
+
+        return found
+
+    def count_pending(self, min_count=1):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM seeds WHERE asked = 0 AND count >= ?", (min_count,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def pending(self, min_count=1, chunk_size=1000):
+
+        """
+        Seeds no questions were generated for yet, in the order they were added.
+
+        Args:
+            min_count (int): Only seeds seen at least this many times.
+            chunk_size (int): Seeds read from the index per query.
+
+        Yields:
+            tuple: (row_id, row) pairs for the question stage.
+        """
+
+        last = 0
+        while True:
+            conn = self._connect()
+            try:
+                rows = conn.execute("SELECT rowid, norm, seed, count FROM seeds WHERE asked = 0 AND count >= ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                                    (min_count, last, chunk_size)).fetchall()
+            finally:
+                conn.close()
+
+            if not rows:
+                return
+
+            for rowid, norm, seed, count in rows:
+                yield f"seed:{norm}", {"seed": seed, "count": count}
+            last = rows[-1][0]
+
+    def mark_asked(self, row_ids):
+
+        """
+        Record that questions were generated for the seeds with these row IDs, as yielded by pending().
+        """
+
+        norms = [(row_id[len("seed:"):],) for row_id in row_ids if row_id.startswith("seed:")]
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("UPDATE seeds SET asked = 1 WHERE norm = ?", norms)
+        finally:
+            conn.close()
@@ -0,0 +1,294 @@
+import os
+import time
+from queue import Queue, Empty
+from threading import Thread
+
+from utils.jsonl import read_jsonl, dumps
+
+_STOP = object()
+
+OUTPUT_FORMATS = ("jsonl", "parquet")
+
+
+def cut_back(filepath, size):
+
+    """
+    Truncate a jsonl file to the size recorded with its last done IDs, dropping rows whose IDs
+    never made it into the index. They are sent again on resume, and written again then.
+    """
+
+    if os.path.exists(filepath) and os.path.getsize(filepath) > size:
+        with open(filepath, "rb+") as f:
+            f.truncate(size)
+
+
+def drop_partial_line(filepath):
+
+    """
+    Truncate a row that was half written to a jsonl file when the previous run died.
+    """
+
+    if not os.path.exists(filepath):
+        return
+
+    with open(filepath, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        position = size
+        while position > 0:
+            step = min(65536, position)
+            f.seek(position - step)
+            chunk = f.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                position = position - step + newline + 1
+                break
+            position -= step
+
+        if position != size:
+            f.truncate(position)
+
+
+class OutputWriter:
+
+    """
+    Single writer thread for a jsonl output file. Workers hand finished items to put()
+    and never touch the file themselves, so rows can't interleave and the file sees
+    a few large writes instead of one per row.
+
+    If a write fails, the writer thread stops and keeps the exception. put() and close()
+    raise it, and an atomic output is not renamed into place.
+
+    A cancelled writer, e.g. of a shard whose lease went to another worker, writes nothing
+    more to the output, its index or its dead letters, and leaves an atomic output as it is.
+    """
+
+    def __init__(self, filepath, checkpoint=None, batch_rows=256, flush_interval=1.0, fsync=False, ordered=False, atomic=False, on_flush=None, dead_letters=None, cancel=None):
+
+        """
+        Args:
+            filepath (str): Output jsonl file.
+            checkpoint (Checkpoint): Completion index. Row IDs are marked done after their rows are flushed.
+                When it resumes, the writer appends instead of truncating.
+            batch_rows (int): Flush once this many rows are buffered.
+            flush_interval (float): Flush buffered rows at least every this many seconds.
+            fsync (bool): fsync the file on every flush.
+            ordered (bool): Write items in input order (by their seq) instead of completion order.
+            atomic (bool): Write to <filepath>.tmp and rename it over filepath once the writer is closed without error.
+            on_flush (callable): Called from the writer thread with the rows of every flush, once they are written.
+            dead_letters (DeadLetters): Where the rows of skipped items go, with the reason they were dropped.
+            cancel (threading.Event): Once set, buffered and later rows are dropped instead of written.
+        """
+
+        self.filepath = filepath
+        self.checkpoint = checkpoint
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.ordered = ordered
+        self.on_flush = on_flush
+        self.dead_letters = dead_letters
+        self.cancel = cancel
+        self.rows_written = 0
+        self.error = None
+
+        self.atomic = atomic
+        self._open(checkpoint is not None and checkpoint.resume)
+
+        self._queue = Queue()
+        self._held = {}
+        self._next_seq = 0
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _open(self, resume):
+        self.path = self.filepath + ".tmp" if self.atomic else self.filepath
+
+        # A resumed run that already finished has no .tmp left; keep appending to the final file
+        if self.atomic and resume and not os.path.exists(self.path) and os.path.exists(self.filepath):
+            self.atomic = False
+            self.path = self.filepath
+
+        if resume and self.checkpoint.position is not None:
+            cut_back(self.path, self.checkpoint.position)
+        elif resume:
+            drop_partial_line(self.path)
+
+        self._file = open(self.path, "a" if resume else "w", encoding='utf-8')
+
+    @property
+    def cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    def existing_rows(self):
+
+        """
+        Rows already in the output before this writer added any, e.g. from the run being resumed.
+        """
+
+        if os.path.exists(self.path):
+            yield from read_jsonl(self.path)
+
+    def put(self, seq, rows, row_ids, dropped=None):
+
+        """
+        Hand a finished item to the writer.
+
+        Args:
+            seq (int): Position of the item in the input, used in ordered mode.
+            rows (list): Output rows, or None if the item was skipped.
+            row_ids (list): Row IDs to mark done once the rows are flushed.
+            dropped (list): (row_id, row, reason, detail) tuples of the item's rows that were dropped.
+
+        Raises:
+            Exception: What the writer thread failed on, if it did.
+        """
+
+        if self.error is not None:
+            raise self.error
+
+        self._queue.put((seq, rows, row_ids, dropped))
+
+    def _release(self, item):
+
+        """
+        Returns:
+            list: Items that can be written now, in write order.
+        """
+
+        if not self.ordered:
+            return [item]
+
+        self._held[item[0]] = item
+        ready = []
+        while self._next_seq in self._held:
+            ready.append(self._held.pop(self._next_seq))
+            self._next_seq += 1
+
+        return ready
+
+    def _run(self):
+        buffered = []
+        done_ids = []
+        dropped = []
+        last_flush = time.monotonic()
+        stopping = False
+
+        while not stopping:
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = None
+
+            if item is _STOP:
+                stopping = True
+                # Whatever is still held back in ordered mode goes out in seq order
+                ready = [self._held[seq] for seq in sorted(self._held)]
+                self._held.clear()
+            elif item is not None:
+                ready = self._release(item)
+            else:
+                ready = []
+
+            for _, rows, row_ids, item_dropped in ready:
+                dropped.extend(item_dropped or [])
+                if rows is None:
+                    continue
+                buffered.extend(rows)
+                done_ids.extend(row_ids)
+
+            if stopping or len(buffered) >= self.batch_rows or time.monotonic() - last_flush >= self.flush_interval:
+                try:
+                    self._flush(buffered, done_ids, dropped)
+                except Exception as e:
+                    # Nothing after a failed write can be trusted to land; put() and close() raise this
+                    print(f"Error writing {self.filepath}: {e}")
+                    self.error = e
+                    return
+                buffered = []
+                done_ids = []
+                dropped = []
+                last_flush = time.monotonic()
+
+    def _flush(self, rows, done_ids, dropped=None):
+        if self.cancelled:
+            return
+
+        if dropped and self.dead_letters is not None:
+            self.dead_letters.add(dropped)
+
+        if rows:
+            self._write(rows)
+            self.rows_written += len(rows)
+            if self.on_flush is not None:
+                self.on_flush(rows)
+
+        if done_ids:
+            self._mark_done(done_ids)
+
+    def _position(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    def _write(self, rows):
+        self._file.write("".join(dumps(row) + "\n" for row in rows))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _mark_done(self, done_ids):
+        if self.checkpoint is not None:
+            self.checkpoint.mark_done(done_ids, self._position())
+
+    def close(self, success=True):
+
+        """
+        Flush everything and stop the writer thread.
+
+        Args:
+            success (bool): Rename the temporary file into place in atomic mode.
+
+        Raises:
+            Exception: What the writer thread failed on, if it did.
+        """
+
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._close()
+
+        if self.error is not None:
+            raise self.error
+
+        if self.atomic and success and not self.cancelled:
+            os.replace(self.path, self.filepath)
+
+    def _close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(success=exc_type is None)
+
+
+def open_writer(filepath, output_format="jsonl", shard_rows=100000, **kwargs):
+
+    """
+    Writer for the given output format.
+
+    Args:
+        filepath (str): Output jsonl file. Parquet output goes to a folder of the same name without the extension.
+        output_format (str): One of OUTPUT_FORMATS.
+        shard_rows (int): Rows per Parquet shard.
+        **kwargs: Passed on to the writer.
+    """
+
+    if output_format == "parquet":
+        from utils.parquet import ParquetWriter
+        return ParquetWriter(filepath, shard_rows=shard_rows, **kwargs)
+
+    if output_format != "jsonl":
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    return OutputWriter(filepath, **kwargs)